@@ -3,12 +3,11 @@ import sys
 import time
 
 import traceback
-import aioredis
-from waifustream import index, danbooru
+from waifustream import backend, danbooru, index
 
 
 async def main():
-    redis = await aioredis.create_redis('redis://localhost')
+    redis = await backend.connect()
     tag = await danbooru.resolve_tag(sys.argv[1])
     
     if tag is None:
@@ -0,0 +1,65 @@
+import asyncio
+import os
+import sys
+
+import aiohttp
+
+from waifustream import backend, backfill, index
+from waifustream.hashing import HashingService
+
+
+async def main():
+    if len(sys.argv) < 2 or sys.argv[1] not in index.hash_schemes:
+        print("Usage: {} [hash scheme] [concurrency (optional)] [batch size (optional)] [retry (optional)]".format(sys.argv[0]))
+        print("Available hash schemes: {}".format(', '.join(index.hash_schemes.keys())))
+        return
+
+    scheme = sys.argv[1]
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    batch_size = int(sys.argv[3]) if len(sys.argv) > 3 else 200
+    retry_failed = len(sys.argv) > 4 and sys.argv[4] == 'retry'
+
+    redis = await backend.connect()
+    hasher = HashingService()
+
+    saved = await backfill.get_backfill_stats(redis, scheme)
+    if retry_failed:
+        print("Retrying {} failed entries for scheme {}".format(saved.n_failed, scheme))
+    else:
+        print("Backfilling scheme {} from entry ID {} of {}".format(scheme, saved.next_id, saved.last_id))
+
+    def progress(stats):
+        n = stats.n_hashed + stats.n_skipped + stats.n_failed
+        rate = n / stats.elapsed
+
+        if retry_failed or rate == 0:
+            eta = ''
+        else:
+            eta = ", ~{:.0f} minutes remaining".format((stats.last_id - stats.next_id + 1) / rate / 60)
+
+        print("[{}/{}] {} hashed, {} skipped, {} failed ({:.1f} entries/s, {:.2f} MiB/s{})".format(
+            stats.next_id - 1, stats.last_id, stats.n_hashed, stats.n_skipped, stats.n_failed,
+            rate, stats.n_bytes / stats.elapsed / (1 << 20), eta
+        ))
+
+    headers = {}
+    if 'WAIFUSTREAM_UA' in os.environ:
+        headers['User-Agent'] = os.environ['WAIFUSTREAM_UA']
+
+    try:
+        async with aiohttp.ClientSession(headers=headers) as sess:
+            stats = await backfill.backfill_scheme(
+                redis, scheme, hasher, http_sess=sess,
+                batch_size=batch_size, concurrency=concurrency,
+                retry_failed=retry_failed, progress=progress
+            )
+    finally:
+        hasher.close()
+        redis.close()
+        await redis.wait_closed()
+
+    print("Hashed {} entries in {:.4f} seconds ({} skipped, {} failed)".format(stats.n_hashed, stats.elapsed, stats.n_skipped, stats.n_failed))
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main())
@@ -0,0 +1,55 @@
+import asyncio
+import sys
+import time
+
+import numpy as np
+
+from waifustream import backend, index
+from waifustream.index import IndexEntry
+from bench_entry_memory import make_entries
+
+# All data in these databases will be deleted!
+BENCH_URLS = ['redis://localhost/15', 'sqlite://']
+
+
+async def bench(url, entries, queries):
+    redis = await backend.connect(url)
+    await redis.flushdb()
+
+    t1 = time.perf_counter()
+    await IndexEntry.add_many(redis, entries)
+    t2 = time.perf_counter()
+
+    for q in queries:
+        await index.search_index(redis, q, min_threshold=32, k=1)
+    t3 = time.perf_counter()
+
+    await redis.flushdb()
+    redis.close()
+    await redis.wait_closed()
+
+    return t2 - t1, (t3 - t2) / len(queries)
+
+async def main():
+    n_entries = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    n_queries = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    urls = sys.argv[3:] if len(sys.argv) > 3 else BENCH_URLS
+
+    entries = list(make_entries(n_entries))
+
+    # Query with slightly perturbed copies of indexed hashes.
+    rng = np.random.default_rng(1)
+    queries = []
+    for i in rng.choice(n_entries, size=n_queries):
+        bits = np.unpackbits(entries[i].imhash_array)
+        bits[rng.choice(128, size=4, replace=False)] ^= 1
+        queries.append(np.packbits(bits))
+
+    print("Indexing {} entries and running {} queries:".format(n_entries, n_queries))
+    for url in urls:
+        t_load, t_query = await bench(url, entries, queries)
+        print("    {}: {:.0f} rows/minute loaded, {:.2f} ms per query".format(url, n_entries * 60 / t_load, t_query * 1000))
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main())
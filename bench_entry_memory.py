@@ -0,0 +1,80 @@
+import asyncio
+import random
+import sys
+
+import aioredis
+import numpy as np
+
+from waifustream import index
+from waifustream.index import IndexEntry
+
+# All data in this database will be deleted!
+BENCH_DB = 15
+
+
+def make_entries(n):
+    rng = np.random.default_rng(0)
+    py_rng = random.Random(0)
+    characters = ['character_{}'.format(i) for i in range(200)]
+
+    for i in range(n):
+        imhash = rng.integers(0, 256, size=16, dtype=np.uint8)
+        md5 = rng.integers(0, 256, size=16, dtype=np.uint8).tobytes().hex()
+
+        yield IndexEntry(
+            imhash=imhash,
+            src='danbooru',
+            src_id=1000000 + i,
+            src_url='https://danbooru.donmai.us/data/original/{}/{}/{}.jpg'.format(md5[:2], md5[2:4], md5),
+            characters=py_rng.sample(characters, py_rng.randint(1, 2)),
+            rating=py_rng.choice(['s', 'q', 'e'])
+        )
+
+def write_legacy(pipe, entry):
+    pipe.set(b'hash:'+entry.imhash+b':src', entry.src)
+    pipe.set(b'hash:'+entry.imhash+b':src_id', entry.src_id)
+    pipe.set(b'hash:'+entry.imhash+b':src_url', entry.src_url)
+    pipe.set(b'hash:'+entry.imhash+b':rating', entry.rating)
+    pipe.sadd(b'hash:'+entry.imhash+b':characters', *entry.characters)
+
+async def write_compact(redis, pipe, entry):
+    pipe.hmset_dict(index.entry_key(entry.imhash), await entry.compact_fields(redis))
+
+async def measure(redis, n, compact):
+    await redis.flushdb()
+    before = await redis.info('memory')
+
+    pipe = redis.pipeline()
+    for i, entry in enumerate(make_entries(n)):
+        if compact:
+            await write_compact(redis, pipe, entry)
+        else:
+            write_legacy(pipe, entry)
+
+        if (i+1) % 1000 == 0:
+            await pipe.execute()
+            pipe = redis.pipeline()
+    await pipe.execute()
+
+    after = await redis.info('memory')
+    await redis.flushdb()
+
+    return int(after['memory']['used_memory']) - int(before['memory']['used_memory'])
+
+async def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    redis = await aioredis.create_redis('redis://localhost', db=BENCH_DB)
+
+    legacy = await measure(redis, n, False)
+    compact = await measure(redis, n, True)
+    
+    redis.close()
+    await redis.wait_closed()
+
+    print("Memory usage for {} entries (extrapolated to 1M entries):".format(n))
+    print("    legacy:  {:.1f} MiB ({:.1f} MiB)".format(legacy / (1<<20), legacy * (1000000 / n) / (1<<20)))
+    print("    compact: {:.1f} MiB ({:.1f} MiB)".format(compact / (1<<20), compact * (1000000 / n) / (1<<20)))
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main())
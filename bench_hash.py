@@ -0,0 +1,63 @@
+import sys
+import time
+
+from PIL import Image
+import imagehash
+import numpy as np
+
+from waifustream import index
+
+
+def reference_hash(img):
+    # The original implementation of index.combined_hash.
+    h1 = imagehash.dhash(img)
+    h1 = np.packbits(np.where(h1.hash.flatten(), 1, 0))
+
+    h2 = imagehash.average_hash(img)
+    h2 = np.packbits(np.where(h2.hash.flatten(), 1, 0))
+
+    return np.concatenate((h1, h2))
+
+def synthetic_images(n, size=(4000, 6000)):
+    rng = np.random.default_rng(0)
+
+    for _ in range(n):
+        # Smooth random structure plus some fine noise, roughly like a photo or illustration.
+        base = Image.fromarray(rng.integers(0, 256, size=(12, 8, 3), dtype=np.uint8), 'RGB').resize(size, Image.BICUBIC)
+        noise = rng.integers(-16, 16, size=(size[1], size[0], 3))
+        yield Image.fromarray(np.clip(np.asarray(base, dtype=np.int16) + noise, 0, 255).astype(np.uint8), 'RGB')
+
+def bench(f, images):
+    hashes = []
+
+    t1 = time.perf_counter()
+    for img in images:
+        hashes.append(f(img))
+    t2 = time.perf_counter()
+
+    return (t2 - t1) / len(images), hashes
+
+def main():
+    if len(sys.argv) > 1:
+        images = []
+        for path in sys.argv[1:]:
+            img = Image.open(path)
+            img.load()
+            images.append(img)
+    else:
+        images = list(synthetic_images(5))
+
+    t_ref, ref = bench(reference_hash, images)
+    t_exact, exact = bench(index.combined_hash, images)
+    t_fast, fast = bench(lambda img: index.combined_hash(img, exact=False), images)
+
+    n_exact = sum(1 for h1, h2 in zip(ref, exact) if np.array_equal(h1, h2))
+    fast_dists = list(index.hamming_dist(h1, h2) for h1, h2 in zip(ref, fast))
+
+    print("Hashed {} images:".format(len(images)))
+    print("    imagehash:        {:.4f} seconds per image".format(t_ref))
+    print("    fused:            {:.4f} seconds per image ({:.1f}x speedup, {} / {} identical)".format(t_exact, t_ref / t_exact, n_exact, len(images)))
+    print("    fused (inexact):  {:.4f} seconds per image ({:.1f}x speedup, mean distance {:.2f}, max {})".format(t_fast, t_ref / t_fast, np.mean(fast_dists), max(fast_dists)))
+
+if __name__ == '__main__':
+    main()
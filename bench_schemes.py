@@ -0,0 +1,90 @@
+import asyncio
+import io
+import os
+import sys
+import time
+
+from PIL import Image
+import numpy as np
+
+from waifustream import backend, index
+from waifustream.index import IndexEntry
+from test_draft_hash import load_files, synthetic_jpegs
+
+# All data in this database will be deleted!
+BENCH_URL = os.environ.get('WAIFUSTREAM_BENCH_URL', 'sqlite://')
+SCHEMES = list(index.hash_schemes.keys())
+
+
+def perturb(data):
+    # Downscale and recompress, as often happens to images reposted elsewhere.
+    img = Image.open(io.BytesIO(data)).convert('RGB')
+    img = img.resize((max(1, img.width // 2), max(1, img.height // 2)), Image.BICUBIC)
+
+    bio = io.BytesIO()
+    img.save(bio, format='jpeg', quality=75)
+    return bio.getvalue()
+
+def hash_all(files):
+    return list(index.hash_image_file_multi(io.BytesIO(data), SCHEMES) for data in files)
+
+async def count_candidates(redis, scheme, imhash):
+    keys = index.construct_probe_keys(imhash.tobytes(), None, scheme.bucket_chunk_bits, scheme.key_prefix)
+    return len(await index.fetch_bucket_hashes(redis, keys, union=True, id_prefix=scheme.entry_hashes_prefix))
+
+async def main():
+    if len(sys.argv) > 1:
+        files = list(load_files(sys.argv[1:]))
+    else:
+        files = list(synthetic_jpegs(20, size=(800, 1200)))
+
+    indexed = hash_all(files)
+    queries = hash_all(perturb(data) for data in files)
+
+    redis = await backend.connect(BENCH_URL)
+    await redis.flushdb()
+
+    entries = []
+    for i, hashes in enumerate(indexed):
+        hashes = dict(hashes)
+        entries.append(IndexEntry(
+            imhash=hashes.pop(index.primary_hash_scheme),
+            src='bench',
+            src_id=str(i),
+            src_url='https://example.com/bench/{}.jpg'.format(i),
+            characters=[],
+            rating='s',
+            extra_hashes=hashes
+        ))
+    await IndexEntry.add_many(redis, entries)
+
+    print("Indexed {} images; querying with downscaled and recompressed copies:".format(len(files)))
+    for name in SCHEMES:
+        scheme = index.get_hash_scheme(name)
+        n_found = 0
+        n_candidates = 0
+        dists = []
+
+        t1 = time.perf_counter()
+        for entry, hashes in zip(entries, queries):
+            res = await index.search_index(redis, hashes[name], k=1, scheme=name)
+            if len(res) > 0 and res[0][0] == entry.imhash:
+                n_found += 1
+        t2 = time.perf_counter()
+
+        for entry, hashes in zip(entries, queries):
+            n_candidates += await count_candidates(redis, scheme, hashes[name])
+            own = indexed[int(entry.src_id)][name]
+            dists.append(index.hamming_dist(own, hashes[name]) / scheme.n_bits)
+
+        print("    {:>10s} ({:3d} bits): {:.2f} ms per query, {:.1f} candidates per query, {:.1%} found, mean relative distance {:.3f}".format(
+            name, scheme.n_bits, (t2 - t1) * 1000 / len(files), n_candidates / len(files), n_found / len(files), np.mean(dists)
+        ))
+
+    await redis.flushdb()
+    redis.close()
+    await redis.wait_closed()
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main())
@@ -0,0 +1,59 @@
+import sys
+import time
+
+import numpy as np
+
+from waifustream import index, snapshot
+
+
+def score_loop(hashes, imhash, min_threshold):
+    _t = []
+
+    for h in hashes:
+        arr = np.frombuffer(h, dtype=np.uint8)
+        dist = index.hamming_dist(arr, imhash)
+
+        if dist < min_threshold:
+            _t.append((h, dist))
+
+    return sorted(_t, key=lambda o: o[1])
+
+def bench(f, *args, n_runs=5):
+    best = None
+    for _ in range(n_runs):
+        t1 = time.perf_counter()
+        res = f(*args)
+        t2 = time.perf_counter()
+
+        if best is None or (t2 - t1) < best:
+            best = t2 - t1
+
+    return best, res
+
+def main():
+    n_candidates = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    min_threshold = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+
+    rng = np.random.default_rng(0)
+    
+    if len(sys.argv) > 3:
+        # Benchmark against real hashes from an index snapshot.
+        block = snapshot.read_snapshot_hashes(sys.argv[3])[:n_candidates]
+        imhash = np.array(block[rng.integers(0, len(block))])
+        hashes = list(bytes(row) for row in block)
+        n_candidates = len(hashes)
+    else:
+        imhash = rng.integers(0, 256, size=16, dtype=np.uint8)
+        hashes = list(bytes(row) for row in rng.integers(0, 256, size=(n_candidates, 16), dtype=np.uint8))
+
+    t_loop, res_loop = bench(score_loop, hashes, imhash, min_threshold)
+    t_vec, res_vec = bench(index.score_candidates, hashes, imhash, min_threshold)
+
+    assert res_loop == res_vec
+
+    print("Scored {} candidates ({} results under distance {}):".format(n_candidates, len(res_vec), min_threshold))
+    print("    loop:       {:.4f} seconds".format(t_loop))
+    print("    vectorized: {:.4f} seconds ({:.1f}x speedup)".format(t_vec, t_loop / t_vec))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+import asyncio
+import sys
+import time
+
+import ujson as json
+from waifustream import backend
+from waifustream.index import IndexEntry
+
+
+def read_batches(f, batch_size):
+    batch = []
+    for line in f:
+        line = line.strip()
+        if len(line) == 0:
+            continue
+        
+        batch.append(IndexEntry.from_dict(json.loads(line)))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    
+    if len(batch) > 0:
+        yield batch
+
+async def main():
+    if len(sys.argv) < 2:
+        print("Usage: {} [dump file, or - for stdin] [batch size (optional)]".format(sys.argv[0]))
+        print("Each line of the dump file should contain one JSON-encoded index entry (see IndexEntry.to_dict).")
+        return
+    
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    redis = await backend.connect()
+    
+    n_total = 0
+    n_added = 0
+    t1 = time.perf_counter()
+    
+    if sys.argv[1] == '-':
+        f = sys.stdin
+    else:
+        f = open(sys.argv[1], 'r', encoding='utf-8')
+    
+    with f:
+        for batch in read_batches(f, batch_size):
+            added = await IndexEntry.add_many(redis, batch, batch_size=batch_size)
+            
+            n_total += len(batch)
+            n_added += sum(added)
+            
+            dt = time.perf_counter() - t1
+            print("Loaded {} / {} entries ({:.0f} rows/minute)".format(n_added, n_total, n_total * 60 / dt))
+    
+    redis.close()
+    await redis.wait_closed()
+    
+    t2 = time.perf_counter()
+    print("Added {} new entries out of {} in {:.4f} seconds".format(n_added, n_total, t2-t1))
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main())
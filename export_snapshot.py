@@ -0,0 +1,27 @@
+import asyncio
+import sys
+import time
+
+from waifustream import backend, snapshot
+
+
+async def main():
+    if len(sys.argv) < 2:
+        print("Usage: {} [snapshot file]".format(sys.argv[0]))
+        return
+    
+    redis = await backend.connect()
+    
+    t1 = time.perf_counter()
+    with open(sys.argv[1], 'wb') as f:
+        n = await snapshot.export_snapshot(redis, f)
+    t2 = time.perf_counter()
+    
+    redis.close()
+    await redis.wait_closed()
+    
+    print("Exported {} entries in {:.4f} seconds".format(n, t2-t1))
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main())
@@ -3,12 +3,11 @@ import sys
 import time
 
 import traceback
-import aioredis
-from waifustream import index
+from waifustream import backend, index
 
 
 async def main():
-    redis = await aioredis.create_redis('redis://localhost')
+    redis = await backend.connect()
     
     characters = await index.get_indexed_characters(redis)
     for character in characters:
@@ -0,0 +1,34 @@
+import asyncio
+import sys
+import time
+
+from waifustream import backend, snapshot
+
+
+async def main():
+    if len(sys.argv) < 2:
+        print("Usage: {} [snapshot file] [batch size (optional)]".format(sys.argv[0]))
+        return
+    
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    redis = await backend.connect()
+    
+    t1 = time.perf_counter()
+    
+    def progress(n_added, n_total):
+        dt = time.perf_counter() - t1
+        print("Loaded {} / {} entries ({:.0f} rows/minute)".format(n_added, n_total, n_total * 60 / dt))
+    
+    with open(sys.argv[1], 'rb') as f:
+        n_added, n_total = await snapshot.import_snapshot(redis, f, batch_size=batch_size, progress=progress)
+    
+    t2 = time.perf_counter()
+    
+    redis.close()
+    await redis.wait_closed()
+    
+    print("Added {} new entries out of {} in {:.4f} seconds".format(n_added, n_total, t2-t1))
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main())
@@ -0,0 +1,56 @@
+import asyncio
+import sys
+import time
+
+from waifustream import backend, index
+
+
+async def main():
+    if len(sys.argv) > 1:
+        index.hash_chunk_bits = int(sys.argv[1])
+    
+    redis = await backend.connect()
+    
+    n_legacy = 0
+    t1 = time.perf_counter()
+    
+    # Convert entries from the legacy multi-key format first.
+    async for key in redis.iscan(match=b'hash:*:src'):
+        if len(key) != 25:
+            continue
+        
+        if await index.migrate_legacy_entry(redis, key[5:-4]):
+            n_legacy += 1
+            
+            if n_legacy % 10000 == 0:
+                print("Migrated {} legacy entries ({:.1f} entries/s)".format(n_legacy, n_legacy / (time.perf_counter() - t1)))
+    
+    t2 = time.perf_counter()
+    print("Migrated {} legacy entries in {:.4f} seconds".format(n_legacy, t2-t1))
+    
+    # Then assign entry IDs to everything that doesn't have one yet.
+    n_ids = 0
+    batch = []
+    
+    async for h in index.scan_hashes(redis):
+        batch.append(h)
+        
+        if len(batch) >= 1000:
+            n_ids += await index.migrate_entry_ids(redis, batch)
+            batch = []
+            print("Migrated {} entries to entry IDs ({:.1f} entries/s)".format(n_ids, n_ids / (time.perf_counter() - t2)))
+    
+    if len(batch) > 0:
+        n_ids += await index.migrate_entry_ids(redis, batch)
+    
+    t3 = time.perf_counter()
+    print("Migrated {} entries to entry IDs in {:.4f} seconds".format(n_ids, t3-t2))
+    
+    n_sets = await index.compact_sets(redis)
+    
+    t4 = time.perf_counter()
+    print("Re-encoded {} sets in {:.4f} seconds".format(n_sets, t4-t3))
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main())
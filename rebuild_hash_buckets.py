@@ -0,0 +1,30 @@
+import asyncio
+import sys
+import time
+
+from waifustream import backend, index
+
+
+async def main():
+    if len(sys.argv) < 2:
+        print("Usage: {} [new chunk bits] [old chunk bits (optional)]".format(sys.argv[0]))
+        return
+    
+    new_bits = int(sys.argv[1])
+    old_bits = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    
+    redis = await backend.connect()
+    
+    t1 = time.perf_counter()
+    n = await index.rebuild_hash_buckets(redis, new_bits)
+    t2 = time.perf_counter()
+    
+    print("Built {}-bit buckets for {} entries in {:.4f} seconds".format(new_bits, n, t2-t1))
+    
+    if old_bits is not None and old_bits != new_bits:
+        await index.clear_hash_buckets(redis, old_bits)
+        print("Deleted {}-bit buckets".format(old_bits))
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main())
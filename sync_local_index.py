@@ -0,0 +1,21 @@
+import asyncio
+import sys
+import time
+
+from waifustream import backend
+from waifustream.local_index import LocalIndex
+
+
+async def main():
+    redis = await backend.connect()
+    local_index = LocalIndex(sys.argv[1])
+    
+    t1 = time.perf_counter()
+    n_added = await local_index.sync(redis)
+    t2 = time.perf_counter()
+    
+    print("Added {} hashes in {:.4f} seconds ({} hashes total)".format(n_added, t2-t1, len(local_index)))
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main())
@@ -0,0 +1,214 @@
+import asyncio
+import sys
+import time
+
+import attr
+import numpy as np
+
+from waifustream import backend, index, work_queue
+from waifustream.index import IndexEntry
+from waifustream.work_queue import WorkQueue
+from bench_entry_memory import make_entries
+
+# All data in these databases will be deleted!
+TEST_URLS = ['redis://localhost/15', 'sqlite://']
+
+
+def perturb(rng, imhash, n_bits):
+    bits = np.unpackbits(np.frombuffer(bytes(imhash), dtype=np.uint8))
+    bits[rng.choice(len(bits), size=n_bits, replace=False)] ^= 1
+    return np.packbits(bits)
+
+def make_test_entries(n):
+    rng = np.random.default_rng(2)
+    entries = []
+
+    for i, entry in enumerate(make_entries(n)):
+        # Every fourth entry shares its secondary hash with the one before it.
+        if i % 4 != 3:
+            phash = rng.integers(0, 256, size=8, dtype=np.uint8)
+        entries.append(attr.evolve(entry, extra_hashes={'phash': phash}))
+
+    return entries
+
+def normalize(value):
+    # Make results comparable across backends: bytes are shown as hex, and
+    # unordered collections are sorted.
+    if isinstance(value, (bytes, bytearray)):
+        return bytes(value).hex()
+    elif isinstance(value, np.ndarray):
+        return value.tobytes().hex()
+    elif isinstance(value, dict):
+        return sorted((normalize(k), normalize(v)) for k, v in value.items())
+    elif isinstance(value, (set, frozenset)):
+        return sorted(normalize(v) for v in value)
+    elif isinstance(value, (list, tuple)):
+        return list(normalize(v) for v in value)
+    elif isinstance(value, IndexEntry):
+        return normalize(attr.asdict(value, recurse=False))
+    elif isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+async def run_commands(redis):
+    out = {}
+
+    await redis.set('str', 'a')
+    out['incr'] = [await redis.incr('counter'), await redis.incrby('counter', 5), await redis.get('counter')]
+
+    await redis.hmset_dict('hash', {'a': 1, 'b': 'x'})
+    await redis.hset('hash', 'c', b'\x00\xff')
+    out['hash'] = [
+        await redis.hgetall('hash'), await redis.hmget('hash', 'a', 'z', 'c'),
+        await redis.hdel('hash', 'a', 'z'), await redis.hincrby('hash', 'n', 3), await redis.hgetall('hash')
+    ]
+
+    out['sets'] = [
+        await redis.sadd('s1', 1, 2, 3), await redis.sadd('s2', 3, 4), await redis.srem('s1', 1, 9),
+        set(await redis.sunion('s1', 's2')), await redis.sunionstore('s3', 's1', 's2'),
+        set(await redis.smembers('s3')), await redis.scard('s3'), await redis.sismember('s3', 4)
+    ]
+
+    out['lists'] = [
+        await redis.rpush('l', 1, 2, 3), await redis.lpush('l', 0, -1), await redis.lrange('l', 0, -1),
+        await redis.lrange('l', 1, -2), await redis.lindex('l', -1), await redis.llen('l'),
+        await redis.lrem('l', 1, 2), await redis.ltrim('l', 1, -1), await redis.lrange('l', 0, -1),
+        await redis.rpop('l'), await redis.lpop('l'), await redis.brpop('empty', 'l', timeout=1)
+    ]
+
+    out['zsets'] = [
+        await redis.zadd('z', 3, 'c', 1, 'a', 2.5, 'b'), await redis.zadd('z', 4, 'a'),
+        await redis.zrangebyscore('z'), await redis.zrangebyscore('z', max=3, withscores=True),
+        await redis.zscore('z', 'b'), await redis.zscore('z', 'nope'),
+        await redis.zrem('z', 'b', 'nope'), await redis.zcard('z')
+    ]
+
+    pipe = redis.pipeline()
+    pipe.incr('p')
+    pipe.sadd('ps', 'x')
+    pipe.lrange('l', 0, -1)
+    out['pipeline'] = await pipe.execute()
+
+    tr = redis.multi_exec()
+    tr.incr('p')
+    tr.hset('ph', 'f', 'v')
+    out['multi_exec'] = await tr.execute()
+
+    out['delete'] = [await redis.exists('str', 'nope', 'hash'), await redis.delete('str', 'nope')]
+    out['keys'] = set([k async for k in redis.iscan(match='s*')])
+
+    return out
+
+async def run_index(redis, entries, queries, phash_queries):
+    out = {}
+
+    out['add_many'] = await IndexEntry.add_many(redis, entries[:-10])
+    out['add_to_index'] = list([await e.add_to_index(redis) for e in entries[-10:]])
+    out['add_duplicate'] = await entries[0].add_to_index(redis)
+
+    hashes = list(e.imhash for e in entries)
+    out['load_many'] = await IndexEntry.load_many(redis, hashes[::7] + [bytes(16)])
+
+    out['search_index'] = list([await index.search_index(redis, q, min_threshold=24) for q in queries])
+    out['search_index_k'] = list([await index.search_index(redis, q, min_threshold=24, k=2) for q in queries])
+    out['search_index_exact'] = list([await index.search_index(redis, q, min_threshold=8, exact_recall=True) for q in queries[:10]])
+    out['search_index_first'] = list([await index.search_index(redis, q, min_threshold=24, first_match_under=8) for q in queries])
+    out['search_many'] = await index.search_many(redis, queries, min_threshold=24)
+    out['search_server_side'] = list([await index.search_index_server_side(redis, q, min_threshold=24, k=3) for q in queries])
+    out['search_phash'] = list([await index.search_index(redis, q, scheme='phash') for q in phash_queries])
+    out['search_many_phash'] = await index.search_many(redis, phash_queries, scheme='phash')
+    out['search_server_side_phash'] = list([await index.search_index_server_side(redis, q, scheme='phash') for q in phash_queries])
+
+    char_keys = list('character:character_{}'.format(i) for i in range(5))
+    out['bucket_hashes'] = list(set(b) for b in await index.fetch_bucket_hashes(redis, char_keys))
+    out['bucket_hashes_union'] = set(await index.fetch_bucket_hashes(redis, char_keys, union=True))
+
+    out['index_log'] = list(h for _, h in await index.read_index_log(redis, b'0-0'))
+
+    return out
+
+async def run_work_queue(redis):
+    out = {}
+
+    await redis.lpush(work_queue.queue_key('a'), 'a1', 'a2')
+    await redis.lpush(work_queue.queue_key('b'), 'b1')
+
+    q1 = WorkQueue(redis, 'w1', lease_timeout=0.5)
+    q2 = WorkQueue(redis, 'w2', lease_timeout=60)
+
+    items = [await q1.claim(['a', 'b']), await q1.claim(['b', 'a']), await q2.claim(['a', 'b']), await q2.claim(['a', 'b'])]
+    out['claim'] = list((item.tag, item.data) if item is not None else None for item in items)
+
+    await q2.complete(items[2:3])
+    out['processing'] = [await redis.lrange(q1.processing_key, 0, -1), await redis.lrange(q2.processing_key, 0, -1)]
+
+    await asyncio.sleep(0.6)
+    await q2.heartbeat()
+    out['reap'] = [await q2.reap(), await redis.lrange(work_queue.queue_key('a'), 0, -1), await redis.lrange(work_queue.queue_key('b'), 0, -1)]
+    out['leases'] = await redis.zrangebyscore(work_queue.lease_key)
+
+    return out
+
+async def run_all(url, entries, queries, phash_queries):
+    redis = await backend.connect(url)
+    await redis.flushdb()
+
+    # Interned string IDs are cached per process, and must be reassigned
+    # for each database.
+    index._intern_ids.clear()
+    index._intern_names.clear()
+
+    results = {}
+    results.update(await run_commands(redis))
+    await redis.flushdb()
+    results.update(await run_index(redis, entries, queries, phash_queries))
+    await redis.flushdb()
+    results.update(await run_work_queue(redis))
+
+    await redis.flushdb()
+    redis.close()
+    await redis.wait_closed()
+
+    return dict((k, normalize(v)) for k, v in results.items())
+
+async def main():
+    n_entries = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    urls = sys.argv[2:] if len(sys.argv) > 2 else TEST_URLS
+
+    entries = make_test_entries(n_entries)
+
+    rng = np.random.default_rng(3)
+    picks = rng.choice(n_entries, size=40)
+    queries = list(perturb(rng, entries[i].imhash_array, 6) for i in picks)
+    phash_queries = list(perturb(rng, entries[i].extra_hashes['phash'], 3) for i in picks)
+
+    all_results = []
+    for url in urls:
+        t1 = time.perf_counter()
+        all_results.append(await run_all(url, entries, queries, phash_queries))
+        print("{}: completed in {:.2f} seconds".format(url, time.perf_counter() - t1))
+
+    base = all_results[0]
+    n_failed = 0
+
+    for name in base:
+        mismatched = list(url for url, res in zip(urls[1:], all_results[1:]) if res[name] != base[name])
+
+        if len(mismatched) == 0:
+            print("    {:>26s}: ok".format(name))
+            continue
+
+        n_failed += 1
+        print("    {:>26s}: MISMATCH".format(name))
+        for url, res in zip(urls, all_results):
+            print("        {}: {}".format(url, str(res[name])[:400]))
+
+    if n_failed > 0:
+        print("{} of {} checks differ between backends".format(n_failed, len(base)))
+        sys.exit(1)
+
+    print("All {} checks match".format(len(base)))
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main())
@@ -0,0 +1,68 @@
+import io
+import os
+import sys
+import time
+
+from PIL import Image
+import numpy as np
+
+from waifustream import index
+
+DRAFT_SCALES = [32, 16, 8, 4, 2, 1]
+
+
+def synthetic_jpegs(n, size=(4000, 6000)):
+    rng = np.random.default_rng(0)
+
+    for _ in range(n):
+        base = Image.fromarray(rng.integers(0, 256, size=(12, 8, 3), dtype=np.uint8), 'RGB').resize(size, Image.BICUBIC)
+        noise = rng.integers(-16, 16, size=(size[1], size[0], 3))
+        img = Image.fromarray(np.clip(np.asarray(base, dtype=np.int16) + noise, 0, 255).astype(np.uint8), 'RGB')
+
+        bio = io.BytesIO()
+        img.save(bio, format='jpeg', quality=90)
+        yield bio.getvalue()
+
+def load_files(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            yield from load_files(os.path.join(path, name) for name in sorted(os.listdir(path)))
+        else:
+            with open(path, 'rb') as f:
+                yield f.read()
+
+def hash_all(files, draft):
+    hashes = []
+    n_pixels = 0
+
+    t1 = time.perf_counter()
+    for data in files:
+        with index.open_image_for_hashing(io.BytesIO(data), draft=draft) as img:
+            n_pixels = max(n_pixels, img.width * img.height * len(img.getbands()))
+            hashes.append(index.combined_hash(img))
+    t2 = time.perf_counter()
+
+    return hashes, (t2 - t1) / len(files), n_pixels
+
+def main():
+    if len(sys.argv) > 1:
+        files = list(load_files(sys.argv[1:]))
+    else:
+        files = list(synthetic_jpegs(5))
+
+    full, t_full, px_full = hash_all(files, False)
+
+    print("Hashed {} images:".format(len(files)))
+    print("    full decode:  {:.4f} seconds per image, {:.1f} MiB largest decoded image".format(t_full, px_full / (1<<20)))
+
+    for scale in DRAFT_SCALES:
+        index.hash_draft_scale = scale
+        drafted, t_draft, px_draft = hash_all(files, True)
+
+        dists = np.array(list(index.hamming_dist(h1, h2) for h1, h2 in zip(full, drafted)))
+        print("    scale {:2d}:     {:.4f} seconds per image ({:.1f}x speedup), {:.1f} MiB largest decoded image, distance mean {:.2f} / max {} / {:.1%} exact".format(
+            scale, t_draft, t_full / t_draft, px_draft / (1<<20), dists.mean(), dists.max(), np.mean(dists == 0)
+        ))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+import sys
+
+from PIL import Image
+import numpy as np
+
+from waifustream import index
+from bench_hash import reference_hash
+
+# (width, height) pairs, from very wide to very tall.
+SIZES = [
+    (5000, 9), (3000, 20), (604, 5), (2000, 100), (3000, 2000), (1200, 850),
+    (9, 8), (8, 8), (1, 1), (3, 3), (64, 64), (850, 1200), (2000, 3000),
+    (100, 2000), (30, 3001), (20, 4000), (9, 5000), (5, 604), (2, 201), (1, 1000)
+]
+
+
+def random_images(size, n):
+    rng = np.random.default_rng(size[0] * 100003 + size[1])
+
+    for _ in range(n):
+        yield Image.fromarray(rng.integers(0, 256, size=(size[1], size[0], 3), dtype=np.uint8), 'RGB')
+
+def main():
+    n_images = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    n_failed = 0
+
+    print("Comparing index.combined_hash to imagehash ({} images per size):".format(n_images))
+
+    for size in SIZES:
+        dists = list(index.hamming_dist(reference_hash(img), index.combined_hash(img)) for img in random_images(size, n_images))
+
+        if max(dists) > 0:
+            n_failed += 1
+        print("    {:>11s}: {} / {} identical, max distance {}".format(
+            '{}x{}'.format(*size), dists.count(0), len(dists), max(dists)
+        ))
+
+    if n_failed > 0:
+        print("{} of {} sizes differ from imagehash".format(n_failed, len(SIZES)))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -2,49 +2,53 @@ import asyncio
 import sys
 import time
 
-from PIL import Image
 import aiohttp
-import aioredis
 import numpy as np
 
-from waifustream import danbooru, index
+from waifustream import backend, danbooru, index
 from waifustream.index import IndexEntry
 
 
 async def main():
-    with Image.open(sys.argv[1]) as img:
-        imhash = index.combined_hash(img)
-        h_bytes = imhash.tobytes()
+    imhashes = []
+    for path in sys.argv[1:]:
+        imhashes.append(index.hash_image_file(path))
         
-    print("Lookup: "+h_bytes.hex())
-    
-    redis = await aioredis.create_redis('redis://localhost')
+    redis = await backend.connect()
     
     t1 = time.perf_counter()
-    res = await index.search_index(redis, imhash)
+    results = await index.search_many(redis, imhashes)
     t2 = time.perf_counter()
     
-    dh1 = imhash[:8]
-    ah1 = imhash[8:]
-    
-    print("Lookup completed in {:.4f} seconds".format(t2-t1))
-    if len(res) == 0:
-        print("Could not identify any candidate images.")
-        return
-        
-    res_imhash, dist = res[0]    
-    entry = await IndexEntry.load_from_index(redis, res_imhash)
+    print("Lookup of {} images completed in {:.4f} seconds".format(len(imhashes), t2-t1))
     
-    dh2 = entry.imhash_array[:8]
-    ah2 = entry.imhash_array[8:]
+    entries = await IndexEntry.load_many(redis, (res[0][0] for res in results if len(res) > 0))
+    entries = iter(entries)
     
-    dist1 = index.hamming_dist(dh1, dh2)
-    dist2 = index.hamming_dist(ah1, ah2)
-    
-    print("Closest match: {} - Distance {} ({}+{})".format(res_imhash.hex(), dist, dist1, dist2))
-    print("Source: {}#{}".format(entry.src, entry.src_id))
-    print("Rating: "+str(entry.rating))
-    print("Characters: "+' '.join(entry.characters))
+    for path, imhash, res in zip(sys.argv[1:], imhashes, results):
+        print("")
+        print("{}: {}".format(path, imhash.tobytes().hex()))
+        
+        if len(res) == 0:
+            print("Could not identify any candidate images.")
+            continue
+        
+        dh1 = imhash[:8]
+        ah1 = imhash[8:]
+        
+        res_imhash, dist = res[0]    
+        entry = next(entries)
+        
+        dh2 = entry.imhash_array[:8]
+        ah2 = entry.imhash_array[8:]
+        
+        dist1 = index.hamming_dist(dh1, dh2)
+        dist2 = index.hamming_dist(ah1, ah2)
+        
+        print("Closest match: {} - Distance {} ({}+{})".format(res_imhash.hex(), dist, dist1, dist2))
+        print("Source: {}#{}".format(entry.src, entry.src_id))
+        print("Rating: "+str(entry.rating))
+        print("Characters: "+' '.join(entry.characters))
     
 
 if __name__ == '__main__':
@@ -2,23 +2,20 @@ import asyncio
 import sys
 import time
 
-from PIL import Image
 import aiohttp
-import aioredis
 import numpy as np
 
-from waifustream import danbooru, index
+from waifustream import backend, danbooru, index
 from waifustream.index import IndexEntry
 
 
 async def main():
-    with Image.open(sys.argv[1]) as img:
-        imhash = index.combined_hash(img)
-        h_bytes = imhash.tobytes()
+    imhash = index.hash_image_file(sys.argv[1])
+    h_bytes = imhash.tobytes()
         
     print("Lookup: "+h_bytes.hex())
     
-    redis = await aioredis.create_redis('redis://localhost')
+    redis = await backend.connect()
     
     t1 = time.perf_counter()
     res = await index.search_index(redis, imhash)
@@ -29,9 +26,9 @@ async def main():
     
     print("Lookup completed in {:.4f} seconds".format(t2-t1))
     print("Results: ")
-    for h, dist in res:
-        entry = await IndexEntry.load_from_index(redis, h)
-        
+    entries = await IndexEntry.load_many(redis, (h for h, _ in res))
+    
+    for (h, dist), entry in zip(res, entries):
         arr = np.frombuffer(h, dtype=np.uint8)
         dh2 = arr[:8]
         ah2 = arr[8:]
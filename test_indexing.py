@@ -4,8 +4,7 @@ import time
 
 import traceback
 import aiohttp
-import aioredis
-from waifustream import danbooru, index
+from waifustream import backend, danbooru, index
 from waifustream.index import IndexEntry
 
 task_sem = asyncio.Semaphore(value=10)
@@ -54,7 +53,7 @@ async def main():
     
     t_start = time.perf_counter()
     
-    redis = await aioredis.create_redis('redis://localhost')
+    redis = await backend.connect()
     async with aiohttp.ClientSession() as sess:
         async for post in danbooru.search(sess, [character], index.exclude_tags):
             futs.append(asyncio.ensure_future(index_one(redis, sess, post)))
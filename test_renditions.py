@@ -0,0 +1,96 @@
+import asyncio
+import io
+import os
+import sys
+
+import aiohttp
+import numpy as np
+
+from waifustream import danbooru, index
+
+# Seconds to wait between downloads, to go easy on Danbooru.
+DOWNLOAD_DELAY = 1.0
+
+
+def compare_renditions(samples):
+    """Print statistics comparing hashes of each rendition to hashes of the original.
+
+    Args:
+        samples (list): A dict for each post, mapping rendition names to image file data.
+    """
+
+    schemes = list(index.hash_schemes.values())
+    names = list(name for name, _ in danbooru.renditions)
+
+    ratios = dict((name, []) for name in names)
+    dists = dict((name, dict((s.name, []) for s in schemes)) for name in names)
+
+    for sample in samples:
+        hashes = dict(
+            (name, index.hash_image_file_multi(io.BytesIO(data), list(s.name for s in schemes)))
+            for name, data in sample.items()
+        )
+
+        for name, data in sample.items():
+            ratios[name].append(len(data) / len(sample['original']))
+            for s in schemes:
+                dists[name][s.name].append(index.hamming_dist(hashes[name][s.name], hashes['original'][s.name]))
+
+    print("Compared renditions of {} posts:".format(len(samples)))
+
+    for name in reversed(names):
+        if len(ratios[name]) == 0:
+            continue
+
+        print("    {}: {:.1%} of original file size on average".format(name, np.mean(ratios[name])))
+        for s in schemes:
+            d = np.array(dists[name][s.name])
+            print("        {:>10s}: distance mean {:.2f} / max {} ({:.1%} exact, {:.1%} within {} bits)".format(
+                s.name, d.mean(), d.max(), np.mean(d == 0), np.mean(d <= s.n_bits // 16), s.n_bits // 16
+            ))
+
+async def fetch(sess, url):
+    await asyncio.sleep(DOWNLOAD_DELAY)
+
+    async with sess.get(url) as resp:
+        resp.raise_for_status()
+        return await resp.read()
+
+async def main():
+    if len(sys.argv) < 2:
+        print("Usage: {} [tag] [number of posts (optional)]".format(sys.argv[0]))
+        return
+
+    n_posts = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+
+    headers = {}
+    if 'WAIFUSTREAM_UA' in os.environ:
+        headers['User-Agent'] = os.environ['WAIFUSTREAM_UA']
+
+    samples = []
+    async with aiohttp.ClientSession(headers=headers) as sess:
+        async for post in danbooru.search(sess, [sys.argv[1]], index.exclude_tags):
+            if 'original' not in post.rendition_urls:
+                continue
+
+            original_url = post.rendition_urls['original']
+            try:
+                sample = {'original': await fetch(sess, original_url)}
+
+                # Small originals are served as-is for every rendition.
+                for name, url in post.rendition_urls.items():
+                    if name not in sample:
+                        sample[name] = sample['original'] if url == original_url else await fetch(sess, url)
+            except aiohttp.ClientError as e:
+                print("Could not fetch post {}: {}".format(post.id, e))
+                continue
+
+            samples.append(sample)
+            if len(samples) >= n_posts:
+                break
+
+    compare_renditions(samples)
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main())
@@ -0,0 +1,265 @@
+import abc
+import os
+
+import aioredis
+
+"""The backend URL used by `connect` when no URL is given.
+"""
+default_url = os.environ.get('WAIFUSTREAM_URL', 'redis://localhost')
+
+
+class IndexBackend(abc.ABC):
+    """The storage interface used by the index, indexer, and bot.
+    
+    This is the subset of the `aioredis.Redis` command interface used
+    throughout WaifuStream; every method has the same arguments, return
+    values, and semantics as the Redis command (and `aioredis` method) of
+    the same name. Methods that accept an `encoding` argument return `bytes`
+    unless it is given.
+    
+    `aioredis.Redis` is registered as an implementation of this interface;
+    `waifustream.sqlite_backend.SQLiteBackend` provides an embedded
+    implementation for single-node deployments.
+    
+    Lua scripts (`script_load`, `evalsha`) are only required to support
+    the scripts used by WaifuStream itself.
+    """
+    
+    # Keys
+    
+    @abc.abstractmethod
+    async def exists(self, key, *keys):
+        pass
+    
+    @abc.abstractmethod
+    async def delete(self, key, *keys):
+        pass
+    
+    @abc.abstractmethod
+    async def unlink(self, key, *keys):
+        pass
+    
+    @abc.abstractmethod
+    def iscan(self, *, match=None, count=None):
+        pass
+    
+    @abc.abstractmethod
+    async def flushdb(self):
+        pass
+    
+    # Strings
+    
+    @abc.abstractmethod
+    async def get(self, key, *, encoding=None):
+        pass
+    
+    @abc.abstractmethod
+    async def set(self, key, value):
+        pass
+    
+    @abc.abstractmethod
+    async def incr(self, key):
+        pass
+    
+    @abc.abstractmethod
+    async def incrby(self, key, increment):
+        pass
+    
+    # Hashes
+    
+    @abc.abstractmethod
+    async def hget(self, key, field, *, encoding=None):
+        pass
+    
+    @abc.abstractmethod
+    async def hmget(self, key, field, *fields, encoding=None):
+        pass
+    
+    @abc.abstractmethod
+    async def hgetall(self, key, *, encoding=None):
+        pass
+    
+    @abc.abstractmethod
+    async def hset(self, key, field, value):
+        pass
+    
+    @abc.abstractmethod
+    async def hmset_dict(self, key, *args, **kwargs):
+        pass
+    
+    @abc.abstractmethod
+    async def hdel(self, key, field, *fields):
+        pass
+    
+    @abc.abstractmethod
+    async def hincrby(self, key, field, increment=1):
+        pass
+    
+    # Sets
+    
+    @abc.abstractmethod
+    async def sadd(self, key, member, *members):
+        pass
+    
+    @abc.abstractmethod
+    async def srem(self, key, member, *members):
+        pass
+    
+    @abc.abstractmethod
+    async def sismember(self, key, member):
+        pass
+    
+    @abc.abstractmethod
+    async def smembers(self, key, *, encoding=None):
+        pass
+    
+    @abc.abstractmethod
+    async def scard(self, key):
+        pass
+    
+    @abc.abstractmethod
+    async def srandmember(self, key, count=None, *, encoding=None):
+        pass
+    
+    @abc.abstractmethod
+    async def sunion(self, key, *keys, encoding=None):
+        pass
+    
+    @abc.abstractmethod
+    async def sunionstore(self, destkey, key, *keys):
+        pass
+    
+    # Lists
+    
+    @abc.abstractmethod
+    async def lpush(self, key, value, *values):
+        pass
+    
+    @abc.abstractmethod
+    async def rpush(self, key, value, *values):
+        pass
+    
+    @abc.abstractmethod
+    async def lpop(self, key, *, encoding=None):
+        pass
+    
+    @abc.abstractmethod
+    async def rpop(self, key, *, encoding=None):
+        pass
+    
+    @abc.abstractmethod
+    async def brpop(self, key, *keys, timeout=0, encoding=None):
+        pass
+    
+    @abc.abstractmethod
+    async def lindex(self, key, index, *, encoding=None):
+        pass
+    
+    @abc.abstractmethod
+    async def lrange(self, key, start, stop, *, encoding=None):
+        pass
+    
+    @abc.abstractmethod
+    async def llen(self, key):
+        pass
+    
+    @abc.abstractmethod
+    async def lrem(self, key, count, value):
+        pass
+    
+    @abc.abstractmethod
+    async def ltrim(self, key, start, stop):
+        pass
+    
+    # Sorted sets
+    
+    @abc.abstractmethod
+    async def zadd(self, key, score, member, *pairs):
+        pass
+    
+    @abc.abstractmethod
+    async def zrem(self, key, member, *members):
+        pass
+    
+    @abc.abstractmethod
+    async def zscore(self, key, member):
+        pass
+    
+    @abc.abstractmethod
+    async def zcard(self, key):
+        pass
+    
+    @abc.abstractmethod
+    async def zrangebyscore(self, key, min=float('-inf'), max=float('inf'), withscores=False, *, encoding=None):
+        pass
+    
+    # Streams
+    
+    @abc.abstractmethod
+    async def xadd(self, stream, fields, message_id=b'*', max_len=None, exact_len=False):
+        pass
+    
+    @abc.abstractmethod
+    async def xrange(self, stream, start='-', stop='+', count=None):
+        pass
+    
+    @abc.abstractmethod
+    async def xrevrange(self, stream, start='+', stop='-', count=None):
+        pass
+    
+    # Scripting
+    
+    @abc.abstractmethod
+    async def script_load(self, script):
+        pass
+    
+    @abc.abstractmethod
+    async def evalsha(self, digest, keys=[], args=[]):
+        pass
+    
+    # Batching and connection management
+    
+    @abc.abstractmethod
+    def pipeline(self):
+        pass
+    
+    @abc.abstractmethod
+    def multi_exec(self):
+        pass
+    
+    @abc.abstractmethod
+    def close(self):
+        pass
+    
+    @abc.abstractmethod
+    async def wait_closed(self):
+        pass
+
+IndexBackend.register(aioredis.Redis)
+
+async def connect(url=None):
+    """Connect to an index backend.
+    
+    Args:
+        url (str): Either a Redis URL (`redis://host:port/db`), or an
+            SQLite URL for the embedded backend: `sqlite:///relative/path.db`,
+            `sqlite:////absolute/path.db`, or `sqlite://` for an in-memory
+            database. Defaults to `default_url`.
+    
+    Returns:
+        An IndexBackend.
+    """
+    
+    if url is None:
+        url = default_url
+    
+    if url.startswith('sqlite:'):
+        from .sqlite_backend import SQLiteBackend
+        
+        path = url[len('sqlite://'):]
+        if path.startswith('/'):
+            path = path[1:]
+        
+        return SQLiteBackend(path if len(path) > 0 else ':memory:')
+    
+    return await aioredis.create_redis(url)
@@ -0,0 +1,215 @@
+import asyncio
+import time
+
+import aiohttp
+import attr
+
+from . import index
+from .index import IndexEntry
+
+"""Backfill progress for each hash scheme is stored within the Redis hash
+`backfill:<scheme>`, and the IDs of entries that could not be fetched or
+hashed are added to the set `backfill:<scheme>:failed`.
+"""
+backfill_key_prefix = 'backfill:'
+
+
+def backfill_key(scheme):
+    return backfill_key_prefix + scheme
+
+def backfill_failed_key(scheme):
+    return backfill_key_prefix + scheme + ':failed'
+
+
+@attr.s
+class BackfillStats(object):
+    """Progress counters for a backfill job.
+    
+    Attributes:
+        next_id (int): The lowest entry ID that hasn't been processed yet.
+        last_id (int): The highest entry ID that existed at the time of the
+            last checkpoint.
+        n_hashed (int): The number of entries hashed and added to the scheme.
+        n_skipped (int): The number of entries that were already hashed
+            under the scheme, or that no longer exist.
+        n_failed (int): The number of entries that could not be fetched or
+            hashed. Saved progress counts the entries still awaiting a retry.
+        n_bytes (int): The number of image bytes fetched.
+        elapsed (float): The number of seconds spent in this run so far.
+    """
+    
+    next_id: int = attr.ib(default=1)
+    last_id: int = attr.ib(default=0)
+    n_hashed: int = attr.ib(default=0)
+    n_skipped: int = attr.ib(default=0)
+    n_failed: int = attr.ib(default=0)
+    n_bytes: int = attr.ib(default=0)
+    elapsed: float = attr.ib(default=0.0)
+    
+    @property
+    def done(self):
+        return self.next_id > self.last_id
+
+async def get_backfill_stats(redis, scheme):
+    """Get the saved progress of the backfill job for a hash scheme.
+    
+    Counters cover every run of the job, except for `n_bytes` and
+    `elapsed`, which are not saved.
+    
+    Args:
+        redis (aioredis.Redis): A Redis interface.
+        scheme (str): The name of the hash scheme.
+    
+    Returns:
+        A BackfillStats object.
+    """
+    
+    saved, last_id, n_failed = await asyncio.gather(
+        redis.hgetall(backfill_key(scheme)),
+        redis.get(index.entry_id_counter_key),
+        redis.scard(backfill_failed_key(scheme))
+    )
+    
+    return BackfillStats(
+        next_id=int(saved.get(b'next_id', 1)),
+        last_id=int(last_id or 0),
+        n_hashed=int(saved.get(b'n_hashed', 0)),
+        n_skipped=int(saved.get(b'n_skipped', 0)),
+        n_failed=n_failed
+    )
+
+async def reset_backfill(redis, scheme):
+    """Discard all saved progress for a hash scheme's backfill job.
+    
+    Hashes that have already been added to the scheme are kept.
+    """
+    
+    await redis.delete(backfill_key(scheme), backfill_failed_key(scheme))
+
+async def _load_batch(redis, entry_ids):
+    pipe = redis.pipeline()
+    for entry_id in entry_ids:
+        pipe.hget(index.entry_hashes_key(entry_id), entry_id % index.entry_id_bucket_size)
+    hashes = await pipe.execute()
+    
+    found = list((i, h) for i, h in zip(entry_ids, hashes) if h is not None)
+    entries = await IndexEntry.load_many(redis, (h for _, h in found))
+    
+    return list((i, entry) for (i, _), entry in zip(found, entries) if entry is not None)
+
+async def _hash_entry(entry, scheme, hasher, fetch, sem, stats):
+    async with sem:
+        data = await fetch(entry)
+    
+    stats.n_bytes += len(data)
+    return (await hasher.hash_bytes_multi(data, [scheme]))[scheme]
+
+async def backfill_scheme(redis, scheme, hasher, http_sess=None, fetch=None, batch_size=200, concurrency=8, limiter=None, retry_failed=False, progress=None):
+    """Hash every existing entry under a secondary hash scheme.
+    
+    Entries are processed in order of their entry IDs, `batch_size` at a
+    time. The source image for each entry is fetched again, hashed within
+    `hasher`'s worker pool and added to the scheme's buckets. Progress is
+    saved to Redis after every batch, so that an interrupted job resumes
+    where it left off when it's next started; the index remains fully usable
+    throughout.
+    
+    Entries must have entry IDs (see `index.migrate_entry_ids`); entries
+    that are added while the job is running are picked up as well.
+    
+    Args:
+        redis (aioredis.Redis): A Redis interface.
+        scheme (str): The name of the hash scheme to backfill.
+        hasher (HashingService): The worker pool used for hashing images.
+        http_sess (aiohttp.ClientSession): The session used to download images.
+        fetch (coroutine function): If given, called with an IndexEntry to
+            get its image file data as `bytes`, instead of downloading it
+            with `http_sess`.
+        batch_size (int): The number of entries to process between checkpoints.
+        concurrency (int): The maximum number of images to fetch at once.
+        limiter (utils.HostRateLimiter): If given, used to rate-limit downloads.
+        retry_failed (bool): If True, only retry the entries that failed
+            during previous runs.
+        progress (callable): If provided, called with a BackfillStats object
+            after every batch.
+    
+    Raises:
+        KeyError: If the scheme is unknown.
+        ValueError: If `scheme` is the primary scheme.
+    
+    Returns:
+        A BackfillStats object for this run.
+    """
+    
+    if index.get_hash_scheme(scheme).is_primary:
+        raise ValueError("The primary hash scheme can't be backfilled")
+    
+    if fetch is None:
+        async def fetch(entry):
+            bio = await entry.fetch_bytesio(http_sess, limiter)
+            return bio.getvalue()
+    
+    saved = await get_backfill_stats(redis, scheme)
+    stats = BackfillStats(next_id=saved.next_id, last_id=saved.last_id)
+    sem = asyncio.Semaphore(concurrency)
+    t1 = time.perf_counter()
+    
+    if retry_failed:
+        pending = sorted(int(i) for i in await redis.smembers(backfill_failed_key(scheme)))
+    
+    while True:
+        if retry_failed:
+            entry_ids, pending = pending[:batch_size], pending[batch_size:]
+            if len(entry_ids) == 0:
+                break
+        else:
+            stats.last_id = int(await redis.get(index.entry_id_counter_key) or 0)
+            if stats.done:
+                break
+            
+            entry_ids = list(range(stats.next_id, min(stats.next_id + batch_size, stats.last_id + 1)))
+        
+        batch = await _load_batch(redis, entry_ids)
+        todo = list((i, entry) for i, entry in batch if scheme not in entry.extra_hashes)
+        n_skipped = len(entry_ids) - len(todo)
+        
+        results = await asyncio.gather(
+            *(_hash_entry(entry, scheme, hasher, fetch, sem, stats) for _, entry in todo),
+            return_exceptions=True
+        )
+        
+        hashes = []
+        failed = []
+        for (entry_id, entry), res in zip(todo, results):
+            if isinstance(res, (OSError, aiohttp.ClientError, asyncio.TimeoutError)):
+                failed.append(entry_id)
+            elif isinstance(res, BaseException):
+                raise res
+            else:
+                hashes.append((entry.imhash, res))
+        
+        n_hashed = await index.add_scheme_hashes(redis, scheme, hashes)
+        n_skipped += len(hashes) - n_hashed
+        
+        stats.n_hashed += n_hashed
+        stats.n_skipped += n_skipped
+        stats.n_failed += len(failed)
+        
+        tr = redis.multi_exec()
+        if retry_failed:
+            tr.srem(backfill_failed_key(scheme), *entry_ids)
+        else:
+            stats.next_id = entry_ids[-1] + 1
+            tr.hset(backfill_key(scheme), 'next_id', stats.next_id)
+        if len(failed) > 0:
+            tr.sadd(backfill_failed_key(scheme), *failed)
+        tr.hincrby(backfill_key(scheme), 'n_hashed', n_hashed)
+        tr.hincrby(backfill_key(scheme), 'n_skipped', n_skipped)
+        await tr.execute()
+        
+        stats.elapsed = time.perf_counter() - t1
+        if progress is not None:
+            progress(stats)
+    
+    stats.elapsed = time.perf_counter() - t1
+    return stats
@@ -10,7 +10,6 @@ import traceback
 
 import aiohttp
 import discord
-from PIL import Image
 import ujson as json
 
 from . import utils, index, danbooru
@@ -92,6 +91,12 @@ async def cmd_indexer_status(client, msg, args):
         
         out = "`{}`: **{}** items queued, **{}** items indexed".format(character, q_len, n_indexed)
         
+        cursor = await index.get_crawl_cursor(client.redis, character)
+        if cursor.newest_id is None:
+            out += " (not crawled yet)"
+        elif not cursor.backfill_done:
+            out += " (backfilling older posts from #{})".format(cursor.oldest_id)
+        
         return await client.reply(msg, out)
 
 async def cmd_random(client, msg, args):
@@ -103,13 +108,15 @@ async def cmd_random(client, msg, args):
         if selected is None:
             return await client.reply(msg, "Could not find any images for `{}`".format(args[0]))
         
-        rating = await client.redis.get(b'hash:'+selected+b':rating')
-        if rating != b'e':
+        selected = (await index.resolve_entry_ids(client.redis, [selected]))[0]
+        if selected is None:
+            continue
+        
+        entry = await IndexEntry.load_from_index(client.redis, selected)
+        if entry.rating != 'e':
             break
     else:
         return await client.reply(msg, "Could not find a random non-explicit image for `{}`".format(args[0]))
-
-    entry = await IndexEntry.load_from_index(client.redis, selected)
     
     async with aiohttp.ClientSession() as sess:
         original = await entry.fetch(sess)
@@ -130,6 +137,45 @@ async def cmd_random(client, msg, args):
             ), file=f)
     
 
+async def _identify_hash(client, queries):
+    schemes = list(index.get_hash_scheme(name) for name, _ in queries)
+    
+    # Matches must be within a quarter of the hash length under every scheme.
+    thresholds = list(s.n_bits // 4 for s in schemes)
+    
+    if len(queries) > 1:
+        res = await index.search_combined(client.redis, queries, thresholds, k=1)
+    elif client.local_index is not None and schemes[0].is_primary:
+        await client.local_index.sync(client.redis)
+        res = list((h, [d]) for h, d in client.local_index.search(queries[0][1], min_threshold=thresholds[0], k=1))
+    else:
+        res = await index.search_index(client.redis, queries[0][1], thresholds[0], k=1, scheme=schemes[0].name)
+        res = list((h, [d]) for h, d in res)
+    
+    if len(res) == 0:
+        return ["    No images were found within the required similarity threshold."]
+    
+    res_imhash, dists = res[0]
+    entry = await IndexEntry.load_from_index(client.redis, res_imhash)
+    
+    similarity = sum(s.similarity(d) for s, d in zip(schemes, dists)) / len(schemes)
+    if len(schemes) > 1:
+        dist_desc = ', '.join('{} {}'.format(s.name, d) for s, d in zip(schemes, dists))
+    else:
+        dist_desc = str(dists[0])
+    
+    async with aiohttp.ClientSession(headers={'User-Agent': client.get_config('bot_ua')}) as sess:
+        db_post = await danbooru.DanbooruPost.get_post(sess, entry.src_id)
+    
+    return [
+        "    **Similarity:**: {:.1%} (distance {})".format(similarity, dist_desc),
+        "    **Source:** {}#{}".format(entry.src.title(), entry.src_id),
+        "    **Rating:**: {}".format(index.friendly_ratings.get(entry.rating, 'Unknown')),
+        "    **Franchises:**: {}".format(', '.join('`{}`'.format(c) for c in db_post.copyrights)),
+        "    **Characters:**: {}".format(', '.join('`{}`'.format(c) for c in entry.characters)),
+        "    **Artists:**: {}".format(', '.join('`{}`'.format(c) for c in db_post.artists)),
+    ]
+
 async def cmd_identify(client, msg, args):
     identify_idx = 0
     
@@ -164,36 +210,55 @@ async def cmd_identify(client, msg, args):
         bio = io.BytesIO()
         await identify_attachment.save(bio)
         
-        with Image.open(bio) as img:
-            imhash = index.combined_hash(img)    
-            bio.close()
-            
-            res = await index.search_index(client.redis, imhash, min_threshold=32)
-            t2 = time.perf_counter()
-            
-            if len(res) > 0:
-                res_imhash, dist = res[0]
-                entry = await IndexEntry.load_from_index(client.redis, res_imhash)
-                
-                async with aiohttp.ClientSession(headers={'User-Agent': client.get_config('bot_ua')}) as sess:
-                    db_post = await danbooru.DanbooruPost.get_post(sess, entry.src_id)
-                
-                lines = [
-                    "Lookup completed in {:.3f} seconds:".format(t2-t1),
-                    "    **Similarity:**: {:.1%} (distance {})".format((128 - dist) / 128, dist),
-                    "    **Source:** {}#{}".format(entry.src.title(), entry.src_id),
-                    "    **Rating:**: {}".format(index.friendly_ratings.get(entry.rating, 'Unknown')),
-                    "    **Franchises:**: {}".format(', '.join('`{}`'.format(c) for c in db_post.copyrights)),
-                    "    **Characters:**: {}".format(', '.join('`{}`'.format(c) for c in entry.characters)),
-                    "    **Artists:**: {}".format(', '.join('`{}`'.format(c) for c in db_post.artists)),
-                ]
-            else:
-                lines = [
-                    "Lookup completed in {:.3f} seconds:".format(t2-t1),
-                    "    No images were found within the required similarity threshold."
-                ]
-            
-            return await client.reply(msg, '\n'.join(lines))
+        schemes = client.identify_schemes
+        if schemes == [index.primary_hash_scheme]:
+            queries = [(schemes[0], await client.hasher.hash_bytes(bio.getvalue()))]
+        else:
+            hashes = await client.hasher.hash_bytes_multi(bio.getvalue(), schemes)
+            queries = list((name, hashes[name]) for name in schemes)
+        bio.close()
+        
+        # The query cache is invalidated using primary scheme hashes, so it
+        # can only be used for primary scheme queries.
+        use_cache = (schemes == [index.primary_hash_scheme])
+        lines = None
+        
+        if use_cache:
+            await client.query_cache.sync(client.redis)
+            lines = client.query_cache.get(queries[0][1])
+        cached = (lines is not None)
+        
+        if not cached:
+            lines = await _identify_hash(client, queries)
+            if use_cache:
+                client.query_cache.put(queries[0][1], lines, size=sum(len(l) for l in lines))
+        
+        t2 = time.perf_counter()
+        
+        header = "Lookup completed in {:.3f} seconds{}:".format(t2-t1, " (cached)" if cached else "")
+        return await client.reply(msg, '\n'.join([header] + lines))
     except OSError:
         return await client.reply(msg, "I couldn't open that image file.")
     
+
+async def cmd_cache_stats(client, msg, args):
+    cache = client.query_cache
+    
+    lines = ["**{}** cached lookups ({:.1f} KiB) | **{}** hits, **{}** misses ({:.1%} hit rate) | **{}** evictions, **{}** invalidations".format(
+        len(cache), cache.n_bytes / 1024,
+        cache.hits, cache.misses, cache.hit_rate,
+        cache.evictions, cache.invalidations
+    )]
+    
+    image_cache = index.image_cache
+    if image_cache is not None:
+        # The cache's size is computed by scanning its directory when first used.
+        n_bytes = await asyncio.get_event_loop().run_in_executor(None, lambda: image_cache.n_bytes)
+        
+        lines.append("Image cache: **{:.1f}** MiB | **{}** hits, **{}** misses ({:.1%} hit rate) | **{}** evictions".format(
+            n_bytes / (1 << 20),
+            image_cache.hits, image_cache.misses, image_cache.hit_rate,
+            image_cache.evictions
+        ))
+    
+    return await client.reply(msg, '\n'.join(lines))
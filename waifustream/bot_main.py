@@ -7,18 +7,24 @@ import traceback
 from pathlib import Path
 import subprocess as sp
 
-import aioredis
 import discord
 import ujson as json
 
+from . import backend
 from . import utils
 from . import index
 from . import bot_commands
+from .hashing import HashingService
+from .image_cache import ImageCache
+from .local_index import LocalIndex
+from .query_cache import QueryCache
 
 class WaifuStreamClient(discord.Client):
     perms_integer = 379968
     cmd_regex = r"\"([^\"]+)\"|\'([^\']+)\'|\`\`\`([^\`]+)\`\`\`|\`([^\`]+)\`|(\S+)"
     ready = False
+    local_index = None
+    hasher = None
 
     def load_config(self, conf_path=None):
         if conf_path is None:
@@ -82,6 +88,8 @@ class WaifuStreamClient(discord.Client):
             return await bot_commands.cmd_add_indexed_tag(self, msg, args)
         elif cmd == 'random':
             return await bot_commands.cmd_random(self, msg, args)
+        elif cmd == 'cache':
+            return await bot_commands.cmd_cache_stats(self, msg, args)
         else:
             return await self.reply(msg, "I couldn't recognize that command.")
     
@@ -101,7 +109,39 @@ class WaifuStreamClient(discord.Client):
         v = await utils.get_version()
         await self.log_notify("WaifuStream Version {} starting up!".format(v))
 
-        self.redis = await aioredis.create_redis('redis://localhost')
+        self.redis = await backend.connect(self.config.get('redis_url', 'redis://localhost'))
+        index.hash_chunk_bits = self.config.get('hash_chunk_bits', 8)
+        index.server_side_search = self.config.get('server_side_search', False)
+        index.hash_draft_scale = self.config.get('hash_draft_scale', 8)
+        index.max_hash_pixels = self.config.get('max_hash_pixels', index.max_hash_pixels)
+        self.identify_schemes = self.config.get('identify_schemes', [index.primary_hash_scheme])
+        
+        image_cache_path = self.config.get('image_cache_path')
+        if image_cache_path is not None:
+            index.image_cache = ImageCache(
+                image_cache_path,
+                max_bytes=self.config.get('image_cache_bytes'),
+                thumbnail_size=self.config.get('image_cache_thumbnail_size')
+            )
+        
+        if self.hasher is None:
+            self.hasher = HashingService(
+                n_workers=self.config.get('hash_workers'),
+                max_pending=self.config.get('hash_max_pending')
+            )
+        
+        local_index_path = self.config.get('local_index_path')
+        if local_index_path is not None:
+            self.local_index = LocalIndex(local_index_path)
+            await self.local_index.sync(self.redis)
+        
+        self.query_cache = QueryCache(
+            max_entries=self.config.get('query_cache_entries', 1024),
+            max_bytes=self.config.get('query_cache_bytes'),
+            ttl=self.config.get('query_cache_ttl', 3600),
+            threshold=32
+        )
+        await self.query_cache.sync(self.redis)
 
         if self.get_config('maintenance_mode'):
             await self.change_presence(activity=discord.Game("Maintenance Mode"))
@@ -7,8 +7,42 @@ import attr
 from PIL import Image
 import numpy as np
 
+from . import utils
+
 base_url = 'https://danbooru.donmai.us'
 
+"""The image renditions available for each post, from smallest to largest,
+along with the API fields containing their URLs.
+"""
+renditions = [
+    ('preview', 'preview_file_url'),
+    ('large', 'large_file_url'),
+    ('original', 'file_url')
+]
+
+"""The rendition used as the URL for each post (and so the image that is
+downloaded and hashed when indexing it). If a post doesn't have this
+rendition, the next larger one is used instead, falling back to smaller
+renditions if necessary.
+
+The `large` rendition is a JPEG sample no more than 850 pixels wide, which is
+usually a small fraction of the size of the original. Hashes computed from
+smaller renditions can differ slightly from those of the original images;
+`test_renditions.py` measures this over a sample of posts.
+"""
+fetch_rendition = 'original'
+
+def rendition_preference(rendition):
+    """Get the order in which renditions are tried for a given preferred rendition.
+    
+    Returns:
+        A list of rendition names.
+    """
+    
+    names = list(name for name, _ in renditions)
+    idx = names.index(rendition)
+    return names[idx:] + list(reversed(names[:idx]))
+
 @attr.s(frozen=True, cmp=False)
 class DanbooruPost(object):
     id: int = attr.ib(converter=int)
@@ -18,6 +52,7 @@ class DanbooruPost(object):
     characters: tuple = attr.ib(converter=tuple)
     copyrights: tuple = attr.ib(converter=tuple)
     artists: tuple = attr.ib(converter=tuple)
+    rendition_urls: dict = attr.ib(factory=dict)
     
     def __len__(self):
         return len(self.tags)
@@ -67,17 +102,28 @@ class DanbooruPost(object):
         return img
             
     @classmethod
-    def from_api_json(cls, data):
+    def from_api_json(cls, data, rendition=None):
+        """Create a DanbooruPost from a post returned by the Danbooru API.
+        
+        Args:
+            data (dict): The post data.
+            rendition (str): The preferred rendition to use for the post URL.
+                Defaults to `fetch_rendition`.
+        
+        Returns:
+            A DanbooruPost.
+        """
+        
         tags = data['tag_string'].split()
         characters = data['tag_string_character'].split()
         
+        rendition_urls = dict((name, data[field]) for name, field in renditions if data.get(field) is not None)
+        
         url = None
-        if 'file_url' in data:
-            url = data['file_url']
-        elif 'large_file_url' in data:
-            url = data['large_file_url']
-        elif 'preview_file_url' in data:
-            url = data['preview_file_url']
+        for name in rendition_preference(rendition or fetch_rendition):
+            if name in rendition_urls:
+                url = rendition_urls[name]
+                break
         
         return cls(
             id=data['id'],
@@ -86,7 +132,8 @@ class DanbooruPost(object):
             url=url,
             characters=characters,
             copyrights=data['tag_string_copyright'].split(),
-            artists=data['tag_string_artist'].split()
+            artists=data['tag_string_artist'].split(),
+            rendition_urls=rendition_urls
         )
     
     @classmethod
@@ -104,8 +151,12 @@ async def api_random(session, tags):
         data = await response.json()
         return list(DanbooruPost.from_api_json(d) for d in data)
 
+"""The number of posts requested per page of search results.
+"""
+page_size = 200
+
 def construct_search_endpoint(page, tags, start_id, random):
-    endpoint = '/posts.json?page={}&limit=200'.format(page)
+    endpoint = '/posts.json?page={}&limit={}'.format(page, page_size)
     tags = list(tags)
     
     if start_id is not None:
@@ -122,65 +173,145 @@ def construct_search_endpoint(page, tags, start_id, random):
 
     return base_url+endpoint
 
-async def search_api(session, tags, start_id=None, random=False):
-    if len(tags) > 2:
-        raise ValueError("Cannot search for more than two tags at a time")
-    
-    if start_id is not None:
-        start_id = int(start_id)
-    
-    page = 0
-    n_tries = 0
-        
-    while page < 1000:
-        await asyncio.sleep(0.5)
-        
-        if n_tries > 5:
-            print("Giving up.")
-            return
+async def _get_page_data(session, url, tags, page, limiter=None, max_tries=6):
+    # Returns the list of posts on a page as JSON data, or None if every
+    # attempt to retrieve it failed.
+    for _ in range(max_tries):
+        if limiter is not None:
+            await limiter.bucket(url).acquire()
+        else:
+            await asyncio.sleep(0.5)
         
         print("[search] tags: {} - page {}".format(' '.join(tags), page))
-        async with session.get(construct_search_endpoint(page, tags, start_id, random)) as response:
+        async with session.get(url) as response:
             if response.status < 200 or response.status > 299:
                 print("    Got error response code {} when retrieving {} page {}".format(str(response.status), ' '.join(tags), page))
-                n_tries += 1
+                
+                if limiter is not None and (response.status == 429 or response.status >= 500):
+                    limiter.bucket(url).backoff(utils.parse_retry_after(response.headers.get('Retry-After')))
                 continue
             
+            if limiter is not None:
+                limiter.bucket(url).success()
+            
             data = await response.json()
             
             if not isinstance(data, list):
                 print("    Got weird response: "+str(data))
-                n_tries += 1
                 continue
-                
-            if len(data) == 0:
-                return
-                
-            page += 1
-            n_tries = 0
-            
-            ids = list(int(d['id']) for d in data)
-            last_id = min(ids)
             
-            if start_id is not None and last_id > start_id:
-                continue
-                
-            for d in data:
-                yield DanbooruPost.from_api_json(d)
-                
+            return data
+    
+    print("Giving up.")
+    return None
+
+async def search_api_pages(session, tags, start_id=None, random=False, limiter=None):
+    """Search for posts, yielding each page of results as a list of DanbooruPosts.
+    """
+    
+    if len(tags) > 2:
+        raise ValueError("Cannot search for more than two tags at a time")
+    
+    if start_id is not None:
+        start_id = int(start_id)
+    
+    page = 0
+    
+    while page < 1000:
+        url = construct_search_endpoint(page, tags, start_id, random)
+        data = await _get_page_data(session, url, tags, page, limiter)
         
-async def search(session, with_tags, without_tags, rating=None, **kwargs):
-    async for post in search_api(session, with_tags[:2], **kwargs):
-        if not all((tag in post) for tag in with_tags):
-            continue
+        if data is None or len(data) == 0:
+            return
         
-        if any((tag in post) for tag in without_tags):
-            continue
+        page += 1
         
-        if rating is not None and post.rating != rating:
+        ids = list(int(d['id']) for d in data)
+        last_id = min(ids)
+        
+        if start_id is not None and last_id > start_id:
             continue
         
-        yield post
+        yield list(DanbooruPost.from_api_json(d) for d in data)
+
+async def fetch_page(session, tags, before_id=None, after_id=None, limiter=None):
+    """Fetch one page of posts adjacent to a given post ID.
+    
+    This uses the API's sequential pagination, which (unlike numbered pages)
+    doesn't shift as new posts are added, and isn't limited to the first
+    1000 pages of results.
+    
+    Args:
+        session (aiohttp.ClientSession): The session to make requests with.
+        tags (list of str): The tags to search for (no more than two).
+        before_id (int): If given, fetch the newest posts older than this ID.
+        after_id (int): If given, fetch the oldest posts newer than this ID.
+            If neither ID is given, the newest posts are fetched.
+        limiter (utils.HostRateLimiter): If given, used to rate-limit requests.
+    
+    Raises:
+        aiohttp.ClientError: If the page could not be retrieved.
+    
+    Returns:
+        A list of up to `page_size` DanbooruPosts, newest first.
+    """
+    
+    if len(tags) > 2:
+        raise ValueError("Cannot search for more than two tags at a time")
+    
+    if before_id is not None:
+        page = 'b{}'.format(int(before_id))
+    elif after_id is not None:
+        page = 'a{}'.format(int(after_id))
+    else:
+        page = 1
+    
+    url = construct_search_endpoint(page, tags, None, False)
+    data = await _get_page_data(session, url, tags, page, limiter)
+    
+    if data is None:
+        raise aiohttp.ClientError("Could not retrieve "+url)
+    
+    posts = list(DanbooruPost.from_api_json(d) for d in data)
+    return sorted(posts, key=lambda post: post.id, reverse=True)
+
+async def search_api(session, tags, start_id=None, random=False, limiter=None):
+    async for page in search_api_pages(session, tags, start_id=start_id, random=random, limiter=limiter):
+        for post in page:
+            yield post
+
+def _matches(post, with_tags, without_tags, rating):
+    if not all((tag in post) for tag in with_tags):
+        return False
+    
+    if any((tag in post) for tag in without_tags):
+        return False
+    
+    return rating is None or post.rating == rating
+
+def filter_posts(posts, with_tags, without_tags, rating=None):
+    """Get the posts that have all of `with_tags`, none of `without_tags`,
+    and (if given) the given rating.
+    
+    Returns:
+        A list of DanbooruPosts.
+    """
+    
+    return list(post for post in posts if _matches(post, with_tags, without_tags, rating))
+
+async def search_pages(session, with_tags, without_tags, rating=None, **kwargs):
+    """Search for posts, yielding each page of matching posts as a list.
+    
+    Pages may be empty if none of their posts match.
+    """
+    
+    async for page in search_api_pages(session, with_tags[:2], **kwargs):
+        yield filter_posts(page, with_tags, without_tags, rating)
+
+async def search(session, with_tags, without_tags, rating=None, **kwargs):
+    async for page in search_pages(session, with_tags, without_tags, rating=rating, **kwargs):
+        for post in page:
+            yield post
 
 async def lookup_tag(sess, tag):
     url = base_url+'/tags.json?search[name_matches]=*'+tag+'*'
@@ -0,0 +1,112 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import io
+import os
+
+from . import index
+
+
+def _hash_bytes(data, draft_scale, max_pixels, schemes=None):
+    # Runs within worker processes, which may not share the parent's config.
+    index.hash_draft_scale = draft_scale
+    
+    if schemes is not None:
+        return index.hash_image_file_multi(io.BytesIO(data), schemes, max_pixels=max_pixels)
+    return index.hash_image_file(io.BytesIO(data), max_pixels=max_pixels)
+
+
+class HashingService(object):
+    """Computes image hashes within a pool of worker processes.
+    
+    Decoding and hashing large images can take a significant amount of CPU
+    time; running them in separate processes keeps the event loop responsive
+    and allows hashing to use several cores at once.
+    
+    Attributes:
+        n_workers (int): The number of worker processes.
+        max_pending (int): The maximum number of images that can be queued or
+            in progress at once. Further requests wait until a slot is free.
+        max_pixels (int): If not None, images that would decode to more than
+            this many pixels are rejected. Defaults to `index.max_hash_pixels`.
+    """
+    
+    def __init__(self, n_workers=None, max_pending=None, max_pixels=None):
+        self.n_workers = n_workers or os.cpu_count() or 1
+        self.max_pending = max_pending or (2 * self.n_workers)
+        self.max_pixels = max_pixels
+
+        self._executor = ProcessPoolExecutor(max_workers=self.n_workers)
+        self._sem = asyncio.Semaphore(self.max_pending)
+    
+    async def hash_bytes(self, data):
+        """Compute the combined perceptual hash of an image file.
+        
+        Args:
+            data (bytes): The contents of the image file.
+        
+        Raises:
+            OSError: If the image could not be opened, was too large, or if
+                the worker process hashing it exited unexpectedly.
+        
+        Returns:
+            A `uint8` ndarray.
+        """
+        
+        return await self._run(data, None)
+    
+    async def hash_bytes_multi(self, data, schemes):
+        """Hash an image file under several hash schemes at once.
+        
+        Args:
+            data (bytes): The contents of the image file.
+            schemes (list of str): The names of the schemes to hash with.
+        
+        Raises:
+            KeyError: If any of the schemes are unknown.
+            OSError: See `hash_bytes`.
+        
+        Returns:
+            A dict mapping scheme names to `uint8` ndarrays.
+        """
+        
+        for name in schemes:
+            index.get_hash_scheme(name)
+        
+        return await self._run(data, list(schemes))
+    
+    async def _run(self, data, schemes):
+        async with self._sem:
+            loop = asyncio.get_event_loop()
+            
+            while True:
+                executor = self._executor
+                
+                try:
+                    fut = loop.run_in_executor(
+                        executor, _hash_bytes, bytes(data),
+                        index.hash_draft_scale, self.max_pixels or index.max_hash_pixels, schemes
+                    )
+                except BrokenProcessPool:
+                    # The pool broke while hashing some earlier image.
+                    self._restart(executor)
+                    continue
+                
+                try:
+                    return await fut
+                except BrokenProcessPool:
+                    # A worker was killed (i.e. by running out of memory)
+                    # while hashing this image.
+                    self._restart(executor)
+                    raise OSError("Hashing worker process exited unexpectedly")
+    
+    def _restart(self, executor):
+        # Broken pools can't be used again, so start a new one.
+        if self._executor is executor:
+            self._executor = ProcessPoolExecutor(max_workers=self.n_workers)
+            executor.shutdown(wait=False)
+    
+    def close(self):
+        """Shut down all worker processes.
+        """
+        self._executor.shutdown(wait=True)
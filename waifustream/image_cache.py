@@ -0,0 +1,244 @@
+import hashlib
+import io
+import os
+import tempfile
+import threading
+import time
+
+from PIL import Image
+
+
+def make_thumbnail(data, size):
+    """Shrink an image file to fit within a given size.
+    
+    Args:
+        data (bytes): The contents of the image file.
+        size (tuple): The maximum (width, height) of the thumbnail.
+    
+    Raises:
+        OSError: If the image could not be opened.
+    
+    Returns:
+        The thumbnail, as JPEG file data.
+    """
+    
+    try:
+        img = Image.open(io.BytesIO(data))
+    except Image.DecompressionBombError as e:
+        raise OSError(str(e))
+    
+    with img:
+        img.draft('RGB', size)
+        thumb = img.convert('RGB')
+        thumb.thumbnail(size, Image.LANCZOS)
+    
+    bio = io.BytesIO()
+    thumb.save(bio, format='jpeg', quality=90)
+    return bio.getvalue()
+
+
+class ImageCache(object):
+    """An on-disk cache of source image files.
+    
+    Each image is stored in its own file, named by the SHA1 digest of the
+    entry's source name, ID, and URL (so that different renditions of the
+    same source image are cached separately). Files are written atomically (by renaming a
+    complete temporary file into place), so the cache can safely be shared
+    between several processes. Once the cache grows past `max_bytes`, the
+    least recently used files are deleted, using file modification times
+    (which are updated on every hit) to track usage. Methods may be called
+    from several threads at once (e.g. from an executor).
+    
+    Attributes:
+        path (str): The directory containing the cached files.
+        max_bytes (int): If not None, the maximum total size of all cached
+            files, in bytes.
+        thumbnail_size (tuple): If not None, images are shrunk to fit within
+            this (width, height) before being stored, instead of storing the
+            original files. Thumbnails are large enough for hashing and for
+            previews, but hashes computed from them may differ slightly from
+            hashes of the originals.
+        hits (int): The number of cache hits so far.
+        misses (int): The number of cache misses so far.
+        evictions (int): The number of files evicted so far.
+    """
+    
+    # Eviction removes files until the cache is this fraction of its maximum size.
+    evict_ratio = 0.9
+    
+    # Temporary files older than this (in seconds) were left by crashed writers.
+    stale_tmp_age = 3600
+    
+    def __init__(self, path, max_bytes=None, thumbnail_size=None):
+        self.path = str(path)
+        self.max_bytes = max_bytes
+        self.thumbnail_size = tuple(thumbnail_size) if thumbnail_size is not None else None
+        
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        
+        self._n_bytes = None
+        self._lock = threading.Lock()
+        os.makedirs(self.path, exist_ok=True)
+    
+    def _file_path(self, src, src_id, src_url):
+        digest = hashlib.sha1('{}:{}:{}'.format(src, src_id, src_url).encode('utf-8')).hexdigest()
+        return os.path.join(self.path, digest[:2], digest)
+    
+    def get(self, src, src_id, src_url):
+        """Read an image from the cache.
+        
+        Args:
+            src (str): The source name of the image's entry.
+            src_id (str): The source ID of the image's entry.
+            src_url (str): The URL the image was fetched from.
+        
+        Returns:
+            The image file data as `bytes`, or None if it isn't cached.
+        """
+        
+        path = self._file_path(src, src_id, src_url)
+        
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        
+        try:
+            os.utime(path)
+        except OSError:
+            # Evicted by another process in the meantime.
+            pass
+        
+        with self._lock:
+            self.hits += 1
+        return data
+    
+    def put(self, src, src_id, src_url, data):
+        """Store an image within the cache, evicting older images if necessary.
+        
+        If `thumbnail_size` is set and the data can't be opened as an image,
+        nothing is stored.
+        
+        Args:
+            src (str): The source name of the image's entry.
+            src_id (str): The source ID of the image's entry.
+            src_url (str): The URL the image was fetched from.
+            data (bytes): The image file data.
+        """
+        
+        if self.thumbnail_size is not None:
+            try:
+                data = make_thumbnail(data, self.thumbnail_size)
+            except OSError:
+                return
+        
+        path = self._file_path(src, src_id, src_url)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            
+            # Overwriting a cached file only grows the cache by the difference.
+            try:
+                old_size = os.stat(path).st_size
+            except FileNotFoundError:
+                old_size = 0
+            
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+        
+        if self.max_bytes is not None:
+            with self._lock:
+                if self._n_bytes is None:
+                    self._n_bytes = sum(size for _, size, _ in self._scan())
+                else:
+                    self._n_bytes += len(data) - old_size
+                
+                if self._n_bytes > self.max_bytes:
+                    self._evict(int(self.max_bytes * self.evict_ratio))
+    
+    def _scan(self):
+        now = time.time()
+        
+        for subdir in os.scandir(self.path):
+            if not subdir.is_dir():
+                continue
+            
+            for entry in os.scandir(subdir.path):
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                
+                if entry.name.startswith('.tmp') and now - st.st_mtime < self.stale_tmp_age:
+                    continue
+                
+                yield st.st_mtime, st.st_size, entry.path
+    
+    def evict(self, max_bytes=None):
+        """Delete the least recently used files until the cache is small enough.
+        
+        Args:
+            max_bytes (int): The size to shrink the cache to. Defaults to
+                `evict_ratio` times `max_bytes`.
+        
+        Returns:
+            int: The number of files deleted.
+        """
+        
+        if max_bytes is None:
+            max_bytes = int(self.max_bytes * self.evict_ratio)
+        
+        with self._lock:
+            return self._evict(max_bytes)
+    
+    def _evict(self, max_bytes):
+        files = sorted(self._scan())
+        total = sum(size for _, size, _ in files)
+        n = 0
+        
+        for _, size, path in files:
+            if total <= max_bytes:
+                break
+            
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            
+            total -= size
+            n += 1
+        
+        self._n_bytes = total
+        self.evictions += n
+        return n
+    
+    @property
+    def n_bytes(self):
+        """int: The total size of all cached files, in bytes.
+        """
+        with self._lock:
+            if self._n_bytes is None:
+                self._n_bytes = sum(size for _, size, _ in self._scan())
+            return self._n_bytes
+    
+    @property
+    def hit_rate(self):
+        """float: The fraction of lookups that resulted in a cache hit.
+        """
+        n = self.hits + self.misses
+        if n == 0:
+            return 0.0
+        return self.hits / n
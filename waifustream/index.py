@@ -1,14 +1,18 @@
 import asyncio
+import functools
+import hashlib
 import io
+import itertools
 import sys
 
 import aiohttp
 import aioredis
 import attr
 from PIL import Image
-import imagehash
 import numpy as np
 
+from . import utils
+
 """Posts with these tags will be excluded from indexing.
 """
 exclude_tags = [
@@ -27,8 +31,351 @@ friendly_ratings = {
     'e': 'Explicit'
 }
 
-def construct_hash_idx_key(idx, val):
-    return 'hash_idx:{:02d}:{:02x}'.format(idx, val).encode('utf-8')
+"""Every newly-inserted image hash is appended to this Redis stream, so that
+local copies of the index can be kept up to date incrementally.
+"""
+index_log_key = 'index_log'
+
+"""The approximate maximum length of the index change log.
+"""
+index_log_maxlen = 1000000
+
+"""The width, in bits, of each chunk that image hashes are split into for bucketing.
+
+Must be a multiple of 8 that evenly divides the hash length.
+"""
+hash_chunk_bits = 8
+
+"""The maximum number of bucket keys that a single search may probe.
+"""
+max_probe_keys = 100000
+
+"""If True, `search_index` will filter and rank candidates within Redis itself
+(see `search_index_server_side`) instead of transferring them to the client.
+"""
+server_side_search = False
+
+"""If set to an `image_cache.ImageCache`, source images fetched by
+`IndexEntry.fetch_bytesio` and `IndexEntry.fetch` are read from and stored
+within it.
+"""
+image_cache = None
+
+"""Each entry is assigned a dense integer ID when it's inserted, and these IDs
+are stored within hash buckets and character sets in place of full image hashes.
+The hash for each ID is stored in the `entry_hashes:<bucket>` Redis hashes,
+with `entry_id_bucket_size` IDs per bucket.
+"""
+entry_id_counter_key = 'entry_id_counter'
+entry_hashes_prefix = 'entry_hashes:'
+entry_id_bucket_size = 128
+
+def construct_hash_idx_key(idx, val, chunk_bits=8, key_prefix=''):
+    if chunk_bits == 8:
+        key = 'hash_idx:{:02d}:{:02x}'.format(idx, val)
+    else:
+        key = 'hash_idx{}:{:02d}:{:0{}x}'.format(chunk_bits, idx, val, chunk_bits // 4)
+    
+    return (key_prefix + key).encode('utf-8')
+
+def split_hash(h_bytes, chunk_bits=8):
+    """Split an image hash into fixed-width chunks.
+    
+    Args:
+        h_bytes (bytes): An image hash.
+        chunk_bits (int): The width of each chunk, in bits.
+    
+    Returns:
+        A list of chunk values, as `int`s.
+    """
+    
+    if chunk_bits % 8 != 0 or (len(h_bytes) * 8) % chunk_bits != 0:
+        raise ValueError("Invalid chunk width: {}".format(chunk_bits))
+    
+    n = chunk_bits // 8
+    return list(int.from_bytes(h_bytes[i:i+n], 'big') for i in range(0, len(h_bytes), n))
+
+def probe_radii(min_threshold, n_chunks):
+    """Compute the search radius required for each chunk to guarantee exact recall.
+    
+    By the pigeonhole principle, if two hashes split into `m` chunks are
+    within distance `r*m + a` of each other (for `0 <= a < m`), then either
+    one of the first `a+1` chunks is within distance `r`, or one of the
+    remaining chunks is within distance `r-1`.
+    
+    Args:
+        min_threshold (int): The search threshold; all hashes at a distance
+            less than this value must be found.
+        n_chunks (int): The number of chunks each hash is split into.
+    
+    Returns:
+        A list of radii, one per chunk. A radius of -1 indicates that the
+        chunk does not need to be probed at all.
+    """
+    
+    r, a = divmod(min_threshold - 1, n_chunks)
+    return list((r if i <= a else r - 1) for i in range(n_chunks))
+
+def hash_ball(val, chunk_bits, radius):
+    """Enumerate all chunk values within a given Hamming distance of a value.
+    
+    Yields:
+        Chunk values, as `int`s.
+    """
+    
+    for d in range(radius + 1):
+        for bits in itertools.combinations(range(chunk_bits), d):
+            flip = 0
+            for b in bits:
+                flip |= (1 << b)
+            yield val ^ flip
+
+def construct_probe_keys(h_bytes, min_threshold=None, chunk_bits=None, key_prefix=''):
+    """Get the bucket keys that must be searched for a given image hash.
+    
+    Args:
+        h_bytes (bytes): The image hash to search for.
+        min_threshold (int): If provided, enough buckets will be probed to find
+            every indexed hash at a distance less than this value. Otherwise,
+            only buckets that match a chunk of the hash exactly are probed.
+        chunk_bits (int): The chunk width used for bucketing. Defaults to
+            `hash_chunk_bits`.
+        key_prefix (str): The key prefix for the hash scheme being searched
+            (see `HashScheme`).
+    
+    Raises:
+        ValueError: If exact recall would require probing more than
+            `max_probe_keys` buckets.
+    
+    Returns:
+        A list of bucket keys.
+    """
+    
+    groups = construct_probe_key_groups(h_bytes, min_threshold, chunk_bits, key_prefix)
+    return list(itertools.chain.from_iterable(keys for _, keys in groups))
+
+def construct_probe_key_groups(h_bytes, min_threshold=None, chunk_bits=None, key_prefix=''):
+    """Get the bucket keys that must be searched for a given image hash, grouped by chunk.
+    
+    Takes the same arguments as `construct_probe_keys`.
+    
+    Returns:
+        A list of (radius, keys) tuples, one for each chunk of the hash.
+        Any indexed hash not contained within one of a chunk's buckets is
+        at least `radius+1` bits away from the query within that chunk.
+    """
+    
+    if chunk_bits is None:
+        chunk_bits = hash_chunk_bits
+    
+    chunks = split_hash(h_bytes, chunk_bits)
+    if min_threshold is None:
+        return list((0, [construct_hash_idx_key(idx, val, chunk_bits, key_prefix)]) for idx, val in enumerate(chunks))
+    
+    radii = probe_radii(min_threshold, len(chunks))
+    
+    n_keys = sum(sum(_n_choose_k(chunk_bits, d) for d in range(r + 1)) for r in radii)
+    if n_keys > max_probe_keys:
+        raise ValueError("Searching with threshold {} and {}-bit chunks would require probing {} buckets".format(min_threshold, chunk_bits, n_keys))
+    
+    groups = []
+    for idx, (val, r) in enumerate(zip(chunks, radii)):
+        keys = list(construct_hash_idx_key(idx, v, chunk_bits, key_prefix) for v in hash_ball(val, chunk_bits, r))
+        groups.append((r, keys))
+    
+    return groups
+
+def _n_choose_k(n, k):
+    res = 1
+    for i in range(k):
+        res = res * (n - i) // (i + 1)
+    return res
+
+def entry_key(imhash):
+    return b'entry:'+imhash
+
+def entry_hashes_key(entry_id):
+    return entry_hashes_prefix+str(int(entry_id) // entry_id_bucket_size)
+
+def _legacy_entry_key(imhash, field):
+    return b'hash:'+imhash+b':'+field
+
+def split_url(url):
+    """Split a URL into a common prefix and an entry-specific suffix.
+    
+    The prefix consists of the scheme, host and first path component of the
+    URL (i.e. `https://cdn.donmai.us/original/`), which is shared by
+    most images from the same source.
+    
+    Returns:
+        A (prefix, suffix) tuple of `str`s.
+    """
+    
+    host_start = url.find('//')
+    if host_start < 0:
+        return '', url
+    
+    path_start = url.find('/', host_start + 2)
+    if path_start < 0:
+        return url, ''
+    
+    split = url.find('/', path_start + 1)
+    if split < 0:
+        return url[:path_start+1], url[path_start+1:]
+    
+    return url[:split+1], url[split+1:]
+
+_intern_script = """
+local id = redis.call('HGET', KEYS[1], ARGV[1])
+if id then
+    return tonumber(id)
+end
+
+id = redis.call('INCR', KEYS[3])
+redis.call('HSET', KEYS[1], ARGV[1], id)
+redis.call('HSET', KEYS[2], id, ARGV[1])
+return id
+"""
+
+_add_entry_script = """
+if redis.call('EXISTS', KEYS[1], KEYS[2]) > 0 then
+    return 0
+end
+
+local id = redis.call('INCR', KEYS[4])
+local bucket_size = tonumber(ARGV[3])
+redis.call('HSET', ARGV[4] .. math.floor(id / bucket_size), id % bucket_size, ARGV[1])
+
+for i = 5, #KEYS do
+    redis.call('SADD', KEYS[i], id)
+end
+
+redis.call('HSET', KEYS[1], 'n', id, unpack(ARGV, 5))
+redis.call('XADD', KEYS[3], 'MAXLEN', '~', ARGV[2], '*', 'imhash', ARGV[1])
+
+return 1
+"""
+
+_assign_entry_id_script = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+
+local id = redis.call('HGET', KEYS[1], 'n')
+if id then
+    id = tonumber(id)
+else
+    id = redis.call('INCR', KEYS[2])
+    local bucket_size = tonumber(ARGV[2])
+    redis.call('HSET', ARGV[3] .. math.floor(id / bucket_size), id % bucket_size, ARGV[1])
+    redis.call('HSET', KEYS[1], 'n', id)
+end
+
+for i = 3, #KEYS do
+    if redis.call('SREM', KEYS[i], ARGV[1]) > 0 then
+        redis.call('SADD', KEYS[i], id)
+    end
+end
+
+return 1
+"""
+
+_add_scheme_hash_script = """
+local id = redis.call('HGET', KEYS[1], 'n')
+if not id or redis.call('HEXISTS', KEYS[1], ARGV[3]) == 1 then
+    return 0
+end
+
+id = tonumber(id)
+local bucket_size = tonumber(ARGV[4])
+redis.call('HSET', KEYS[1], ARGV[3], ARGV[2])
+redis.call('HSET', ARGV[5] .. math.floor(id / bucket_size), id % bucket_size, ARGV[2])
+
+local entries = redis.call('HGET', KEYS[2], ARGV[2]) or ''
+redis.call('HSET', KEYS[2], ARGV[2], entries .. ARGV[1])
+
+for i = 3, #KEYS do
+    redis.call('SADD', KEYS[i], id)
+end
+
+return 1
+"""
+
+# Used by scripts that need to map set members back to image hashes.
+# Members may either be entry IDs or (for entries that predate entry IDs)
+# full image hashes.
+#
+# The `entry_hashes:<n>` keys read here depend on the members of the sets
+# being searched, so they can't be declared in KEYS ahead of time; like the
+# entry insertion scripts (which write to keys built from ARGV), these
+# scripts require a non-clustered Redis server.
+_resolve_members_lua = """
+local function resolve_member(m, id_prefix, bucket_size)
+    if #m >= 16 then
+        return m
+    end
+    
+    local id = tonumber(m)
+    return redis.call('HGET', id_prefix .. math.floor(id / bucket_size), id % bucket_size)
+end
+"""
+
+_intern_ids = {}
+_intern_names = {}
+
+async def intern_string(redis, table, name):
+    """Get the integer ID for a string within an intern table, assigning one if necessary.
+    
+    Args:
+        redis (aioredis.Redis): A Redis interface.
+        table (str): The name of the intern table.
+        name (str): The string to intern.
+    
+    Returns:
+        int: The ID for the given string.
+    """
+    
+    try:
+        return _intern_ids[(table, name)]
+    except KeyError:
+        pass
+    
+    keys = ['intern:'+table, 'intern:'+table+':names', 'intern:'+table+':next']
+    str_id = int(await run_script(redis, _intern_script, keys, [name]))
+    
+    _intern_ids[(table, name)] = str_id
+    _intern_names[(table, str_id)] = name
+    
+    return str_id
+
+async def resolve_interned(redis, table, str_ids):
+    """Look up the strings for a set of IDs within an intern table.
+    
+    Args:
+        redis (aioredis.Redis): A Redis interface.
+        table (str): The name of the intern table.
+        str_ids (iterable of int): IDs to look up.
+    
+    Raises:
+        KeyError: If any of the IDs are not in the table.
+    
+    Returns:
+        A dict mapping IDs to `str`s.
+    """
+    
+    str_ids = set(int(i) for i in str_ids)
+    missing = list(i for i in str_ids if (table, i) not in _intern_names)
+    
+    if len(missing) > 0:
+        names = await redis.hmget('intern:'+table+':names', *missing, encoding='utf-8')
+        for str_id, name in zip(missing, names):
+            if name is None:
+                raise KeyError("Unknown ID {} in intern table {}".format(str_id, table))
+            
+            _intern_ids[(table, name)] = str_id
+            _intern_names[(table, str_id)] = name
+    
+    return dict((i, _intern_names[(table, i)]) for i in str_ids)
 
 @attr.s(frozen=True)
 class IndexEntry(object):
@@ -40,39 +387,61 @@ class IndexEntry(object):
         else:
             return bytes(h)
     
+    def _cvt_extra_hashes(d):
+        if d is None:
+            return {}
+        return dict((name, IndexEntry._cvt_imhash(h)) for name, h in d.items())
+    
     imhash: bytes = attr.ib(converter=_cvt_imhash)
     src: str = attr.ib(converter=str)
     src_id: str = attr.ib(converter=str)
     src_url: str = attr.ib(converter=str)
     characters: tuple = attr.ib(converter=tuple)
     rating: str = attr.ib(converter=str)
+    extra_hashes: dict = attr.ib(factory=dict, converter=_cvt_extra_hashes, hash=False)
     
-    async def fetch_bytesio(self, http_sess):
+    async def fetch_bytesio(self, http_sess, limiter=None):
         """Download the source image for this entry.
         
+        If `image_cache` is set, the image is read from the cache if
+        possible, and is added to the cache after being downloaded.
+        
+        Args:
+            http_sess (aiohttp.ClientSession): The session to download with.
+            limiter (utils.HostRateLimiter): If given, used to rate-limit
+                the download (see `utils.fetch_url`).
+        
+        Raises:
+            aiohttp.ClientResponseError: If the image could not be downloaded.
+        
         Returns:
             A `BytesIO` containing the raw image file data.
         """
         
-        bio = io.BytesIO()
-        async with http_sess.get(self.src_url) as resp:
-            while True:
-                chunk = await resp.content.read(8*1024)
-                if not chunk:
-                    break
-                bio.write(chunk)
-                
-        bio.seek(0)
-        return bio
+        # Cache reads, writes, thumbnailing and eviction all run in the
+        # default executor, to keep disk I/O off the event loop.
+        loop = asyncio.get_event_loop()
+        
+        if image_cache is not None:
+            data = await loop.run_in_executor(None, image_cache.get, self.src, self.src_id, self.src_url)
+            if data is not None:
+                return io.BytesIO(data)
+        
+        data = await utils.fetch_url(http_sess, self.src_url, limiter)
+        
+        if image_cache is not None:
+            await loop.run_in_executor(None, image_cache.put, self.src, self.src_id, self.src_url, data)
+        
+        return io.BytesIO(data)
     
-    async def fetch(self, http_sess):
+    async def fetch(self, http_sess, limiter=None):
         """Fetch and open the source image for this entry.
         
         Returns:
             An Image.
         """
         
-        bio = await self.fetch_bytesio(http_sess)
+        bio = await self.fetch_bytesio(http_sess, limiter)
         img = Image.open(bio)
         img.load()
         
@@ -85,12 +454,14 @@ class IndexEntry(object):
         return np.frombuffer(self.imhash, dtype=np.uint8)
     
     @classmethod
-    def from_danbooru_post(cls, imhash, post):
+    def from_danbooru_post(cls, imhash, post, extra_hashes=None):
         """Create an IndexEntry from an image hash and a DanbooruPost.
         
         Args:
             imhash (bytes or ndarray): An image hash for this entry.
             post (DanbooruPost): A DanbooruPost to create this entry from.
+            extra_hashes (dict): Hashes for this entry under secondary hash
+                schemes, keyed by scheme name.
         
         Returns:
             An IndexEntry.
@@ -102,7 +473,8 @@ class IndexEntry(object):
             src_url=post.url,
             src='danbooru',
             characters=post.characters,
-            rating=post.rating
+            rating=post.rating,
+            extra_hashes=extra_hashes
         )
     
     @classmethod
@@ -122,26 +494,127 @@ class IndexEntry(object):
         
         imhash = cls._cvt_imhash(imhash)
         
-        ex = await redis.exists(b'hash:'+imhash+b':src')
-        if not ex:
+        entry = (await cls.load_many(redis, [imhash]))[0]
+        if entry is None:
             raise KeyError("Image with hash "+imhash.hex()+" not found in index")
         
-        src, src_id, src_url, rating, characters = await asyncio.gather(
-            redis.get(b'hash:'+imhash+b':src'),
-            redis.get(b'hash:'+imhash+b':src_id'),
-            redis.get(b'hash:'+imhash+b':src_url'),
-            redis.get(b'hash:'+imhash+b':rating'),
-            redis.smembers(b'hash:'+imhash+b':characters')
+        return entry
+    
+    @classmethod
+    async def load_many(cls, redis, hashes):
+        """Load the entries for several image hashes from the index at once.
+        
+        All entries are fetched within a single pipelined request.
+        
+        Args:
+            redis (aioredis.Redis): A Redis instance.
+            hashes (iterable of bytes or ndarray): Image hashes to lookup.
+        
+        Returns:
+            A list containing an IndexEntry for each hash, in the same order
+            as `hashes`. Hashes that are not in the index will have `None`
+            in their place.
+        """
+        
+        hashes = list(cls._cvt_imhash(h) for h in hashes)
+        if len(hashes) == 0:
+            return []
+        
+        pipe = redis.pipeline()
+        for h in hashes:
+            pipe.hgetall(entry_key(h))
+        all_fields = await pipe.execute()
+        
+        srcs, prefixes = await asyncio.gather(
+            resolve_interned(redis, 'src', (f[b's'] for f in all_fields if len(f) > 0)),
+            resolve_interned(redis, 'url_prefix', (f[b'p'] for f in all_fields if len(f) > 0))
         )
         
-        return cls(
-            imhash=imhash,
-            src=src.decode('utf-8'),
-            src_id=src_id.decode('utf-8'),
-            src_url=src_url.decode('utf-8'),
-            characters=map(lambda c: c.decode('utf-8'), characters),
-            rating=rating.decode('utf-8')
+        entries = []
+        legacy_idxs = []
+        for idx, (h, fields) in enumerate(zip(hashes, all_fields)):
+            if len(fields) > 0:
+                entries.append(cls(
+                    imhash=h,
+                    src=srcs[int(fields[b's'])],
+                    src_id=fields[b'i'].decode('utf-8'),
+                    src_url=prefixes[int(fields[b'p'])] + fields[b'u'].decode('utf-8'),
+                    characters=fields[b'c'].decode('utf-8').split(),
+                    rating=fields[b'r'].decode('utf-8'),
+                    extra_hashes=dict(
+                        (f[2:].decode('utf-8'), v) for f, v in fields.items() if f.startswith(b'h:')
+                    )
+                ))
+            else:
+                entries.append(None)
+                legacy_idxs.append(idx)
+        
+        # Entries that haven't been migrated to the compact format yet.
+        if len(legacy_idxs) > 0:
+            legacy = await cls._load_legacy_many(redis, list(hashes[i] for i in legacy_idxs))
+            for idx, entry in zip(legacy_idxs, legacy):
+                entries[idx] = entry
+        
+        return entries
+    
+    @classmethod
+    async def _load_legacy_many(cls, redis, hashes):
+        pipe = redis.pipeline()
+        for h in hashes:
+            pipe.get(_legacy_entry_key(h, b'src'))
+            pipe.get(_legacy_entry_key(h, b'src_id'))
+            pipe.get(_legacy_entry_key(h, b'src_url'))
+            pipe.get(_legacy_entry_key(h, b'rating'))
+            pipe.smembers(_legacy_entry_key(h, b'characters'))
+        res = await pipe.execute()
+        
+        entries = []
+        for i, h in enumerate(hashes):
+            src, src_id, src_url, rating, characters = res[i*5:(i+1)*5]
+            
+            if src is None:
+                entries.append(None)
+                continue
+            
+            entries.append(cls(
+                imhash=h,
+                src=src.decode('utf-8'),
+                src_id=src_id.decode('utf-8'),
+                src_url=src_url.decode('utf-8'),
+                characters=map(lambda c: c.decode('utf-8'), characters),
+                rating=rating.decode('utf-8')
+            ))
+        
+        return entries
+    
+    async def compact_fields(self, redis):
+        """Get the fields used to store this entry in the compact storage format.
+        
+        The source name and the common prefix of the source URL are replaced
+        with interned IDs, and characters are stored as a single
+        space-separated string.
+        
+        Args:
+            redis (aioredis.Redis): A Redis instance.
+        
+        Returns:
+            A dict mapping field names to values.
+        """
+        
+        prefix, suffix = split_url(self.src_url)
+        src_id, prefix_id = await asyncio.gather(
+            intern_string(redis, 'src', self.src),
+            intern_string(redis, 'url_prefix', prefix)
         )
+        
+        return {
+            b's': src_id,
+            b'i': self.src_id,
+            b'p': prefix_id,
+            b'u': suffix,
+            b'r': self.rating,
+            b'c': ' '.join(self.characters)
+        }
     
     async def add_to_index(self, redis):
         """Add this entry to the index.
@@ -153,144 +626,1513 @@ class IndexEntry(object):
             bool: True if the entry was added, False if it already exists.
         """
         
-        await redis.sadd('indexed:'+self.src, self.src_id)
+        return (await IndexEntry.add_many(redis, [self]))[0]
+    
+    @classmethod
+    async def add_many(cls, redis, entries, batch_size=500):
+        """Add several entries to the index at once.
         
-        ex = await redis.get(b'hash:'+self.imhash+b':src_id')
-        if ex is not None:
-            return False
+        Each entry is checked and inserted atomically by a Lua script, and
+        up to `batch_size` entries are sent to Redis within each pipeline.
+        Any secondary scheme hashes in `extra_hashes` are indexed along with
+        each newly-added entry.
+        
+        Args:
+            redis (aioredis.Redis): A Redis instance.
+            entries (iterable of IndexEntry): The entries to add.
+            batch_size (int): The maximum number of entries to write per pipeline.
         
-        tr = redis.multi_exec()
+        Returns:
+            A list of bools, one per entry: True if the entry was added, or
+            False if it already exists (or appears earlier within `entries`).
+        """
         
-        tr.set(b'hash:'+self.imhash+b':src', self.src)
-        tr.set(b'hash:'+self.imhash+b':src_id', self.src_id)
-        tr.set(b'hash:'+self.imhash+b':src_url', self.src_url)
-        tr.set(b'hash:'+self.imhash+b':rating', self.rating)
+        entries = list(entries)
+        added = []
         
-        for idx, val in enumerate(self.imhash):
-            tr.sadd(construct_hash_idx_key(idx, val), self.imhash)
+        for i in range(0, len(entries), batch_size):
+            batch = entries[i:i+batch_size]
+            all_fields = await asyncio.gather(*(entry.compact_fields(redis) for entry in batch))
+            
+            src_ids = {}
+            for entry in batch:
+                src_ids.setdefault(entry.src, set()).add(entry.src_id)
             
-        if len(self.characters) > 0:
-            tr.sadd(b'hash:'+self.imhash+b':characters', *self.characters)
-            for character in self.characters:
-                b_char = character.encode('utf-8')
-                tr.sadd(b'character:'+b_char, self.imhash)
+            pipe = redis.pipeline()
+            
+            # Make sure the scripts are loaded before they're used within the pipeline.
+            pipe.script_load(_add_entry_script)
+            pipe.script_load(_add_scheme_hash_script)
+            digest = hashlib.sha1(_add_entry_script.encode('utf-8')).hexdigest()
+            scheme_digest = hashlib.sha1(_add_scheme_hash_script.encode('utf-8')).hexdigest()
+            
+            for src, ids in src_ids.items():
+                pipe.sadd('indexed:'+src, *ids)
+            
+            res_idxs = []
+            n_cmds = 2 + len(src_ids)
+            
+            for entry, fields in zip(batch, all_fields):
+                keys = [entry_key(entry.imhash), _legacy_entry_key(entry.imhash, b'src_id'), index_log_key, entry_id_counter_key]
+                
+                for idx, val in enumerate(split_hash(entry.imhash, hash_chunk_bits)):
+                    keys.append(construct_hash_idx_key(idx, val, hash_chunk_bits))
+                
+                for character in entry.characters:
+                    keys.append(b'character:'+character.encode('utf-8'))
+                
+                args = [entry.imhash, index_log_maxlen, entry_id_bucket_size, entry_hashes_prefix]
+                for field, value in fields.items():
+                    args.extend((field, value))
+                
+                pipe.evalsha(digest, keys, args)
+                res_idxs.append(n_cmds)
+                n_cmds += 1
+                
+                # If the entry already existed, these do nothing unless it
+                # lacks a hash for the scheme.
+                for name, h in entry.extra_hashes.items():
+                    pipe.evalsha(scheme_digest, *_scheme_hash_keys_args(get_hash_scheme(name), entry.imhash, h))
+                    n_cmds += 1
             
-        res = await tr.execute()
-        return True
+            res = await pipe.execute()
+            added.extend(bool(res[i]) for i in res_idxs)
+        
+        return added
+    
+    def to_dict(self):
+        """Convert this entry to a JSON-serializable dict.
+        
+        The image hash is encoded in hexadecimal.
+        """
+        
+        d = attr.asdict(self)
+        d['imhash'] = self.imhash.hex() if self.imhash is not None else None
+        d['extra_hashes'] = dict((name, h.hex()) for name, h in self.extra_hashes.items())
+        
+        return d
+    
+    @classmethod
+    def from_dict(cls, d):
+        """Create an IndexEntry from a dict created by `to_dict`.
+        """
+        
+        d = dict(d)
+        if d['imhash'] is not None:
+            d['imhash'] = bytes.fromhex(d['imhash'])
+        if d.get('extra_hashes') is not None:
+            d['extra_hashes'] = dict((name, bytes.fromhex(h)) for name, h in d['extra_hashes'].items())
+        
+        return cls(**d)
 
-async def search_index(redis, imhash, min_threshold=64):
-    """Search the index for images with nearby hashes.
+async def migrate_legacy_entry(redis, imhash):
+    """Convert an entry stored in the legacy multi-key format to the compact format.
+    
+    The entry remains readable throughout the migration.
     
     Args:
         redis (aioredis.Redis): A Redis interface.
-        imhash (ndarray): An image hash to look up. Must be of type `uint8`.
-        min_threshold (int): A minimum distance threshold for filtering results.
-            The result list will only contain images with a result less than
-            this value.
-            
+        imhash (bytes): The hash of the entry to migrate.
+    
     Returns:
-        A list of (hash, distance) tuples, sorted by increasing distance.
+        bool: True if the entry was migrated, False if no legacy entry exists.
     """
     
-    h_bytes = imhash.tobytes()
+    entry = (await IndexEntry._load_legacy_many(redis, [imhash]))[0]
+    if entry is None:
+        return False
     
-    keys = []
-    for idx, val in enumerate(h_bytes):
-        keys.append(construct_hash_idx_key(idx, val))
+    fields = await entry.compact_fields(redis)
     
-    hashes = await redis.sunion(*keys)
-    _t = []
+    tr = redis.multi_exec()
+    tr.hmset_dict(entry_key(imhash), fields)
+    tr.delete(*(_legacy_entry_key(imhash, f) for f in (b'src', b'src_id', b'src_url', b'rating', b'characters')))
+    await tr.execute()
     
-    for h in hashes:
-        arr = np.frombuffer(h, dtype=np.uint8)
-        dist = hamming_dist(arr, imhash)
-        
-        if dist < min_threshold:
-            _t.append((h, dist))
-        
-    return sorted(_t, key=lambda o: o[1])
+    return True
+
+async def migrate_entry_ids(redis, hashes):
+    """Assign entry IDs to existing entries, and convert their set memberships to use them.
     
-async def get_indexed_tags(redis):
-    """Get all tags monitored for indexing.
+    Hash bucket (for the current `hash_chunk_bits`) and character set
+    members that contain the full image hash for an entry are replaced with
+    its entry ID. Entries must already be stored in the compact format.
     
     Args:
-        redis (aioredis.Redis): a Redis interface.
-        
+        redis (aioredis.Redis): A Redis interface.
+        hashes (iterable of bytes): The hashes of the entries to migrate.
+    
     Returns:
-        A list of monitored tags as `str` objects.
+        int: The number of entries processed.
     """
     
-    return await redis.lrange('indexed_tags', 0, -1, encoding='utf-8')
+    hashes = list(hashes)
+    entries = await IndexEntry.load_many(redis, hashes)
     
-async def add_indexed_tag(redis, tag):
-    """Add a new tag to be monitored for indexing.
+    pipe = redis.pipeline()
+    pipe.script_load(_assign_entry_id_script)
+    digest = hashlib.sha1(_assign_entry_id_script.encode('utf-8')).hexdigest()
+    
+    for h, entry in zip(hashes, entries):
+        if entry is None:
+            continue
+        
+        keys = [entry_key(h), entry_id_counter_key]
+        for idx, val in enumerate(split_hash(h, hash_chunk_bits)):
+            keys.append(construct_hash_idx_key(idx, val, hash_chunk_bits))
+        for character in entry.characters:
+            keys.append(b'character:'+character.encode('utf-8'))
+        
+        pipe.evalsha(digest, keys, [h, entry_id_bucket_size, entry_hashes_prefix])
+    
+    res = await pipe.execute()
+    return sum(res[1:])
+
+async def compact_sets(redis):
+    """Re-encode all hash bucket and character sets.
+    
+    Redis never converts a set back to a compact encoding once it has
+    contained a non-integer member, so this should be run after
+    `migrate_entry_ids` to allow migrated sets to use the `intset` encoding.
     
     Args:
         redis (aioredis.Redis): A Redis interface.
-        tag (str or bytes): The tag to monitor.
-
+    
     Returns:
-        The total number of indexed tags (incl. the added tag).
+        int: The number of sets re-encoded.
     """
     
-    return await redis.lpush('indexed_tags', tag)
+    n = 0
+    for pattern in (b'hash_idx*', b'character:*'):
+        async for key in redis.iscan(match=pattern):
+            await redis.sunionstore(key, key)
+            n += 1
     
-async def get_tag_queue_length(redis, tag):
-    """Get the current fetch queue length for a given indexed tag.
+    return n
+
+def _scheme_hash_keys_args(scheme, imhash, scheme_hash):
+    scheme_hash = IndexEntry._cvt_imhash(scheme_hash)
+    
+    if scheme.is_primary:
+        raise ValueError("Hashes for the primary scheme can't be added to existing entries")
+    
+    if len(scheme_hash) != scheme.n_bytes:
+        raise ValueError("Expected a {}-byte hash for scheme {}, got {} bytes".format(scheme.n_bytes, scheme.name, len(scheme_hash)))
+    
+    keys = [entry_key(imhash), scheme.hash_entries_key]
+    for idx, val in enumerate(split_hash(scheme_hash, scheme.bucket_chunk_bits)):
+        keys.append(construct_hash_idx_key(idx, val, scheme.bucket_chunk_bits, scheme.key_prefix))
+    
+    return keys, [imhash, scheme_hash, scheme.entry_field, entry_id_bucket_size, scheme.entry_hashes_prefix]
+
+async def add_scheme_hashes(redis, scheme, hashes, batch_size=500):
+    """Index existing entries under a secondary hash scheme.
+    
+    Entries must already have entry IDs (see `migrate_entry_ids`). An entry
+    that already has a hash for the scheme is left unchanged.
     
     Args:
         redis (aioredis.Redis): A Redis interface.
-        tag (str or bytes): The indexed tag to inspect.
-        
-    Returns:
-        The total number of images awaiting indexing for the tag.
-    """
-    
-    return await redis.llen('index_queue:'+tag)
+        scheme (str): The name of the hash scheme.
+        hashes (iterable): (entry hash, scheme hash) tuples, where the entry
+            hash is the entry's hash under the primary scheme.
+        batch_size (int): The maximum number of entries to write per pipeline.
     
-def diff_hash(img):
-    """Compute the difference hash of an image.
+    Raises:
+        KeyError: If the scheme is unknown.
+        ValueError: If `scheme` is the primary scheme, or any hash has the wrong length.
     
     Returns:
-        A `uint8` ndarray.
+        int: The number of entries that were updated.
     """
     
-    h = imagehash.dhash(img)
-    arr = np.packbits(np.where(h.hash.flatten(), 1, 0))
+    scheme = get_hash_scheme(scheme)
+    hashes = list(hashes)
+    digest = hashlib.sha1(_add_scheme_hash_script.encode('utf-8')).hexdigest()
+    n = 0
+    
+    for i in range(0, len(hashes), batch_size):
+        pipe = redis.pipeline()
+        pipe.script_load(_add_scheme_hash_script)
+        
+        for imhash, h in hashes[i:i+batch_size]:
+            pipe.evalsha(digest, *_scheme_hash_keys_args(scheme, IndexEntry._cvt_imhash(imhash), h))
+        
+        res = await pipe.execute()
+        n += sum(res[1:])
     
-    return arr
+    return n
 
-def avg_hash(img):
-    """Compute the average hash of an image.
+async def fetch_bucket_members(redis, keys, union=False):
+    """Fetch the raw members (entry IDs or legacy image hashes) of a set of bucket keys.
+    
+    Args:
+        redis (aioredis.Redis): A Redis interface.
+        keys (list): The bucket keys to fetch.
+        union (bool): If True, return the union of all buckets as a single list.
     
     Returns:
-        A `uint8` ndarray.
+        Either a list of members, if `union` is True, or a list containing a
+        list of members for each key.
     """
     
-    h = imagehash.average_hash(img)
-    arr = np.packbits(np.where(h.hash.flatten(), 1, 0))
+    if len(keys) == 0:
+        return []
     
-    return arr
+    if union:
+        return await redis.sunion(*keys)
+    
+    pipe = redis.pipeline()
+    for key in keys:
+        pipe.smembers(key)
+    return await pipe.execute()
 
-def combined_hash(img):
-    """Compute a combined perceptual hash for an image.
+async def fetch_bucket_hashes(redis, keys, union=False, id_prefix=None):
+    """Fetch the image hashes contained within a set of bucket keys.
     
-    Currently, this is just the concatenation of the dHash and the avgHash.
+    Buckets are fetched with a single `SUNION` (or pipelined `SMEMBERS`),
+    after which each distinct entry ID is resolved to its hash with
+    `resolve_entry_ids`. Distances can't be computed without the hashes, so
+    every candidate is resolved; this costs one more pipelined round trip
+    of `HMGET`s (one per reverse map bucket), rather than lookups within a
+    long-running script that would block Redis. To filter candidates before
+    they're returned, use `search_index_server_side`.
+    
+    Args:
+        redis (aioredis.Redis): A Redis interface.
+        keys (list): The bucket keys to fetch (i.e. hash index buckets or character sets).
+        union (bool): If True, return the union of all buckets as a single list.
+        id_prefix (str): The prefix of the Redis hashes used to resolve entry
+            IDs. Defaults to `entry_hashes_prefix`, which resolves IDs to
+            their primary scheme hashes.
     
     Returns:
-        A `uint8` ndarray.
+        Either a list of image hashes, if `union` is True, or a list
+        containing a list of image hashes for each key.
     """
     
-    h1 = imagehash.dhash(img)
-    h1 = np.packbits(np.where(h1.hash.flatten(), 1, 0))
+    if len(keys) == 0:
+        return []
+    
+    members = await fetch_bucket_members(redis, keys, union)
     
-    h2 = imagehash.average_hash(img)
-    h2 = np.packbits(np.where(h2.hash.flatten(), 1, 0))
+    if union:
+        # Distinct entries can share a hash under secondary schemes.
+        return list(dict.fromkeys(h for h in await resolve_entry_ids(redis, members, id_prefix) if h is not None))
     
-    return np.concatenate((h1, h2))
+    unique = list(set(itertools.chain.from_iterable(members)))
+    resolved = dict(zip(unique, await resolve_entry_ids(redis, unique, id_prefix)))
+    return list(list(resolved[m] for m in bucket if resolved[m] is not None) for bucket in members)
+
+async def resolve_entry_ids(redis, members, id_prefix=None):
+    """Resolve members of a hash bucket or character set to image hashes.
+    
+    IDs are looked up with one `HMGET` per reverse map bucket, all within a
+    single pipelined round trip.
+    
+    Args:
+        redis (aioredis.Redis): A Redis interface.
+        members (iterable of bytes): Set members, which may be entry IDs or image hashes.
+        id_prefix (str): The prefix of the Redis hashes used to resolve entry
+            IDs. Defaults to `entry_hashes_prefix`.
+    
+    Returns:
+        A list of image hashes, with `None` in place of any unknown entry IDs.
+    """
+    
+    members = list(members)
+    id_prefix = id_prefix or entry_hashes_prefix
+    
+    buckets = {}
+    for m in members:
+        if len(m) < 16:
+            entry_id = int(m)
+            buckets.setdefault(entry_id // entry_id_bucket_size, []).append(entry_id % entry_id_bucket_size)
+    
+    if len(buckets) == 0:
+        return members
+    
+    pipe = redis.pipeline()
+    for bucket, fields in buckets.items():
+        pipe.hmget(id_prefix+str(bucket), *fields)
+    
+    resolved = {}
+    for (bucket, fields), values in zip(buckets.items(), await pipe.execute()):
+        for field, h in zip(fields, values):
+            resolved[bucket * entry_id_bucket_size + field] = h
+    
+    return list((resolved[int(m)] if len(m) < 16 else m) for m in members)
+
+async def search_index(redis, imhash, min_threshold=None, exact_recall=False, k=None, first_match_under=None, scheme=None):
+    """Search the index for images with nearby hashes.
+    
+    If either `k` or `first_match_under` are given, buckets are probed
+    incrementally from smallest to largest, and the search stops as soon as
+    no unprobed bucket could contain a closer result.
+    
+    Args:
+        redis (aioredis.Redis): A Redis interface.
+        imhash (ndarray): An image hash to look up. Must be of type `uint8`.
+        min_threshold (int): A minimum distance threshold for filtering results.
+            The result list will only contain images with a result less than
+            this value. Defaults to the scheme's `default_threshold`.
+        exact_recall (bool): If True, probe enough buckets to guarantee that
+            every indexed hash under `min_threshold` is returned. Otherwise,
+            only hashes sharing at least one chunk with the query are found.
+        k (int): If provided, return at most this many results.
+        first_match_under (int): If provided, stop searching as soon as any
+            result with a distance less than this value is found.
+        scheme (str): The name of the hash scheme that `imhash` was computed
+            with. Defaults to the primary scheme.
+            
+    Returns:
+        A list of (hash, distance) tuples, sorted by increasing distance.
+        Each hash is the primary scheme hash of a matching entry (as used by
+        `IndexEntry.load_many`), while distances are measured under `scheme`.
+    """
+    
+    scheme = get_hash_scheme(scheme)
+    if min_threshold is None:
+        min_threshold = scheme.default_threshold
+    
+    groups = construct_probe_key_groups(imhash.tobytes(), min_threshold if exact_recall else None, scheme.bucket_chunk_bits, scheme.key_prefix)
+    
+    if server_side_search:
+        keys = list(itertools.chain.from_iterable(keys for _, keys in groups))
+        res = await _search_keys_server_side(redis, keys, imhash, min_threshold, k, scheme.entry_hashes_prefix)
+    elif k is None and first_match_under is None:
+        keys = list(itertools.chain.from_iterable(keys for _, keys in groups))
+        hashes = await fetch_bucket_hashes(redis, keys, union=True, id_prefix=scheme.entry_hashes_prefix)
+        res = score_candidates(hashes, imhash, min_threshold)
+    else:
+        res = await _search_progressive(redis, groups, imhash, min_threshold, k, first_match_under, scheme.entry_hashes_prefix)
+    
+    return await resolve_scheme_results(redis, scheme, res, k)
+
+async def _search_progressive(redis, groups, imhash, min_threshold, k, first_match_under, id_prefix=None):
+    probes = []
+    remaining = []
+    for group_idx, (_, keys) in enumerate(groups):
+        remaining.append(len(keys))
+        for key in keys:
+            probes.append((group_idx, key))
+    
+    pipe = redis.pipeline()
+    for _, key in probes:
+        pipe.scard(key)
+    sizes = await pipe.execute()
+    
+    probes = list(p for _, p in sorted(zip(sizes, probes), key=lambda o: o[0]))
+    
+    seen_members = set()
+    seen = set()
+    found = []
+    lower_bound = 0
+    batch_size = 1
+    
+    while len(probes) > 0:
+        batch = probes[:batch_size]
+        probes = probes[batch_size:]
+        batch_size *= 2
+        
+        # Only members that weren't in earlier batches need to be resolved.
+        new_members = set(await fetch_bucket_members(redis, list(key for _, key in batch), union=True))
+        new_members.difference_update(seen_members)
+        seen_members.update(new_members)
+        
+        new_hashes = set(h for h in await resolve_entry_ids(redis, new_members, id_prefix) if h is not None)
+        new_hashes.difference_update(seen)
+        seen.update(new_hashes)
+        
+        found.extend(score_candidates(new_hashes, imhash, min_threshold))
+        
+        # Any hash we haven't seen yet must lie outside every chunk whose
+        # buckets have all been probed, which bounds its distance.
+        for group_idx, _ in batch:
+            remaining[group_idx] -= 1
+            if remaining[group_idx] == 0:
+                lower_bound += groups[group_idx][0] + 1
+        
+        found.sort(key=lambda o: o[1])
+        
+        if first_match_under is not None and len(found) > 0 and found[0][1] < first_match_under:
+            break
+        
+        if lower_bound >= min_threshold:
+            break
+        
+        if k is not None and len(found) >= k and found[k-1][1] <= lower_bound:
+            break
+    
+    if k is not None:
+        return found[:k]
+    return found
+
+async def search_many(redis, imhashes, min_threshold=None, exact_recall=False, scheme=None):
+    """Search the index for images near any of several hashes at once.
+    
+    All bucket sets needed by the queries are fetched in a single pipelined
+    round trip, with buckets shared between queries fetched only once.
+    
+    Args:
+        redis (aioredis.Redis): A Redis interface.
+        imhashes (sequence of ndarray): Image hashes to look up. Must be of type `uint8`.
+        min_threshold (int): A minimum distance threshold for filtering results.
+            Defaults to the scheme's `default_threshold`.
+        exact_recall (bool): See `search_index`.
+        scheme (str): See `search_index`.
+    
+    Returns:
+        A list containing a list of (hash, distance) tuples for each query
+        hash, in the same order as `imhashes`.
+    """
+    
+    scheme = get_hash_scheme(scheme)
+    if min_threshold is None:
+        min_threshold = scheme.default_threshold
+    
+    imhashes = list(imhashes)
+    key_lists = list(
+        construct_probe_keys(h.tobytes(), min_threshold if exact_recall else None, scheme.bucket_chunk_bits, scheme.key_prefix)
+        for h in imhashes
+    )
+    
+    if server_side_search:
+        results = await asyncio.gather(*(
+            _search_keys_server_side(redis, keys, h, min_threshold, id_prefix=scheme.entry_hashes_prefix)
+            for keys, h in zip(key_lists, imhashes)
+        ))
+        return await asyncio.gather(*(resolve_scheme_results(redis, scheme, res) for res in results))
+    
+    unique_keys = list(set(itertools.chain.from_iterable(key_lists)))
+    
+    buckets = dict(zip(unique_keys, await fetch_bucket_hashes(redis, unique_keys, id_prefix=scheme.entry_hashes_prefix)))
+    
+    candidates = []
+    candidate_idxs = {}
+    query_idxs = []
+    
+    for keys in key_lists:
+        idxs = set()
+        for key in keys:
+            for h in buckets[key]:
+                if h not in candidate_idxs:
+                    candidate_idxs[h] = len(candidates)
+                    candidates.append(h)
+                idxs.add(candidate_idxs[h])
+        query_idxs.append(np.fromiter(idxs, dtype=np.intp, count=len(idxs)))
+    
+    if len(candidates) == 0:
+        return list([] for _ in imhashes)
+    
+    dists = hamming_dist_matrix(hash_matrix(candidates), np.stack(imhashes))
+    
+    results = []
+    for row, idxs in zip(dists, query_idxs):
+        idxs = np.sort(idxs)
+        ranked = idxs[rank_distances(row[idxs], min_threshold)]
+        results.append(list((candidates[i], int(row[i])) for i in ranked))
+    
+    if not scheme.is_primary:
+        results = await asyncio.gather(*(resolve_scheme_results(redis, scheme, res) for res in results))
+    
+    return results
+
+async def resolve_scheme_results(redis, scheme, results, k=None):
+    """Map search results for a secondary hash scheme back to the entries they belong to.
+    
+    Several entries may share an identical hash under a secondary scheme;
+    each of them is included in the output, with the same distance.
+    
+    Args:
+        redis (aioredis.Redis): A Redis interface.
+        scheme (HashScheme or str): The scheme that the results were found with.
+        results (list): (hash, distance) tuples, where each hash was computed
+            under `scheme`.
+        k (int): If provided, return at most this many results.
+    
+    Returns:
+        A list of (hash, distance) tuples in the same order as `results`,
+        where each hash is an entry's primary scheme hash.
+    """
+    
+    scheme = get_hash_scheme(scheme)
+    if scheme.is_primary or len(results) == 0:
+        return results
+    
+    primary_len = get_hash_scheme(primary_hash_scheme).n_bytes
+    entries = await redis.hmget(scheme.hash_entries_key, *(h for h, _ in results))
+    
+    out = []
+    for (_, dist), value in zip(results, entries):
+        if value is None:
+            continue
+        
+        for i in range(0, len(value), primary_len):
+            out.append((value[i:i+primary_len], dist))
+    
+    if k is not None:
+        return out[:k]
+    return out
+
+async def search_combined(redis, queries, min_thresholds=None, exact_recall=False, k=None):
+    """Search the index using several hash schemes at once.
+    
+    Candidates are found by searching with the first scheme, and are then
+    filtered by their distances under each of the other schemes. This allows
+    a cheap hash to be used for finding candidates, with a longer or more
+    robust hash used to weed out false matches.
+    
+    Entries that have not been hashed under every scheme are never returned.
+    
+    Args:
+        redis (aioredis.Redis): A Redis interface.
+        queries (sequence): (scheme name, hash) tuples, where each hash is a
+            `uint8` ndarray computed from the same query image.
+        min_thresholds (sequence of int): A distance threshold for each scheme,
+            in the same order as `queries`. Defaults to each scheme's
+            `default_threshold`.
+        exact_recall (bool): See `search_index`. Only applies to the first scheme.
+        k (int): If provided, return at most this many results.
+    
+    Returns:
+        A list of (hash, distances) tuples, where `distances` is a list of
+        distances under each scheme in the same order as `queries`. Results
+        are sorted by the sum of their distances, each divided by the length
+        of its scheme's hashes.
+    """
+    
+    schemes = list(get_hash_scheme(name) for name, _ in queries)
+    query_hashes = list(h for _, h in queries)
+    if min_thresholds is None:
+        min_thresholds = list(s.default_threshold for s in schemes)
+    
+    candidates = await search_index(redis, query_hashes[0], min_thresholds[0], exact_recall, scheme=schemes[0].name)
+    if len(candidates) == 0:
+        return []
+    
+    entry_hashes = list(h for h, _ in candidates)
+    all_dists = [np.array(list(d for _, d in candidates), dtype=np.int32)]
+    mask = np.ones(len(candidates), dtype=bool)
+    
+    pipe = redis.pipeline()
+    for scheme in schemes[1:]:
+        if not scheme.is_primary:
+            for h in entry_hashes:
+                pipe.hget(entry_key(h), scheme.entry_field)
+    res = iter(await pipe.execute())
+    
+    for scheme, query, threshold in zip(schemes[1:], query_hashes[1:], min_thresholds[1:]):
+        if scheme.is_primary:
+            hashes = entry_hashes
+        else:
+            hashes = list(next(res) for _ in entry_hashes)
+        
+        present = np.fromiter((h is not None for h in hashes), dtype=bool, count=len(hashes))
+        dists = np.full(len(hashes), threshold, dtype=np.int32)
+        if present.any():
+            dists[present] = hamming_dist_many(hash_matrix(list(h for h in hashes if h is not None)), query)
+        
+        mask &= (dists < threshold)
+        all_dists.append(dists)
+    
+    idxs = np.flatnonzero(mask)
+    scores = sum(dists[idxs] / scheme.n_bits for scheme, dists in zip(schemes, all_dists))
+    idxs = idxs[np.argsort(scores, kind='stable')]
+    if k is not None:
+        idxs = idxs[:k]
+    
+    return list((entry_hashes[i], list(int(dists[i]) for dists in all_dists)) for i in idxs)
+
+# Candidates are resolved and filtered in a single pass, so only matching
+# hashes are returned; each distinct member is still looked up once, since
+# its distance can't be computed without its hash.
+_search_script = _resolve_members_lua + """
+local popcount = {}
+for i = 0, 255 do
+    local n, v = 0, i
+    while v > 0 do
+        n = n + bit.band(v, 1)
+        v = bit.rshift(v, 1)
+    end
+    popcount[i] = n
+end
+
+local query = {string.byte(ARGV[1], 1, -1)}
+local n_bytes = #query
+local threshold = tonumber(ARGV[2])
+local k = tonumber(ARGV[3])
+
+local id_prefix = ARGV[4]
+local bucket_size = tonumber(ARGV[5])
+
+local results = {}
+local seen_members = {}
+local seen = {}
+
+for _, key in ipairs(KEYS) do
+    for _, m in ipairs(redis.call('SMEMBERS', key)) do
+        local h = false
+        if not seen_members[m] then
+            seen_members[m] = true
+            h = resolve_member(m, id_prefix, bucket_size)
+        end
+        
+        if h and #h == n_bytes and not seen[h] then
+            seen[h] = true
+            
+            local dist = 0
+            for i = 1, n_bytes do
+                dist = dist + popcount[bit.bxor(string.byte(h, i), query[i])]
+                if dist >= threshold then
+                    break
+                end
+            end
+            
+            if dist < threshold then
+                results[#results+1] = {h, dist}
+            end
+        end
+    end
+end
+
+table.sort(results, function (a, b)
+    if a[2] == b[2] then
+        return a[1] < b[1]
+    end
+    return a[2] < b[2]
+end)
+
+local out = {}
+for i, res in ipairs(results) do
+    if k > 0 and i > k then
+        break
+    end
+    out[#out+1] = res[1]
+    out[#out+1] = res[2]
+end
+
+return out
+"""
+
+async def run_script(redis, script, keys=[], args=[]):
+    """Run a Lua script within Redis, loading it into the script cache if necessary.
+    
+    Args:
+        redis (aioredis.Redis): A Redis interface.
+        script (str): The script source.
+        keys (list): Key names to pass to the script.
+        args (list): Additional arguments to pass to the script.
+    
+    Returns:
+        The script's return value.
+    """
+    
+    digest = hashlib.sha1(script.encode('utf-8')).hexdigest()
+    
+    try:
+        return await redis.evalsha(digest, keys, args)
+    except aioredis.ReplyError as e:
+        if not str(e).startswith('NOSCRIPT'):
+            raise
+    
+    await redis.script_load(script)
+    return await redis.evalsha(digest, keys, args)
+
+async def _search_keys_server_side(redis, keys, imhash, min_threshold, k=None, id_prefix=None):
+    res = await run_script(redis, _search_script, keys, [imhash.tobytes(), min_threshold, k or 0, id_prefix or entry_hashes_prefix, entry_id_bucket_size])
+    return list((res[i], int(res[i+1])) for i in range(0, len(res), 2))
+
+async def search_index_server_side(redis, imhash, min_threshold=None, exact_recall=False, k=None, scheme=None):
+    """Search the index for images with nearby hashes, filtering results within Redis.
+    
+    Distances are computed by a Lua script running on the Redis server, so
+    that only matching hashes are transferred back to the client.
+    
+    Args:
+        redis (aioredis.Redis): A Redis interface.
+        imhash (ndarray): An image hash to look up. Must be of type `uint8`.
+        min_threshold (int): A minimum distance threshold for filtering results.
+            Defaults to the scheme's `default_threshold`.
+        exact_recall (bool): See `search_index`.
+        k (int): If provided, return at most this many results.
+        scheme (str): See `search_index`.
+    
+    Returns:
+        A list of (hash, distance) tuples, sorted by increasing distance.
+    """
+    
+    scheme = get_hash_scheme(scheme)
+    if min_threshold is None:
+        min_threshold = scheme.default_threshold
+    
+    keys = construct_probe_keys(imhash.tobytes(), min_threshold if exact_recall else None, scheme.bucket_chunk_bits, scheme.key_prefix)
+    res = await _search_keys_server_side(redis, keys, imhash, min_threshold, k, scheme.entry_hashes_prefix)
+    return await resolve_scheme_results(redis, scheme, res, k)
+
+def score_candidates(hashes, imhash, min_threshold):
+    """Filter and rank a set of candidate hashes by distance to a query hash.
+    
+    Args:
+        hashes (sequence of bytes): Candidate image hashes.
+        imhash (ndarray): The query hash. Must be of type `uint8`.
+        min_threshold (int): Only candidates with a distance less than this
+            value will be returned.
+    
+    Returns:
+        A list of (hash, distance) tuples, sorted by increasing distance.
+    """
+    
+    hashes = list(hashes)
+    if len(hashes) == 0:
+        return []
+    
+    dists = hamming_dist_many(hash_matrix(hashes), imhash)
+    return [(hashes[i], int(dists[i])) for i in rank_distances(dists, min_threshold)]
+
+def rank_distances(dists, min_threshold):
+    """Select and order the distances that fall under a threshold.
+    
+    Args:
+        dists (ndarray): An array of Hamming distances.
+        min_threshold (int): Only distances less than this value are selected.
+    
+    Returns:
+        An ndarray of indices into `dists`, sorted by increasing distance.
+    """
+    
+    idxs = np.flatnonzero(dists < min_threshold)
+    return idxs[np.argsort(dists[idxs], kind='stable')]
+    
+def parse_log_id(log_id):
+    """Parse an index change log entry ID into a comparable tuple.
+    
+    Args:
+        log_id (str or bytes): A Redis stream entry ID.
+    
+    Returns:
+        A (milliseconds, sequence) tuple of `int`s.
+    """
+    
+    if isinstance(log_id, bytes):
+        log_id = log_id.decode('utf-8')
+    
+    ms, seq = log_id.split('-')
+    return int(ms), int(seq)
+
+async def get_index_log_bounds(redis):
+    """Get the IDs of the oldest and newest entries within the index change log.
+    
+    Args:
+        redis (aioredis.Redis): A Redis interface.
+    
+    Returns:
+        A (head, tail) tuple of entry IDs, or (None, None) if the log is empty.
+    """
+    
+    head, tail = await asyncio.gather(
+        redis.xrange(index_log_key, count=1),
+        redis.xrevrange(index_log_key, count=1)
+    )
+    
+    if len(head) == 0 or len(tail) == 0:
+        return None, None
+    
+    return head[0][0], tail[0][0]
+
+async def read_index_log(redis, after_id, count=10000):
+    """Read newly-indexed hashes from the index change log.
+    
+    Args:
+        redis (aioredis.Redis): A Redis interface.
+        after_id (str or bytes): Only entries after this ID will be returned.
+        count (int): The maximum number of entries to return.
+    
+    Returns:
+        A list of (entry ID, hash) tuples, in insertion order.
+    """
+    
+    ms, seq = parse_log_id(after_id)
+    entries = await redis.xrange(index_log_key, start='{}-{}'.format(ms, seq+1), count=count)
+    
+    return list((log_id, fields[b'imhash']) for log_id, fields in entries)
+
+async def scan_hashes(redis):
+    """Iterate over every image hash stored in the index.
+    
+    Entries still stored in the legacy format are included. Legacy keys are
+    scanned first, so that an entry migrated while this scan is in progress
+    is never missed (though it may be yielded twice): if it's migrated
+    before the legacy scan reaches it, its new key already exists for the
+    whole of the second scan.
+    
+    Args:
+        redis (aioredis.Redis): A Redis interface.
+    
+    Yields:
+        Image hashes, as `bytes`.
+    """
+    
+    async for key in redis.iscan(match=b'hash:*:src'):
+        if len(key) == 25:
+            yield key[5:-4]
+    
+    async for key in redis.iscan(match=b'entry:*'):
+        if len(key) == 22:
+            yield key[6:]
+
+async def rebuild_hash_buckets(redis, chunk_bits, batch_size=1000):
+    """Rebuild the hash bucket sets for a given chunk width from the stored entries.
+    
+    Args:
+        redis (aioredis.Redis): A Redis interface.
+        chunk_bits (int): The chunk width to build buckets for.
+        batch_size (int): The number of entries to write per pipeline.
+    
+    Returns:
+        int: The number of entries processed.
+    """
+    
+    n = 0
+    batch = []
+    
+    async def write_batch(batch):
+        pipe = redis.pipeline()
+        for h in batch:
+            pipe.hget(entry_key(h), b'n')
+        entry_ids = await pipe.execute()
+        
+        pipe = redis.pipeline()
+        for h, entry_id in zip(batch, entry_ids):
+            # Entries without an assigned ID are stored by their full hash.
+            member = entry_id if entry_id is not None else h
+            for idx, val in enumerate(split_hash(h, chunk_bits)):
+                pipe.sadd(construct_hash_idx_key(idx, val, chunk_bits), member)
+        await pipe.execute()
+    
+    async for h in scan_hashes(redis):
+        batch.append(h)
+        n += 1
+        
+        if len(batch) >= batch_size:
+            await write_batch(batch)
+            batch = []
+    
+    if len(batch) > 0:
+        await write_batch(batch)
+    
+    return n
+
+async def clear_hash_buckets(redis, chunk_bits):
+    """Delete all hash bucket sets for a given chunk width.
+    
+    Args:
+        redis (aioredis.Redis): A Redis interface.
+        chunk_bits (int): The chunk width to delete buckets for.
+    """
+    
+    if chunk_bits == 8:
+        pattern = 'hash_idx:*'
+    else:
+        pattern = 'hash_idx{}:*'.format(chunk_bits)
+    
+    async for key in redis.iscan(match=pattern):
+        await redis.unlink(key)
+
+async def get_indexed_tags(redis):
+    """Get all tags monitored for indexing.
+    
+    Args:
+        redis (aioredis.Redis): a Redis interface.
+        
+    Returns:
+        A list of monitored tags as `str` objects.
+    """
+    
+    return await redis.lrange('indexed_tags', 0, -1, encoding='utf-8')
+    
+async def add_indexed_tag(redis, tag):
+    """Add a new tag to be monitored for indexing.
+    
+    Args:
+        redis (aioredis.Redis): A Redis interface.
+        tag (str or bytes): The tag to monitor.
+
+    Returns:
+        The total number of indexed tags (incl. the added tag).
+    """
+    
+    return await redis.lpush('indexed_tags', tag)
+    
+async def get_tag_queue_length(redis, tag):
+    """Get the current fetch queue length for a given indexed tag.
+    
+    Args:
+        redis (aioredis.Redis): A Redis interface.
+        tag (str or bytes): The indexed tag to inspect.
+        
+    Returns:
+        The total number of images awaiting indexing for the tag.
+    """
+    
+    return await redis.llen('index_queue:'+tag)
+
+"""The crawl progress of each indexed tag is stored within the Redis hash
+`crawl_cursor:<tag>`.
+"""
+crawl_cursor_key_prefix = 'crawl_cursor:'
+
+def crawl_cursor_key(tag):
+    return crawl_cursor_key_prefix + tag
+
+@attr.s
+class CrawlCursor(object):
+    """The Indexer's progress through the posts with an indexed tag.
+    
+    Routine refreshes only look for posts newer than `newest_id`, while a
+    separate, one-time backfill walks back through older posts from
+    `oldest_id`.
+    
+    Attributes:
+        newest_id (int): The ID of the newest post seen, or None if the tag
+            hasn't been crawled yet.
+        oldest_id (int): The ID of the oldest post seen, or None if the tag
+            hasn't been crawled yet.
+        backfill_done (bool): Whether the backfill has reached the tag's
+            oldest post.
+    """
+    
+    newest_id: int = attr.ib(default=None)
+    oldest_id: int = attr.ib(default=None)
+    backfill_done: bool = attr.ib(default=False)
+
+async def get_crawl_cursor(redis, tag):
+    """Get the crawl progress for an indexed tag.
+    
+    Args:
+        redis (aioredis.Redis): A Redis interface.
+        tag (str): The indexed tag to inspect.
+    
+    Returns:
+        A CrawlCursor.
+    """
+    
+    saved = await redis.hgetall(crawl_cursor_key(tag))
+    
+    return CrawlCursor(
+        newest_id=int(saved[b'newest_id']) if b'newest_id' in saved else None,
+        oldest_id=int(saved[b'oldest_id']) if b'oldest_id' in saved else None,
+        backfill_done=(saved.get(b'backfill_done') == b'1')
+    )
+    
+"""If `combined_hash` is called with `exact=False`, images are first reduced
+(with a box filter) to no more than this many times the hash size along each
+dimension.
+"""
+fast_hash_scale = 8
+
+_resample_bits = 22
+
+def _lanczos(x):
+    x = np.asarray(x, dtype=np.float64)
+    
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sinc1 = np.where(x == 0, 1.0, np.sin(x * np.pi) / (x * np.pi))
+        sinc3 = np.where(x == 0, 1.0, np.sin((x / 3) * np.pi) / ((x / 3) * np.pi))
+    
+    return np.where((x >= -3.0) & (x < 3.0), sinc1 * sinc3, 0.0)
+
+@functools.lru_cache(maxsize=512)
+def _resample_coeffs(in_size, out_size):
+    """Compute the fixed-point weights used by Pillow to resample one image axis with a Lanczos filter.
+    
+    This follows `precompute_coeffs` and `normalize_coeffs_8bpc` within
+    Pillow's `Resample.c` exactly, so that resampling with these weights
+    gives identical results to `Image.resize`.
+    
+    Returns:
+        A float64 ndarray of shape (in_size, out_size), containing integer weights.
+    """
+    
+    coeffs = np.zeros((in_size, out_size), dtype=np.float64)
+    
+    if in_size == out_size:
+        # Pillow skips resampling entirely along unchanged axes.
+        coeffs[np.arange(in_size), np.arange(in_size)] = 1 << _resample_bits
+        return coeffs
+    
+    scale = in_size / out_size
+    filterscale = max(scale, 1.0)
+    support = 3.0 * filterscale
+    
+    for i in range(out_size):
+        center = (i + 0.5) * scale
+        lo = max(int(center - support + 0.5), 0)
+        hi = min(int(center + support + 0.5), in_size)
+        
+        w = _lanczos(((np.arange(lo, hi) - center) + 0.5) * (1.0 / filterscale))
+        
+        # Pillow sums the weights sequentially.
+        total = np.cumsum(w)[-1]
+        if total != 0.0:
+            w = w / total
+        
+        coeffs[lo:hi, i] = np.trunc(np.where(w < 0, w * (1 << _resample_bits) - 0.5, w * (1 << _resample_bits) + 0.5))
+    
+    return coeffs
+
+def _clip8(acc):
+    acc = acc + (1 << (_resample_bits - 1))
+    return np.clip(np.floor(acc / (1 << _resample_bits)), 0, 255).astype(np.uint8)
+
+def _resample_vertical_first(px, out_height):
+    # Resample each column of a grayscale image, then each row of the result,
+    # with the rounding of the intermediate image that this order implies.
+    h, w = px.shape
+    v_coeffs = _resample_coeffs(h, out_height)
+    
+    acc = np.zeros((out_height, w), dtype=np.float64)
+    block_rows = max(1, (1 << 20) // w)
+    
+    for start in range(0, h, block_rows):
+        acc += v_coeffs[start:start+block_rows].T @ px[start:start+block_rows].astype(np.float64)
+    
+    return _clip8(acc).astype(np.float64)
+
+@functools.lru_cache(maxsize=1)
+def _pillow_resamples_tall_images_vertically():
+    """Check whether Pillow resamples very tall images vertically first.
+    
+    Recent versions of Pillow resample images that are more than 100 times
+    taller than they are wide along their height first, instead of their
+    width, which changes how the intermediate image is rounded. This is
+    checked with a small test image for which the two orders differ.
+    """
+    
+    px = ((np.arange(2 * 201) * 97) % 256).astype(np.uint8).reshape(201, 2)
+    ref = np.asarray(Image.fromarray(px, 'L').resize((8, 8), Image.LANCZOS))
+    
+    return np.array_equal(ref, _clip8(_resample_vertical_first(px, 8) @ _resample_coeffs(2, 8)))
+
+def _hash_pixels(gray):
+    # Equivalent to resizing a grayscale image to both 9x8 and 8x8 pixels
+    # with Image.resize(..., Image.LANCZOS), but with only one pass over the
+    # full image. Since every weight and pixel is an integer, these float64
+    # products and sums are exact.
+    px = np.asarray(gray)
+    h, w = px.shape
+    
+    h_coeffs = np.concatenate((_resample_coeffs(w, 9), _resample_coeffs(w, 8)), axis=1)
+    
+    if h > w * 100 and _pillow_resamples_tall_images_vertically():
+        out = _clip8(_resample_vertical_first(px, 8) @ h_coeffs)
+        return out[:, :9], out[:, 9:]
+    
+    tmp = np.empty((h, 17), dtype=np.float64)
+    block_rows = max(1, (1 << 20) // w)
+    
+    for start in range(0, h, block_rows):
+        tmp[start:start+block_rows] = px[start:start+block_rows].astype(np.float64) @ h_coeffs
+    
+    tmp = _clip8(tmp).astype(np.float64)
+    out = _clip8(_resample_coeffs(h, 8).T @ tmp)
+    
+    return out[:, :9], out[:, 9:]
+
+def _gray_hash_bits(gray):
+    # Matches imagehash.dhash and imagehash.average_hash, which each resize
+    # from a grayscale copy of the full image using a Lanczos filter.
+    d_px, a_px = _hash_pixels(gray)
+    
+    d_bits = np.packbits(d_px[:, 1:] > d_px[:, :-1])
+    a_bits = np.packbits(a_px > np.mean(a_px))
+    
+    return d_bits, a_bits
+
+def diff_hash(img):
+    """Compute the difference hash of an image.
+    
+    Returns:
+        A `uint8` ndarray.
+    """
+    
+    return _gray_hash_bits(img.convert('L'))[0]
+
+def avg_hash(img):
+    """Compute the average hash of an image.
+    
+    Returns:
+        A `uint8` ndarray.
+    """
+    
+    return _gray_hash_bits(img.convert('L'))[1]
+
+def combined_hash(img, exact=True):
+    """Compute a combined perceptual hash for an image.
+    
+    Currently, this is just the concatenation of the dHash and the avgHash.
+    The image is converted to grayscale and resampled for both hashes in a
+    single pass; the result is bit-for-bit identical to the hashes computed
+    by `imagehash.dhash` and `imagehash.average_hash` with the installed
+    version of Pillow, including for images over 100 times taller than they
+    are wide (which recent versions of Pillow resample in a different
+    order). `test_hash_aspect.py` checks this over a range of aspect ratios.
+    
+    Args:
+        img (Image): The image to hash.
+        exact (bool): If False, the image is cheaply reduced in size before
+            hashing (see `fast_hash_scale`). This is much faster for large
+            images, but the resulting hashes may differ by a few bits from
+            those computed with `exact=True`.
+    
+    Returns:
+        A `uint8` ndarray.
+    """
+    
+    gray = img.convert('L')
+    
+    if not exact:
+        factor = min(gray.width // (9 * fast_hash_scale), gray.height // (8 * fast_hash_scale))
+        if factor > 1:
+            gray = gray.resize((gray.width // factor, gray.height // factor), Image.BOX)
+    
+    return np.concatenate(_gray_hash_bits(gray))
+
+def diff_hash_256(img):
+    """Compute a 256-bit difference hash of an image.
+    
+    This is equivalent to `imagehash.dhash(img, hash_size=16)`.
+    
+    Returns:
+        A `uint8` ndarray.
+    """
+    
+    px = np.asarray(img.convert('L').resize((17, 16), Image.LANCZOS))
+    return np.packbits(px[:, 1:] > px[:, :-1])
+
+@functools.lru_cache(maxsize=8)
+def _dct_matrix(n):
+    k = np.arange(n)[:, np.newaxis]
+    i = np.arange(n)[np.newaxis, :]
+    return np.cos(np.pi * k * (2 * i + 1) / (2 * n))
+
+def dct_hash(img):
+    """Compute the 64-bit DCT-based perceptual hash (pHash) of an image.
+    
+    This is equivalent to `imagehash.phash(img)`, up to rounding in
+    coefficients that lie very close to the median.
+    
+    Returns:
+        A `uint8` ndarray.
+    """
+    
+    px = np.asarray(img.convert('L').resize((32, 32), Image.LANCZOS), dtype=np.float64)
+    
+    dct = _dct_matrix(32)[:8]
+    low_freq = dct @ px @ dct.T
+    
+    return np.packbits(low_freq > np.median(low_freq))
+
+"""When hashing image files with `hash_image_file`, JPEG images are decoded at
+a reduced scale, but never to less than this many times the hash size along
+each dimension. Set to None to always fully decode images.
+"""
+hash_draft_scale = 8
+
+"""Images that would decode to more than this many pixels are rejected by
+`open_image_for_hashing`.
+"""
+max_hash_pixels = 1 << 27
+
+def open_image_for_hashing(fp, draft=True, max_pixels=None, size=(9, 8)):
+    """Open and decode an image file at the smallest size suitable for hashing.
+    
+    JPEG images are decoded directly to grayscale at a reduced size (using
+    DCT-domain scaling), which is several times faster and uses far less
+    memory than a full decode. Other formats are fully decoded.
+    
+    Args:
+        fp (str or file): The image file to open.
+        draft (bool): If False, always fully decode the image.
+        max_pixels (int): Overrides `max_hash_pixels` if given.
+        size (tuple): The (width, height) that the image will be resampled
+            to for hashing (see `HashScheme.resample_size`).
+    
+    Raises:
+        OSError: If the image could not be opened, or is too large.
+    
+    Returns:
+        A loaded Image.
+    """
+    
+    if max_pixels is None:
+        max_pixels = max_hash_pixels
+    
+    try:
+        img = Image.open(fp)
+    except Image.DecompressionBombError as e:
+        raise OSError(str(e))
+    
+    if draft and hash_draft_scale is not None:
+        img.draft('L', (size[0] * hash_draft_scale, size[1] * hash_draft_scale))
+    
+    if img.width * img.height > max_pixels:
+        img.close()
+        raise OSError("Image is too large to hash ({}x{} pixels)".format(img.width, img.height))
+    
+    img.load()
+    return img
+
+def hash_image_file(fp, draft=True, max_pixels=None):
+    """Compute the combined perceptual hash of an image file.
+    
+    Hashes computed from reduced-size decodes (see `open_image_for_hashing`)
+    can differ by a few bits from those computed from fully-decoded images.
+    
+    Args:
+        fp (str or file): The image file to hash.
+        draft (bool): If False, always fully decode the image.
+        max_pixels (int): Overrides `max_hash_pixels` if given.
+    
+    Raises:
+        OSError: If the image could not be opened, or is too large.
+    
+    Returns:
+        A `uint8` ndarray.
+    """
+    
+    with open_image_for_hashing(fp, draft, max_pixels) as img:
+        return combined_hash(img)
+
+def hash_image_file_multi(fp, schemes, draft=True, max_pixels=None):
+    """Hash an image file under several hash schemes at once.
+    
+    The primary scheme's hash is always computed from a decode at its own
+    resample size, so that it exactly matches `hash_image_file`; the
+    secondary schemes share a single decode at a size suitable for all of
+    them. (Reduced-size decodes change slightly with the decode size, and the
+    primary hash identifies each entry.)
+    
+    Args:
+        fp (str or file): The image file to hash.
+        schemes (iterable of str): The names of the schemes to hash with.
+        draft (bool): If False, always fully decode the image.
+        max_pixels (int): Overrides `max_hash_pixels` if given.
+    
+    Raises:
+        KeyError: If any of the schemes are unknown.
+        OSError: If the image could not be opened, or is too large.
+    
+    Returns:
+        A dict mapping scheme names to `uint8` ndarrays.
+    """
+    
+    schemes = list(get_hash_scheme(name) for name in schemes)
+    secondary = list(s for s in schemes if s.name != primary_hash_scheme)
+    
+    by_size = {}
+    for s in schemes:
+        if s.name == primary_hash_scheme:
+            size = s.resample_size
+        else:
+            size = (
+                max(s2.resample_size[0] for s2 in secondary),
+                max(s2.resample_size[1] for s2 in secondary)
+            )
+        by_size.setdefault(size, []).append(s)
+    
+    start = fp.tell() if hasattr(fp, 'seek') else None
+    
+    hashes = {}
+    for size, group in by_size.items():
+        if start is not None:
+            fp.seek(start)
+        
+        with open_image_for_hashing(fp, draft, max_pixels, size) as img:
+            hashes.update((s.name, s.func(img)) for s in group)
+    
+    return hashes
+
+@attr.s(frozen=True)
+class HashScheme(object):
+    """A method of hashing images, along with the keys its hashes are indexed under.
+    
+    Every entry is stored under its hash from the primary scheme (see
+    `primary_hash_scheme`). Entries can also be indexed under any number of
+    secondary schemes, each of which uses its own set of hash buckets (whose
+    keys begin with `key_prefix`) that share the entry IDs assigned to each
+    entry.
+    
+    Attributes:
+        name (str): The name of this scheme.
+        n_bits (int): The length of this scheme's hashes, in bits.
+        func (callable): Computes the hash of an Image as a `uint8` ndarray.
+        default_threshold (int): The distance threshold used by searches that
+            don't specify one.
+        resample_size (tuple): The smallest (width, height) that `func`
+            resamples images to, used to pick a size for reduced decoding.
+        key_prefix (str): A prefix for the names of every key belonging to
+            this scheme.
+        chunk_bits (int): The chunk width used for bucketing hashes. If None,
+            `hash_chunk_bits` is used.
+    """
+    
+    name: str = attr.ib()
+    n_bits: int = attr.ib()
+    func = attr.ib()
+    default_threshold: int = attr.ib()
+    resample_size: tuple = attr.ib()
+    key_prefix: str = attr.ib()
+    chunk_bits: int = attr.ib(default=None)
+    
+    @property
+    def n_bytes(self):
+        return self.n_bits // 8
+    
+    @property
+    def is_primary(self):
+        return self.name == primary_hash_scheme
+    
+    @property
+    def bucket_chunk_bits(self):
+        return self.chunk_bits if self.chunk_bits is not None else hash_chunk_bits
+    
+    @property
+    def entry_hashes_prefix(self):
+        """str: The prefix of the Redis hashes mapping entry IDs to this scheme's hashes.
+        """
+        return self.key_prefix + entry_hashes_prefix
+    
+    @property
+    def hash_entries_key(self):
+        """str: The Redis hash mapping this scheme's hashes to the primary hashes of their entries.
+        """
+        return self.key_prefix + 'hash_entries'
+    
+    @property
+    def entry_field(self):
+        """bytes: The entry field that this scheme's hash is stored under.
+        """
+        return b'h:' + self.name.encode('utf-8')
+    
+    def similarity(self, dist):
+        """Convert a distance between two hashes into a similarity between 0 and 1.
+        """
+        return (self.n_bits - dist) / self.n_bits
+
+"""All known hash schemes, keyed by name.
+"""
+hash_schemes = {}
+
+"""The name of the hash scheme that entries are stored under.
+
+The hash buckets for this scheme use the unprefixed `hash_idx` keys.
+"""
+primary_hash_scheme = 'combined'
+
+"""The names of secondary hash schemes that newly-indexed images are also
+hashed and indexed with.
+"""
+index_hash_schemes = []
+
+def register_hash_scheme(scheme):
+    """Add a hash scheme to `hash_schemes`.
+    
+    Args:
+        scheme (HashScheme): The scheme to add.
+    
+    Raises:
+        ValueError: If a scheme with the same name or key prefix already exists.
+    """
+    
+    for other in hash_schemes.values():
+        if other.name == scheme.name or other.key_prefix == scheme.key_prefix:
+            raise ValueError("Hash scheme {} conflicts with existing scheme {}".format(scheme.name, other.name))
+    
+    hash_schemes[scheme.name] = scheme
+
+def get_hash_scheme(name=None):
+    """Look up a hash scheme by name.
+    
+    Args:
+        name (str or HashScheme): The name of the scheme. Defaults to
+            `primary_hash_scheme`. HashScheme objects are returned as-is.
+    
+    Raises:
+        KeyError: If no scheme with the given name exists.
+    
+    Returns:
+        A HashScheme.
+    """
+    
+    if isinstance(name, HashScheme):
+        return name
+    
+    if name is None:
+        name = primary_hash_scheme
+    
+    try:
+        return hash_schemes[name]
+    except KeyError:
+        raise KeyError("Unknown hash scheme: {}".format(name))
+
+register_hash_scheme(HashScheme('combined', 128, combined_hash, 64, (9, 8), ''))
+register_hash_scheme(HashScheme('dhash256', 256, diff_hash_256, 64, (17, 16), 'dhash256:', 8))
+register_hash_scheme(HashScheme('phash', 64, dct_hash, 16, (32, 32), 'phash:', 8))
 
 def hamming_dist(h1, h2):
     """Compute the Hamming distance between two uint8 arrays.
     """
     
     return np.count_nonzero(np.unpackbits(np.bitwise_xor(h1, h2)))
+
+"""A lookup table mapping each byte value to the number of bits set within it.
+"""
+popcount_table = np.unpackbits(np.arange(256, dtype=np.uint8)[:, np.newaxis], axis=1).sum(axis=1).astype(np.uint8)
+
+def hash_matrix(hashes):
+    """Pack a sequence of image hashes into a single contiguous matrix.
+    
+    Args:
+        hashes (sequence of bytes): Image hashes, all of the same length.
+    
+    Returns:
+        A `uint8` ndarray with one row per hash.
+    """
+    
+    return np.frombuffer(b''.join(hashes), dtype=np.uint8).reshape(len(hashes), -1)
+
+def hamming_dist_many(hashes, imhash):
+    """Compute the Hamming distances between many hashes and a single hash.
+    
+    Args:
+        hashes (ndarray): A `uint8` matrix with one hash per row.
+        imhash (ndarray): The `uint8` hash to compare each row against.
+    
+    Returns:
+        An ndarray containing the distance for each row in `hashes`.
+    """
+    
+    return popcount_table[np.bitwise_xor(hashes, imhash)].sum(axis=1, dtype=np.int32)
+
+def hamming_dist_matrix(hashes, queries, max_block_size=1<<26):
+    """Compute the Hamming distances between every pair of hashes from two sets.
+    
+    Args:
+        hashes (ndarray): A `uint8` matrix with one hash per row.
+        queries (ndarray): A `uint8` matrix with one query hash per row.
+        max_block_size (int): The maximum size of the temporary arrays used
+            for computing distances, in bytes.
+    
+    Returns:
+        An ndarray of shape `(len(queries), len(hashes))` containing distances.
+    """
+    
+    out = np.empty((queries.shape[0], hashes.shape[0]), dtype=np.int32)
+    step = max(1, max_block_size // max(1, hashes.size))
+    
+    for i in range(0, queries.shape[0], step):
+        block = np.bitwise_xor(hashes[np.newaxis, :, :], queries[i:i+step, np.newaxis, :])
+        out[i:i+step] = popcount_table[block].sum(axis=2, dtype=np.int32)
+    
+    return out
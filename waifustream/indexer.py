@@ -4,12 +4,15 @@ import multiprocessing as mp
 import sys
 import time
 import traceback
+import urllib.parse
 
 import attr
 import aiohttp
-import aioredis
-from waifustream import danbooru, index
+from waifustream import backend, danbooru, index, utils, work_queue
+from waifustream.hashing import HashingService
+from waifustream.image_cache import ImageCache
 from waifustream.index import IndexEntry
+from waifustream.work_queue import WorkQueue
 
 with open(sys.argv[1], 'r', encoding='utf-8') as f:
     config = json.load(f)
@@ -18,100 +21,312 @@ with open(sys.argv[1], 'r', encoding='utf-8') as f:
     REDIS_URL = config['redis_url']
     INDEXER_UA = config['indexer_ua']
     index.exclude_tags = config['exclude_tags']
+    index.hash_chunk_bits = config.get('hash_chunk_bits', 8)
+    index.hash_draft_scale = config.get('hash_draft_scale', 8)
+    index.max_hash_pixels = config.get('max_hash_pixels', index.max_hash_pixels)
+    index.index_hash_schemes = config.get('hash_schemes', [])
+    danbooru.fetch_rendition = config.get('fetch_rendition', 'original')
+    
+    if config.get('image_cache_path') is not None:
+        index.image_cache = ImageCache(
+            config['image_cache_path'],
+            max_bytes=config.get('image_cache_bytes'),
+            thumbnail_size=config.get('image_cache_thumbnail_size')
+        )
+    
+    HASH_WORKERS = config.get('hash_workers')
+    HASH_MAX_PENDING = config.get('hash_max_pending')
+    
+    FETCH_CONCURRENCY = config.get('fetch_concurrency', 4)
+    INSERT_BATCH_SIZE = config.get('insert_batch_size', 50)
+    
+    REFRESH_INTERVAL = config.get('refresh_interval', 30*60)
+    POP_TIMEOUT = config.get('pop_timeout', 5)
+    REFRESH_WORKER = config.get('refresh_worker', True)
+    WORKER_ID = config.get('worker_id')
+    LEASE_TIMEOUT = config.get('lease_timeout', 300)
+    MAX_FETCH_ATTEMPTS = config.get('max_fetch_attempts', 5)
+    TAG_REFRESH_INTERVAL = config.get('tag_refresh_interval', 60)
+    
+    # Requests to the Danbooru API default to the same rate as before, and
+    # image downloads default to one per `min_download_delay` seconds.
+    RATE_LIMITS = {urllib.parse.urlsplit(danbooru.base_url).hostname: (2.0, 1)}
+    RATE_LIMITS.update((host, tuple(limit)) for host, limit in config.get('rate_limits', {}).items())
+    DEFAULT_RATE_LIMIT = tuple(config.get('default_rate_limit', (1.0 / MIN_DOWNLOAD_DELAY if MIN_DOWNLOAD_DELAY > 0 else None, 1)))
+
+def make_rate_limiter():
+    return utils.HostRateLimiter(DEFAULT_RATE_LIMIT, RATE_LIMITS)
+
+async def enqueue_posts(redis, tag, posts):
+    """Queue a page of posts for indexing, skipping those already seen.
+    
+    Returns:
+        int: The number of posts queued.
+    """
+    
+    if len(posts) == 0:
+        return 0
+    
+    pipe = redis.pipeline()
+    for post in posts:
+        pipe.sismember('indexed:danbooru', str(post.id))
+        pipe.sismember('awaiting_index:danbooru', str(post.id))
+    seen = await pipe.execute()
+    
+    new_posts = list(post for i, post in enumerate(posts) if not (seen[2*i] or seen[2*i+1]))
+    if len(new_posts) == 0:
+        return 0
+    
+    # Posts are pushed in the order they were found, as before.
+    serialized = list(json.dumps(attr.asdict(IndexEntry.from_danbooru_post(None, post))) for post in new_posts)
+    
+    tr = redis.multi_exec()
+    tr.lpush(work_queue.queue_key(tag), *serialized)
+    tr.sadd('awaiting_index:danbooru', *(str(post.id) for post in new_posts))
+    work_queue.signal_ready(tr, len(new_posts))
+    await tr.execute()
+    
+    return len(new_posts)
 
-async def refresh_one_tag(tag, sess, redis):
-    print("[refresh] Refreshing tag: "+tag)
+async def refresh_one_tag(tag, sess, redis, limiter=None):
+    """Queue the posts with a tag that are newer than its crawl cursor.
     
-    cur_head = await redis.lindex('index_queue:'+tag, 0)
-    if cur_head is not None:
-        head_entry = json.loads(cur_head)
-        last_id = head_entry['src_id']
-        print("[refresh] starting from ID {} with tag {}".format(last_id, tag))
-    else:
-        last_id = None
+    The first refresh of a tag only queues its newest page of posts; older
+    posts are left to `backfill_one_tag`. The cursor is saved after every
+    page, so failed refreshes resume where they left off.
+    """
+    
+    cursor = await index.get_crawl_cursor(redis, tag)
+    key = index.crawl_cursor_key(tag)
+    print("[refresh] Refreshing tag {} from ID {}".format(tag, cursor.newest_id))
     
     n = 0
-    async for post in danbooru.search(sess, [tag], index.exclude_tags, start_id=last_id):
-        is_indexed, awaiting_index = await asyncio.gather(
-            redis.sismember('indexed:danbooru', str(post.id)),
-            redis.sismember('awaiting_index:danbooru', str(post.id))
+    try:
+        while True:
+            posts = await danbooru.fetch_page(sess, [tag], after_id=cursor.newest_id, limiter=limiter)
+            if len(posts) == 0:
+                break
+            
+            n += await enqueue_posts(redis, tag, danbooru.filter_posts(posts, [tag], index.exclude_tags))
+            
+            if cursor.newest_id is None:
+                cursor.newest_id = posts[0].id
+                cursor.oldest_id = posts[-1].id
+                await redis.hmset_dict(key, newest_id=cursor.newest_id, oldest_id=cursor.oldest_id)
+                break
+            
+            cursor.newest_id = posts[0].id
+            await redis.hset(key, 'newest_id', cursor.newest_id)
+            
+            if len(posts) < danbooru.page_size:
+                break
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        traceback.print_exc()
+    
+    print("[refresh] Enqueued {} items for {}".format(n, tag))
+
+async def backfill_one_tag(tag, sess, redis, limiter=None):
+    """Queue the posts with a tag that are older than its crawl cursor.
+    
+    Each tag is only backfilled once, after its first refresh. Progress is
+    saved after every page. Danbooru can return short pages before the end
+    of a search (e.g. when some posts are hidden), so backfilling is only
+    finished once an empty page is returned.
+    """
+    
+    cursor = await index.get_crawl_cursor(redis, tag)
+    if cursor.backfill_done or cursor.oldest_id is None:
+        return
+    
+    key = index.crawl_cursor_key(tag)
+    print("[backfill] Backfilling tag {} from ID {}".format(tag, cursor.oldest_id))
+    
+    n = 0
+    try:
+        while True:
+            posts = await danbooru.fetch_page(sess, [tag], before_id=cursor.oldest_id, limiter=limiter)
+            n += await enqueue_posts(redis, tag, danbooru.filter_posts(posts, [tag], index.exclude_tags))
+            
+            if len(posts) == 0:
+                cursor.backfill_done = True
+                await redis.hset(key, 'backfill_done', 1)
+                break
+            
+            cursor.oldest_id = posts[-1].id
+            await redis.hset(key, 'oldest_id', cursor.oldest_id)
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        traceback.print_exc()
+        return
+    
+    print("[backfill] Finished backfilling {} ({} items enqueued)".format(tag, n))
+
+async def _refresh_loop(redis, sess, limiter):
+    while True:
+        tags = await index.get_indexed_tags(redis)
+        await asyncio.gather(*(refresh_one_tag(tag, sess, redis, limiter) for tag in tags))
+        await asyncio.sleep(REFRESH_INTERVAL)
+
+async def _backfill_loop(redis, sess, limiter):
+    # Tags are backfilled one at a time, so that routine refreshes aren't
+    # starved of API requests.
+    while True:
+        for tag in await index.get_indexed_tags(redis):
+            await backfill_one_tag(tag, sess, redis, limiter)
+        
+        await asyncio.sleep(60)
+
+async def refresh_character_worker():
+    redis = await backend.connect(REDIS_URL)
+    limiter = make_rate_limiter()
+    print("[refresh] Tag refresh worker started.")
+    
+    async with aiohttp.ClientSession(headers={'User-Agent': INDEXER_UA}) as sess:
+        await asyncio.gather(
+            _refresh_loop(redis, sess, limiter),
+            _backfill_loop(redis, sess, limiter)
         )
+
+
+async def _skip_entry(queue, item, entry):
+    # Failed entries are marked as indexed, so they aren't queued again.
+    traceback.print_exc()
+    await queue.redis.sadd('indexed:'+entry.src, entry.src_id)
+    await queue.complete([item])
+
+async def _pop_stage(queue, fetch_q):
+    # Waiting for new items blocks the connection used to wait on, so the
+    # rest of the pipeline can't share it.
+    pop_redis = await backend.connect(REDIS_URL)
+    
+    tags = []
+    refreshed_at = None
+    next_idx = 0
+    
+    while True:
+        now = time.monotonic()
+        if refreshed_at is None or now - refreshed_at >= TAG_REFRESH_INTERVAL:
+            tags = await index.get_indexed_tags(queue.redis)
+            refreshed_at = now
         
-        if is_indexed or awaiting_index:
+        if len(tags) == 0:
+            refreshed_at = None
+            await asyncio.sleep(POP_TIMEOUT)
             continue
         
-        entry = IndexEntry.from_danbooru_post(None, post)
-        ser = json.dumps(attr.asdict(entry))
+        # Items are claimed from the first non-empty queue in the order given,
+        # so start from the tag after the one claimed from last, for fairness.
+        next_idx %= len(tags)
+        rotated = tags[next_idx:] + tags[:next_idx]
+        item = await queue.claim(rotated, POP_TIMEOUT, pop_redis)
         
-        await asyncio.gather(
-            redis.lpush('index_queue:'+tag, ser),
-            redis.sadd('awaiting_index:danbooru', str(post.id))
-        )
+        if item is None:
+            # All queues are idle; check for newly indexed tags.
+            refreshed_at = None
+            continue
         
-        n += 1
+        next_idx = (next_idx + rotated.index(item.tag) + 1) % len(tags)
         
-    print("[refresh] Enqueued {} items for {}".format(n, tag))
+        entry_dict = json.loads(item.data)
+        entry = IndexEntry(**entry_dict)
+        
+        if entry.src_url is None:
+            await queue.redis.sadd('indexed:'+entry.src, entry.src_id)
+            await queue.complete([item])
+            continue
+        
+        await fetch_q.put((item, entry))
 
-async def refresh_character_worker():
-    redis = await aioredis.create_redis(REDIS_URL)
-    print("[refresh] Tag refresh worker started.")
-    
+async def _fetch_stage(queue, sess, limiter, fetch_q, hash_q):
     while True:
-        tags = await redis.lrange('indexed_tags', 0, -1)
+        item, entry = await fetch_q.get()
         
-        async with aiohttp.ClientSession(headers={'User-Agent': INDEXER_UA}) as sess:
-            futs = []
-            for tag in tags:
-                tag = tag.decode('utf-8')
-                futs.append(asyncio.ensure_future(refresh_one_tag(tag, sess, redis)))
-                
-            await asyncio.gather(*futs)
-    
-        await asyncio.sleep(30*60)
+        try:
+            bio = await entry.fetch_bytesio(sess, limiter)
+        except aiohttp.ClientResponseError as e:
+            if (e.status == 429 or e.status >= 500) and item.attempts + 1 < MAX_FETCH_ATTEMPTS:
+                # Still failing after backing off; try again later.
+                print("[fetch] Requeueing {}#{} after error {}".format(entry.src, entry.src_id, e.status))
+                await queue.release(item)
+            else:
+                await _skip_entry(queue, item, entry)
+            continue
+        except (OSError, aiohttp.ClientError, asyncio.TimeoutError):
+            await _skip_entry(queue, item, entry)
+            continue
+        
+        await hash_q.put((item, entry, bio.getvalue()))
 
+async def _hash_stage(queue, hasher, hash_q, insert_q):
+    while True:
+        item, entry, data = await hash_q.get()
+        
+        try:
+            hashes = await hasher.hash_bytes_multi(data, [index.primary_hash_scheme] + index.index_hash_schemes)
+        except OSError:
+            await _skip_entry(queue, item, entry)
+            continue
+        
+        imhash = hashes.pop(index.primary_hash_scheme)
+        await insert_q.put((item, attr.evolve(entry, imhash=imhash, extra_hashes=hashes)))
+
+async def _insert_stage(queue, insert_q):
+    n = 0
+    t1 = time.perf_counter()
+    
+    while True:
+        batch = [await insert_q.get()]
+        while len(batch) < INSERT_BATCH_SIZE and not insert_q.empty():
+            batch.append(insert_q.get_nowait())
+        
+        entries = list(entry for _, entry in batch)
+        await IndexEntry.add_many(queue.redis, entries)
+        
+        pipe = queue.redis.pipeline()
+        for entry in entries:
+            pipe.srem('awaiting_index:'+entry.src, entry.src_id)
+        await pipe.execute()
+        
+        await queue.complete(list(item for item, _ in batch))
+        
+        for entry in entries:
+            print("[fetch] Indexed: {}#{}".format(entry.src, entry.src_id))
+        
+        n += len(batch)
+        if n % 100 < len(batch):
+            print("[fetch] Indexed {} images ({:.2f} images/s)".format(n, n / (time.perf_counter() - t1)))
 
 async def fetch_worker():
-    redis = await aioredis.create_redis(REDIS_URL)
-    print("[fetch] Fetch worker started.")
+    """Fetch, hash and index queued images.
+    
+    Entries move through a pipeline of stages connected by bounded queues:
+    claiming entries from the tag queues, downloading images (with up to
+    `FETCH_CONCURRENCY` downloads at once, rate-limited per host), hashing
+    them within the worker pool, and inserting them into the index in batches.
+    
+    Entries are claimed through a `WorkQueue`, so several fetch workers
+    (possibly on different hosts) can share the same queues, and the entries
+    being processed by a worker that dies are returned to their queues.
+    """
+    
+    redis = await backend.connect(REDIS_URL)
+    queue = WorkQueue(redis, worker_id=WORKER_ID, lease_timeout=LEASE_TIMEOUT)
+    hasher = HashingService(n_workers=HASH_WORKERS, max_pending=HASH_MAX_PENDING)
+    limiter = make_rate_limiter()
+    
+    n = await queue.recover()
+    print("[fetch] Fetch worker {} started (recovered {} items).".format(queue.worker_id, n))
+    
+    fetch_q = asyncio.Queue(FETCH_CONCURRENCY)
+    hash_q = asyncio.Queue(hasher.max_pending)
+    insert_q = asyncio.Queue(INSERT_BATCH_SIZE)
     
     async with aiohttp.ClientSession(headers={'User-Agent': INDEXER_UA}) as sess:
-        while True:
-            tags = await redis.lrange('indexed_tags', 0, -1)
-            for tag in tags:
-                tag = tag.decode('utf-8')
-                next_entry = await redis.rpop('index_queue:'+tag)
-                
-                if next_entry is None:
-                    continue
-                
-                t1 = time.perf_counter()
-                
-                entry_dict = json.loads(next_entry)
-                entry = IndexEntry(**entry_dict)
-                
-                if entry.src_url is None:
-                    await redis.sadd('indexed:'+entry.src, entry.src_id)
-                    continue
-                
-                try:
-                    img = await entry.fetch(sess)
-                    imhash = index.combined_hash(img)
-                    img.close()
-                    
-                    entry = attr.evolve(entry, imhash=imhash)
-                    await entry.add_to_index(redis)
-                    await redis.srem('awaiting_index:'+entry.src, entry.src_id)
-                    
-                    print("[fetch] Indexed: {}#{}".format(entry.src, entry.src_id))
-                except (OSError, aiohttp.ClientError):
-                    traceback.print_exc()
-                    await redis.sadd('indexed:'+entry.src, entry.src_id)
-                
-                t2 = time.perf_counter()
-                
-                dt = t2 - t1
-                if dt < MIN_DOWNLOAD_DELAY:
-                    await asyncio.sleep(MIN_DOWNLOAD_DELAY - dt)
+        stages = [queue.run_heartbeat(), _pop_stage(queue, fetch_q)]
+        stages.extend(_fetch_stage(queue, sess, limiter, fetch_q, hash_q) for _ in range(FETCH_CONCURRENCY))
+        stages.extend(_hash_stage(queue, hasher, hash_q, insert_q) for _ in range(hasher.max_pending))
+        stages.append(_insert_stage(queue, insert_q))
+        
+        await asyncio.gather(*stages)
 
 def _start_worker(f):
     loop = asyncio.get_event_loop()
@@ -124,7 +339,8 @@ def start_refresh_worker():
     _start_worker(refresh_character_worker)
     
 def main():
-    targets = [start_refresh_worker]
+    # Only one Indexer should run the refresh worker; any number can fetch.
+    targets = [start_refresh_worker] if REFRESH_WORKER else []
     workers = []
     
     for tgt in targets:
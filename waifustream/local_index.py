@@ -0,0 +1,213 @@
+import contextlib
+import fcntl
+import mmap
+import os
+import struct
+
+import numpy as np
+
+from . import index
+
+
+class LocalIndex(object):
+    """A local, memory-mapped copy of every image hash within the index.
+
+    Hashes are stored as packed 16-byte rows within a single file, which is
+    mapped into memory and brute-force scanned to answer queries. The file
+    is kept up to date by tailing the index change log, and can be shared
+    between several processes on the same host.
+
+    Attributes:
+        path (str): The path to the backing file.
+    """
+
+    magic = b'WSLIDX01'
+    header_fmt = '<8sQ32s'
+    header_size = 64
+    row_size = 16
+    grow_rows = 65536
+
+    def __init__(self, path):
+        self.path = str(path)
+        self._fd = None
+        self._ino = None
+        self._mm = None
+
+        with self._lock():
+            if not os.path.exists(self.path):
+                self._create(self.path)
+
+            self._open()
+
+    @contextlib.contextmanager
+    def _lock(self):
+        with open(self.path+'.lock', 'wb') as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+    def _create(self, path):
+        with open(path, 'wb') as f:
+            f.write(struct.pack(self.header_fmt, self.magic, 0, b'').ljust(self.header_size, b'\0'))
+            f.truncate(self.header_size + (self.grow_rows * self.row_size))
+
+    def _open(self):
+        if self._fd is not None:
+            os.close(self._fd)
+
+        self._fd = os.open(self.path, os.O_RDWR)
+        self._ino = os.fstat(self._fd).st_ino
+        self._map()
+
+        magic, _, _ = struct.unpack_from(self.header_fmt, self._mm, 0)
+        if magic != self.magic:
+            raise ValueError(self.path+" is not a local index file")
+
+    def _map(self):
+        self._mm = mmap.mmap(self._fd, os.fstat(self._fd).st_size)
+
+    def _check_reopen(self):
+        # Rebuilds replace the backing file entirely; pick up the new one
+        # if that happened in another process.
+        try:
+            if os.stat(self.path).st_ino != self._ino:
+                self._open()
+        except FileNotFoundError:
+            pass
+
+    def _read_header(self):
+        _, n_rows, last_id = struct.unpack_from(self.header_fmt, self._mm, 0)
+        return n_rows, last_id.rstrip(b'\0')
+
+    def _append(self, hashes, last_id):
+        n_rows, _ = self._read_header()
+        n_new = len(hashes)
+
+        end = self.header_size + ((n_rows + n_new) * self.row_size)
+        if end > len(self._mm):
+            n_grow = max(self.grow_rows, n_new)
+            os.ftruncate(self._fd, end + (n_grow * self.row_size))
+            self._map()
+
+        if n_new > 0:
+            start = self.header_size + (n_rows * self.row_size)
+            self._mm[start:end] = b''.join(hashes)
+
+        # The row count is only updated after the rows themselves have been
+        # written, so concurrent readers never see partially-written rows.
+        struct.pack_into(self.header_fmt, self._mm, 0, self.magic, n_rows + n_new, last_id)
+
+    def __len__(self):
+        self._check_reopen()
+        n_rows, _ = self._read_header()
+        return n_rows
+
+    @property
+    def hashes(self):
+        """ndarray: A `uint8` matrix view of every hash in this index, one per row.
+        """
+
+        n_rows, _ = self._read_header()
+        if self.header_size + (n_rows * self.row_size) > len(self._mm):
+            self._map()
+
+        return np.frombuffer(self._mm, dtype=np.uint8, count=n_rows*self.row_size, offset=self.header_size).reshape(n_rows, self.row_size)
+
+    def search(self, imhash, min_threshold=64, k=None):
+        """Search this index for images with nearby hashes.
+
+        Args:
+            imhash (ndarray): An image hash to look up. Must be of type `uint8`.
+            min_threshold (int): A minimum distance threshold for filtering results.
+            k (int): If provided, return at most this many results.
+
+        Returns:
+            A list of (hash, distance) tuples, sorted by increasing distance.
+        """
+
+        self._check_reopen()
+
+        hashes = self.hashes
+        dists = index.hamming_dist_many(hashes, imhash)
+
+        res = {}
+        for i in index.rank_distances(dists, min_threshold):
+            res.setdefault(hashes[i].tobytes(), int(dists[i]))
+            if k is not None and len(res) >= k:
+                break
+
+        return list(res.items())
+
+    async def rebuild(self, redis):
+        """Rebuild this index from scratch using the hashes stored in Redis.
+
+        Args:
+            redis (aioredis.Redis): A Redis interface.
+        """
+
+        _, last_id = await index.get_index_log_bounds(redis)
+        if last_id is None:
+            last_id = b'0-0'
+
+        hashes = set()
+        async for h in index.scan_hashes(redis):
+            hashes.add(h)
+
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            header = struct.pack(self.header_fmt, self.magic, len(hashes), last_id)
+            f.write(header.ljust(self.header_size, b'\0'))
+            f.write(b''.join(hashes))
+
+        with self._lock():
+            os.replace(tmp_path, self.path)
+            self._open()
+
+    async def sync(self, redis, batch_size=10000):
+        """Apply any new entries from the index change log to this index.
+
+        If this index has never been built, or if it has fallen too far
+        behind the change log, it will be rebuilt from scratch.
+
+        Args:
+            redis (aioredis.Redis): A Redis interface.
+            batch_size (int): The maximum number of log entries to read per request.
+
+        Returns:
+            int: The number of hashes added to this index.
+        """
+
+        self._check_reopen()
+        _, last_id = self._read_header()
+
+        if len(last_id) == 0:
+            await self.rebuild(redis)
+            return len(self)
+
+        head, _ = await index.get_index_log_bounds(redis)
+        if head is not None and index.parse_log_id(head) > index.parse_log_id(last_id):
+            # The log may have been trimmed past the last entry we've seen.
+            await self.rebuild(redis)
+            return len(self)
+
+        n_added = 0
+        while True:
+            _, last_id = self._read_header()
+
+            entries = await index.read_index_log(redis, last_id, batch_size)
+            if len(entries) == 0:
+                return n_added
+
+            with self._lock():
+                # Another process may have applied some of these entries
+                # while we were waiting on Redis.
+                self._check_reopen()
+                _, last_id = self._read_header()
+
+                entries = list(e for e in entries if index.parse_log_id(e[0]) > index.parse_log_id(last_id))
+                if len(entries) > 0:
+                    self._append(list(h for _, h in entries), entries[-1][0])
+
+            n_added += len(entries)
@@ -0,0 +1,192 @@
+from collections import OrderedDict
+import sys
+import time
+
+import numpy as np
+
+from . import index
+
+
+class QueryCache(object):
+    """An LRU cache for search results, keyed by query image hash.
+
+    Cached results are invalidated whenever a hash is added to the index
+    within `threshold` of a cached query, so that lookups never miss
+    newly-indexed images. This is done by tailing the index change log
+    with `sync`.
+
+    Attributes:
+        max_entries (int): The maximum number of cached queries.
+        max_bytes (int): If not None, the maximum total (estimated) size of
+            all cached values, in bytes.
+        ttl (float): If not None, the number of seconds each cached result
+            remains valid for.
+        threshold (int): Cached queries within this distance of a newly-indexed
+            hash are invalidated.
+        hits (int): The number of cache hits so far.
+        misses (int): The number of cache misses so far.
+        evictions (int): The number of entries evicted due to size limits or expiry.
+        invalidations (int): The number of entries invalidated by new index entries.
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=None, ttl=3600, threshold=32):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.threshold = threshold
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+        self._entries = OrderedDict()
+        self._n_bytes = 0
+        self._last_log_id = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def n_bytes(self):
+        """int: The total estimated size of all cached values, in bytes.
+        """
+        return self._n_bytes
+
+    @property
+    def hit_rate(self):
+        """float: The fraction of lookups that resulted in a cache hit.
+        """
+        n = self.hits + self.misses
+        if n == 0:
+            return 0.0
+        return self.hits / n
+
+    def _key(self, imhash):
+        if isinstance(imhash, np.ndarray):
+            return imhash.tobytes()
+        return bytes(imhash)
+
+    def _remove(self, key):
+        _, _, size = self._entries.pop(key)
+        self._n_bytes -= size
+
+    def get(self, imhash, default=None):
+        """Look up the cached result for a query hash.
+
+        Args:
+            imhash (bytes or ndarray): The query hash.
+            default: The value to return if no valid cached result exists.
+
+        Returns:
+            The cached value, or `default`.
+        """
+
+        key = self._key(imhash)
+
+        try:
+            value, expires, _ = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            return default
+
+        if expires is not None and time.monotonic() >= expires:
+            self._remove(key)
+            self.evictions += 1
+            self.misses += 1
+            return default
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, imhash, value, size=None):
+        """Cache a result for a query hash.
+
+        Args:
+            imhash (bytes or ndarray): The query hash.
+            value: The value to cache.
+            size (int): The size of `value` in bytes. If not provided, this
+                is estimated using `sys.getsizeof`.
+        """
+
+        key = self._key(imhash)
+        if key in self._entries:
+            self._remove(key)
+
+        if size is None:
+            size = sys.getsizeof(value)
+
+        expires = None
+        if self.ttl is not None:
+            expires = time.monotonic() + self.ttl
+
+        self._entries[key] = (value, expires, size)
+        self._n_bytes += size
+
+        while len(self._entries) > self.max_entries or (self.max_bytes is not None and self._n_bytes > self.max_bytes):
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def invalidate_near(self, hashes):
+        """Invalidate all cached queries near any of the given hashes.
+
+        Args:
+            hashes (sequence of bytes): Newly-indexed image hashes.
+
+        Returns:
+            int: The number of cached entries invalidated.
+        """
+
+        hashes = list(hashes)
+        if len(self._entries) == 0 or len(hashes) == 0:
+            return 0
+
+        keys = list(self._entries.keys())
+        dists = index.hamming_dist_matrix(index.hash_matrix(keys), index.hash_matrix(hashes))
+        near = np.flatnonzero((dists < self.threshold).any(axis=0))
+
+        for i in near:
+            self._remove(keys[i])
+
+        self.invalidations += len(near)
+        return len(near)
+
+    def clear(self):
+        """Remove all cached results.
+        """
+
+        self.invalidations += len(self._entries)
+        self._entries.clear()
+        self._n_bytes = 0
+
+    async def sync(self, redis, batch_size=10000):
+        """Invalidate cached results using new entries from the index change log.
+
+        Args:
+            redis (aioredis.Redis): A Redis interface.
+            batch_size (int): The maximum number of log entries to read per request.
+        """
+
+        if self._last_log_id is None:
+            # Nothing can be cached before the first sync, so there's nothing
+            # to invalidate.
+            _, tail = await index.get_index_log_bounds(redis)
+            self._last_log_id = tail if tail is not None else b'0-0'
+            return
+
+        head, tail = await index.get_index_log_bounds(redis)
+        if head is not None and index.parse_log_id(head) > index.parse_log_id(self._last_log_id):
+            # The log may have been trimmed past the last entry we've seen,
+            # so some new entries can't be checked against cached results.
+            self.clear()
+            self._last_log_id = tail
+            return
+
+        while True:
+            entries = await index.read_index_log(redis, self._last_log_id, batch_size)
+            if len(entries) == 0:
+                return
+
+            self.invalidate_near(h for _, h in entries)
+            self._last_log_id = entries[-1][0]
@@ -0,0 +1,179 @@
+import struct
+
+import numpy as np
+import ujson as json
+
+from . import index
+from .index import IndexEntry
+
+"""Snapshot files begin with this magic string.
+"""
+snapshot_magic = b'WSSNAP01'
+
+_header_fmt = '<8sQ'
+_record_len_fmt = '<I'
+
+
+def _read_exact(f, n):
+    data = f.read(n)
+    if len(data) < n:
+        raise ValueError("Unexpected end of snapshot file")
+    return data
+
+def _read_header(f):
+    magic, n_entries = struct.unpack(_header_fmt, _read_exact(f, struct.calcsize(_header_fmt)))
+    if magic != snapshot_magic:
+        raise ValueError("Not an index snapshot file")
+    
+    return n_entries
+
+def _read_hash_block(f, mmap_path=None):
+    version = np.lib.format.read_magic(f)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+    else:
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+    
+    if dtype != np.uint8 or len(shape) != 2 or fortran_order:
+        raise ValueError("Invalid snapshot hash block")
+    
+    if mmap_path is not None:
+        hashes = np.memmap(mmap_path, dtype=np.uint8, mode='r', offset=f.tell(), shape=shape)
+        f.seek(hashes.size, 1)
+    else:
+        hashes = np.frombuffer(_read_exact(f, shape[0] * shape[1]), dtype=np.uint8).reshape(shape)
+    
+    return hashes
+
+def _entry_record(entry):
+    record = [entry.src, entry.src_id, entry.src_url, entry.rating, list(entry.characters)]
+    if len(entry.extra_hashes) > 0:
+        record.append(dict((name, h.hex()) for name, h in entry.extra_hashes.items()))
+    
+    return record
+
+async def export_snapshot(redis, f, batch_size=1000):
+    """Write every entry within the index to a snapshot file.
+    
+    Snapshots consist of a short header, followed by every image hash as a
+    single `.npy`-formatted `uint8` matrix (one hash per row), followed by
+    the metadata for each entry (including any secondary scheme hashes) as
+    length-prefixed JSON records in the same order as the hashes.
+    
+    Args:
+        redis (aioredis.Redis): A Redis interface.
+        f (file): A binary file object to write to.
+        batch_size (int): The number of entries to load from Redis per request.
+    
+    Returns:
+        int: The number of entries written.
+    """
+    
+    # Entries migrated during the scan can be seen twice.
+    hashes = list(dict.fromkeys([h async for h in index.scan_hashes(redis)]))
+    hash_block = np.frombuffer(b''.join(hashes), dtype=np.uint8).reshape(len(hashes), 16)
+    
+    f.write(struct.pack(_header_fmt, snapshot_magic, len(hashes)))
+    np.lib.format.write_array(f, hash_block, allow_pickle=False)
+    
+    for i in range(0, len(hashes), batch_size):
+        entries = await IndexEntry.load_many(redis, hashes[i:i+batch_size])
+        
+        for entry in entries:
+            record = json.dumps(_entry_record(entry) if entry is not None else None).encode('utf-8')
+            f.write(struct.pack(_record_len_fmt, len(record)))
+            f.write(record)
+    
+    return len(hashes)
+
+def read_snapshot_hashes(path):
+    """Load the image hashes stored within a snapshot file, without loading any metadata.
+    
+    The hashes are memory-mapped, so this is suitable for offline analysis
+    and benchmarking over large snapshots.
+    
+    Args:
+        path (str): The path to a snapshot file.
+    
+    Returns:
+        ndarray: A `uint8` matrix containing one hash per row.
+    """
+    
+    with open(path, 'rb') as f:
+        _read_header(f)
+        return _read_hash_block(f, mmap_path=path)
+
+def iter_snapshot(f, batch_size=1000):
+    """Read the entries stored within a snapshot file.
+    
+    Args:
+        f (file): A binary file object to read from.
+        batch_size (int): The number of entries to yield at a time.
+    
+    Yields:
+        Lists of up to `batch_size` IndexEntry objects.
+    """
+    
+    n_entries = _read_header(f)
+    hashes = _read_hash_block(f)
+    
+    if hashes.shape != (n_entries, 16):
+        raise ValueError("Snapshot hash block does not match header")
+    
+    batch = []
+    for imhash in hashes:
+        record_len, = struct.unpack(_record_len_fmt, _read_exact(f, struct.calcsize(_record_len_fmt)))
+        record = json.loads(_read_exact(f, record_len).decode('utf-8'))
+        
+        if record is None:
+            continue
+        
+        src, src_id, src_url, rating, characters = record[:5]
+        extra_hashes = record[5] if len(record) > 5 else {}
+        
+        batch.append(IndexEntry(
+            imhash=imhash,
+            src=src,
+            src_id=src_id,
+            src_url=src_url,
+            characters=characters,
+            rating=rating,
+            extra_hashes=dict((name, bytes.fromhex(h)) for name, h in extra_hashes.items())
+        ))
+        
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    
+    if len(batch) > 0:
+        yield batch
+
+async def import_snapshot(redis, f, batch_size=1000, progress=None):
+    """Add every entry within a snapshot file to the index.
+    
+    Entries that already exist within the index are skipped.
+    
+    Args:
+        redis (aioredis.Redis): A Redis interface.
+        f (file): A binary file object to read from.
+        batch_size (int): The number of entries to write per pipeline.
+        progress (callable): If provided, called with the number of entries
+            added and the number of entries read so far after each batch.
+    
+    Returns:
+        A tuple containing the number of entries added and the number of entries read.
+    """
+    
+    n_total = 0
+    n_added = 0
+    
+    for batch in iter_snapshot(f, batch_size):
+        added = await IndexEntry.add_many(redis, batch, batch_size=batch_size)
+        
+        n_total += len(batch)
+        n_added += sum(added)
+        
+        if progress is not None:
+            progress(n_added, n_total)
+    
+    return n_added, n_total
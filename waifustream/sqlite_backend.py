@@ -0,0 +1,957 @@
+import asyncio
+import contextlib
+import fnmatch
+import hashlib
+import random
+import sqlite3
+import struct
+import time
+
+import aioredis
+import numpy as np
+
+from . import index, work_queue
+from .backend import IndexBackend
+
+_schema = """
+CREATE TABLE IF NOT EXISTS keys (key BLOB PRIMARY KEY, type TEXT NOT NULL) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS strings (key BLOB PRIMARY KEY, value BLOB NOT NULL) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS hashes (key BLOB, field BLOB, value BLOB NOT NULL, PRIMARY KEY (key, field)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS sets (key BLOB, member BLOB, PRIMARY KEY (key, member)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS lists (key BLOB, pos INTEGER, value BLOB NOT NULL, PRIMARY KEY (key, pos)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS zsets (key BLOB, member BLOB, score REAL NOT NULL, PRIMARY KEY (key, member)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS zsets_by_score ON zsets (key, score, member);
+CREATE TABLE IF NOT EXISTS streams (key BLOB, ms INTEGER, seq INTEGER, fields BLOB NOT NULL, PRIMARY KEY (key, ms, seq)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS stream_meta (key BLOB PRIMARY KEY, length INTEGER NOT NULL, last_ms INTEGER NOT NULL, last_seq INTEGER NOT NULL) WITHOUT ROWID;
+"""
+
+_max_int = (1<<63) - 1
+
+_value_tables = {
+    'string': ('strings',),
+    'hash': ('hashes',),
+    'set': ('sets',),
+    'list': ('lists',),
+    'zset': ('zsets',),
+    'stream': ('streams', 'stream_meta'),
+}
+
+def _enc(value):
+    if isinstance(value, bytes):
+        return value
+    elif isinstance(value, (bytearray, memoryview)):
+        return bytes(value)
+    elif isinstance(value, str):
+        return value.encode('utf-8')
+    elif isinstance(value, int) and not isinstance(value, bool):
+        return str(value).encode('utf-8')
+    elif isinstance(value, float):
+        return repr(value).encode('utf-8')
+    
+    raise TypeError("Argument {!r} expected to be of bytearray, bytes, float, int, or str type".format(value))
+
+def _dec(value, encoding):
+    if value is None or encoding is None:
+        return value
+    return value.decode(encoding)
+
+def _pack_fields(fields):
+    parts = []
+    for field, value in fields.items():
+        field = _enc(field)
+        value = _enc(value)
+        parts.append(struct.pack('<II', len(field), len(value)))
+        parts.append(field)
+        parts.append(value)
+    return b''.join(parts)
+
+def _unpack_fields(data):
+    fields = {}
+    offset = 0
+    while offset < len(data):
+        n_field, n_value = struct.unpack_from('<II', data, offset)
+        offset += 8
+        field = data[offset:offset+n_field]
+        offset += n_field
+        fields[field] = data[offset:offset+n_value]
+        offset += n_value
+    return fields
+
+def _parse_stream_id(stream_id, default_seq):
+    stream_id = _enc(stream_id)
+    if b'-' in stream_id:
+        ms, seq = stream_id.split(b'-', 1)
+        return int(ms), int(seq)
+    return int(stream_id), default_seq
+
+def _glob_prefix(pattern):
+    # The literal portion of a glob pattern, used to narrow key scans.
+    for i, c in enumerate(pattern):
+        if c in b'*?[\\':
+            return pattern[:i]
+    return pattern
+
+def _prefix_upper_bound(prefix):
+    prefix = prefix.rstrip(b'\xff')
+    if len(prefix) == 0:
+        return None
+    return prefix[:-1] + bytes([prefix[-1] + 1])
+
+def _wrongtype():
+    return aioredis.ReplyError("WRONGTYPE Operation against a key holding the wrong kind of value")
+
+
+class _Pipeline(object):
+    """Buffers commands for `SQLiteBackend`, mirroring `aioredis.commands.Pipeline`.
+    
+    All buffered commands are executed within a single SQLite transaction.
+    """
+    
+    error_class = aioredis.PipelineError
+    
+    def __init__(self, db):
+        self._db = db
+        self._calls = []
+        self._done = False
+    
+    def __getattr__(self, name):
+        method = getattr(self._db, name)
+        
+        def wrapper(*args, **kwargs):
+            fut = asyncio.get_event_loop().create_future()
+            self._calls.append((fut, method, args, kwargs))
+            return fut
+        
+        return wrapper
+    
+    async def execute(self, *, return_exceptions=False):
+        assert not self._done, "Pipeline already executed. Create new one."
+        self._done = True
+        
+        results = []
+        errors = []
+        
+        with self._db._transaction():
+            for fut, method, args, kwargs in self._calls:
+                try:
+                    res = await method(*args, **kwargs)
+                except aioredis.ReplyError as e:
+                    errors.append(e)
+                    results.append(e)
+                    fut.set_exception(e)
+                else:
+                    results.append(res)
+                    fut.set_result(res)
+        
+        if len(errors) > 0 and not return_exceptions:
+            raise self.error_class(errors)
+        
+        return results
+
+class _MultiExec(_Pipeline):
+    # Pipelines already execute atomically.
+    error_class = aioredis.MultiExecError
+
+
+class SQLiteBackend(IndexBackend):
+    """An embedded index backend, storing data within an SQLite database.
+    
+    Redis data types are emulated using one table per type, so that
+    individual set members, hash fields, etc. can be accessed without
+    loading entire values. Each command (or pipeline) runs within its own
+    transaction, so a database file can be safely shared between several
+    processes on the same host.
+    
+    Lua scripts cannot be run; instead, scripts used by WaifuStream are
+    recognized by their SHA1 digest and run as equivalent Python functions.
+    
+    Blocking commands are emulated by polling every `poll_interval` seconds,
+    since writes from other processes can't be waited on directly.
+    
+    Attributes:
+        path (str): The path to the database file, or `:memory:`.
+    """
+    
+    poll_interval = 0.1
+    
+    def __init__(self, path):
+        self.path = path
+        self._conn = sqlite3.connect(path, isolation_level=None, timeout=60)
+        self._tx_depth = 0
+        
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(_schema)
+    
+    @property
+    def closed(self):
+        return self._conn is None
+    
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+    
+    async def wait_closed(self):
+        pass
+    
+    @contextlib.contextmanager
+    def _transaction(self):
+        if self._tx_depth == 0:
+            self._conn.execute('BEGIN IMMEDIATE')
+        
+        self._tx_depth += 1
+        try:
+            yield
+        except BaseException:
+            self._tx_depth -= 1
+            if self._tx_depth == 0:
+                self._conn.execute('ROLLBACK')
+            raise
+        
+        self._tx_depth -= 1
+        if self._tx_depth == 0:
+            self._conn.execute('COMMIT')
+    
+    def _query(self, sql, *params):
+        return self._conn.execute(sql, params)
+    
+    def _type(self, key):
+        row = self._query('SELECT type FROM keys WHERE key = ?', key).fetchone()
+        return row[0] if row is not None else None
+    
+    def _check_type(self, key, key_type):
+        # Returns True if the key exists, and raises if it has another type.
+        cur = self._type(key)
+        if cur is not None and cur != key_type:
+            raise _wrongtype()
+        return cur is not None
+    
+    def _create(self, key, key_type):
+        if not self._check_type(key, key_type):
+            self._query('INSERT INTO keys (key, type) VALUES (?, ?)', key, key_type)
+    
+    def _delete_key(self, key):
+        key_type = self._type(key)
+        if key_type is None:
+            return False
+        
+        for table in _value_tables[key_type]:
+            self._query('DELETE FROM {} WHERE key = ?'.format(table), key)
+        self._query('DELETE FROM keys WHERE key = ?', key)
+        
+        return True
+    
+    def _delete_if_empty(self, key, table):
+        if self._query('SELECT 1 FROM {} WHERE key = ? LIMIT 1'.format(table), key).fetchone() is None:
+            self._query('DELETE FROM keys WHERE key = ?', key)
+    
+    def pipeline(self):
+        return _Pipeline(self)
+    
+    def multi_exec(self):
+        return _MultiExec(self)
+    
+    # Keys
+    
+    async def exists(self, key, *keys):
+        with self._transaction():
+            return sum(1 for k in (key,)+keys if self._type(_enc(k)) is not None)
+    
+    async def delete(self, key, *keys):
+        with self._transaction():
+            return sum(1 for k in (key,)+keys if self._delete_key(_enc(k)))
+    
+    async def unlink(self, key, *keys):
+        return await self.delete(key, *keys)
+    
+    async def iscan(self, *, match=None, count=None):
+        match = _enc(match) if match is not None else b'*'
+        count = count or 1000
+        
+        prefix = _glob_prefix(match)
+        upper = _prefix_upper_bound(prefix)
+        last = None
+        
+        while True:
+            sql = 'SELECT key FROM keys WHERE key >= ?'
+            params = [prefix]
+            
+            if upper is not None:
+                sql += ' AND key < ?'
+                params.append(upper)
+            
+            if last is not None:
+                sql += ' AND key > ?'
+                params.append(last)
+            
+            sql += ' ORDER BY key LIMIT ?'
+            params.append(count)
+            
+            rows = self._query(sql, *params).fetchall()
+            if len(rows) == 0:
+                return
+            
+            last = rows[-1][0]
+            for key, in rows:
+                if fnmatch.fnmatchcase(key, match):
+                    yield key
+    
+    async def flushdb(self):
+        with self._transaction():
+            for table in ('keys', 'strings', 'hashes', 'sets', 'lists', 'zsets', 'streams', 'stream_meta'):
+                self._query('DELETE FROM '+table)
+        return True
+    
+    # Strings
+    
+    async def get(self, key, *, encoding=None):
+        key = _enc(key)
+        
+        with self._transaction():
+            if not self._check_type(key, 'string'):
+                return None
+            
+            value, = self._query('SELECT value FROM strings WHERE key = ?', key).fetchone()
+            return _dec(value, encoding)
+    
+    async def set(self, key, value):
+        key = _enc(key)
+        
+        with self._transaction():
+            if self._type(key) not in (None, 'string'):
+                self._delete_key(key)
+            
+            self._create(key, 'string')
+            self._query('INSERT OR REPLACE INTO strings (key, value) VALUES (?, ?)', key, _enc(value))
+        
+        return True
+    
+    async def incrby(self, key, increment):
+        key = _enc(key)
+        
+        with self._transaction():
+            value = await self.get(key)
+            try:
+                value = int(value or 0) + int(increment)
+            except ValueError:
+                raise aioredis.ReplyError("ERR value is not an integer or out of range")
+            
+            await self.set(key, value)
+            return value
+    
+    async def incr(self, key):
+        return await self.incrby(key, 1)
+    
+    # Hashes
+    
+    async def hget(self, key, field, *, encoding=None):
+        return (await self.hmget(key, field, encoding=encoding))[0]
+    
+    async def hmget(self, key, field, *fields, encoding=None):
+        key = _enc(key)
+        fields = list(_enc(f) for f in (field,)+fields)
+        
+        with self._transaction():
+            if not self._check_type(key, 'hash'):
+                return list(None for _ in fields)
+            
+            out = []
+            for f in fields:
+                row = self._query('SELECT value FROM hashes WHERE key = ? AND field = ?', key, f).fetchone()
+                out.append(_dec(row[0], encoding) if row is not None else None)
+            
+            return out
+    
+    async def hgetall(self, key, *, encoding=None):
+        key = _enc(key)
+        
+        with self._transaction():
+            if not self._check_type(key, 'hash'):
+                return {}
+            
+            rows = self._query('SELECT field, value FROM hashes WHERE key = ?', key).fetchall()
+            return dict((_dec(f, encoding), _dec(v, encoding)) for f, v in rows)
+    
+    def _hset_many(self, key, pairs):
+        self._create(key, 'hash')
+        
+        n_new = 0
+        for field, value in pairs:
+            field = _enc(field)
+            if self._query('SELECT 1 FROM hashes WHERE key = ? AND field = ?', key, field).fetchone() is None:
+                n_new += 1
+            self._query('INSERT OR REPLACE INTO hashes (key, field, value) VALUES (?, ?, ?)', key, field, _enc(value))
+        
+        return n_new
+    
+    async def hset(self, key, field, value):
+        with self._transaction():
+            return self._hset_many(_enc(key), [(field, value)])
+    
+    async def hmset_dict(self, key, *args, **kwargs):
+        pairs = {}
+        for arg in args:
+            pairs.update(arg)
+        pairs.update(kwargs)
+        
+        with self._transaction():
+            self._hset_many(_enc(key), pairs.items())
+        
+        return True
+    
+    async def hdel(self, key, field, *fields):
+        key = _enc(key)
+        
+        with self._transaction():
+            if not self._check_type(key, 'hash'):
+                return 0
+            
+            n = 0
+            for f in (field,)+fields:
+                n += self._query('DELETE FROM hashes WHERE key = ? AND field = ?', key, _enc(f)).rowcount
+            
+            self._delete_if_empty(key, 'hashes')
+            return n
+    
+    async def hincrby(self, key, field, increment=1):
+        with self._transaction():
+            value = await self.hget(key, field)
+            try:
+                value = int(value or 0) + int(increment)
+            except ValueError:
+                raise aioredis.ReplyError("ERR hash value is not an integer")
+            
+            await self.hset(key, field, value)
+            return value
+    
+    # Sets
+    
+    async def sadd(self, key, member, *members):
+        key = _enc(key)
+        
+        with self._transaction():
+            self._create(key, 'set')
+            
+            n = 0
+            for m in (member,)+members:
+                n += self._query('INSERT OR IGNORE INTO sets (key, member) VALUES (?, ?)', key, _enc(m)).rowcount
+            return n
+    
+    async def srem(self, key, member, *members):
+        key = _enc(key)
+        
+        with self._transaction():
+            if not self._check_type(key, 'set'):
+                return 0
+            
+            n = 0
+            for m in (member,)+members:
+                n += self._query('DELETE FROM sets WHERE key = ? AND member = ?', key, _enc(m)).rowcount
+            
+            self._delete_if_empty(key, 'sets')
+            return n
+    
+    async def sismember(self, key, member):
+        key = _enc(key)
+        
+        with self._transaction():
+            if not self._check_type(key, 'set'):
+                return 0
+            
+            row = self._query('SELECT 1 FROM sets WHERE key = ? AND member = ?', key, _enc(member)).fetchone()
+            return int(row is not None)
+    
+    async def smembers(self, key, *, encoding=None):
+        return await self.sunion(key, encoding=encoding)
+    
+    async def scard(self, key):
+        key = _enc(key)
+        
+        with self._transaction():
+            if not self._check_type(key, 'set'):
+                return 0
+            
+            return self._query('SELECT COUNT(*) FROM sets WHERE key = ?', key).fetchone()[0]
+    
+    async def srandmember(self, key, count=None, *, encoding=None):
+        key = _enc(key)
+        
+        with self._transaction():
+            members = await self.smembers(key, encoding=encoding)
+        
+        if count is None:
+            return random.choice(members) if len(members) > 0 else None
+        elif count >= 0:
+            return random.sample(members, min(count, len(members)))
+        else:
+            return list(random.choice(members) for _ in range(-count)) if len(members) > 0 else []
+    
+    async def sunion(self, key, *keys, encoding=None):
+        keys = list(_enc(k) for k in (key,)+keys)
+        
+        with self._transaction():
+            keys = list(k for k in keys if self._check_type(k, 'set'))
+            if len(keys) == 0:
+                return []
+            
+            rows = self._query(
+                'SELECT DISTINCT member FROM sets WHERE key IN ({})'.format(','.join('?' * len(keys))),
+                *keys
+            ).fetchall()
+            
+            return list(_dec(m, encoding) for m, in rows)
+    
+    async def sunionstore(self, destkey, key, *keys):
+        with self._transaction():
+            members = await self.sunion(key, *keys)
+            await self.delete(destkey)
+            
+            if len(members) > 0:
+                await self.sadd(destkey, *members)
+            
+            return len(members)
+    
+    # Lists
+    
+    def _push(self, key, values, left):
+        key = _enc(key)
+        
+        with self._transaction():
+            self._create(key, 'list')
+            
+            lo, hi = self._query('SELECT MIN(pos), MAX(pos) FROM lists WHERE key = ?', key).fetchone()
+            if lo is None:
+                lo, hi = 1, 0
+            
+            for value in values:
+                if left:
+                    lo -= 1
+                    pos = lo
+                else:
+                    hi += 1
+                    pos = hi
+                
+                self._query('INSERT INTO lists (key, pos, value) VALUES (?, ?, ?)', key, pos, _enc(value))
+            
+            return self._query('SELECT COUNT(*) FROM lists WHERE key = ?', key).fetchone()[0]
+    
+    def _pop(self, key, left, encoding):
+        key = _enc(key)
+        
+        with self._transaction():
+            if not self._check_type(key, 'list'):
+                return None
+            
+            pos, value = self._query(
+                'SELECT pos, value FROM lists WHERE key = ? ORDER BY pos {} LIMIT 1'.format('ASC' if left else 'DESC'),
+                key
+            ).fetchone()
+            
+            self._query('DELETE FROM lists WHERE key = ? AND pos = ?', key, pos)
+            self._delete_if_empty(key, 'lists')
+            
+            return _dec(value, encoding)
+    
+    async def lpush(self, key, value, *values):
+        return self._push(key, (value,)+values, True)
+    
+    async def rpush(self, key, value, *values):
+        return self._push(key, (value,)+values, False)
+    
+    async def lpop(self, key, *, encoding=None):
+        return self._pop(key, True, encoding)
+    
+    async def rpop(self, key, *, encoding=None):
+        return self._pop(key, False, encoding)
+    
+    async def brpop(self, key, *keys, timeout=0, encoding=None):
+        deadline = time.monotonic() + timeout
+        
+        while True:
+            for k in (key,)+keys:
+                value = self._pop(k, False, encoding)
+                if value is not None:
+                    return [_dec(_enc(k), encoding), value]
+            
+            if timeout > 0 and time.monotonic() >= deadline:
+                return None
+            
+            await asyncio.sleep(self.poll_interval)
+    
+    async def lindex(self, key, index, *, encoding=None):
+        key = _enc(key)
+        
+        with self._transaction():
+            if not self._check_type(key, 'list'):
+                return None
+            
+            if index >= 0:
+                row = self._query('SELECT value FROM lists WHERE key = ? ORDER BY pos ASC LIMIT 1 OFFSET ?', key, index).fetchone()
+            else:
+                row = self._query('SELECT value FROM lists WHERE key = ? ORDER BY pos DESC LIMIT 1 OFFSET ?', key, -index-1).fetchone()
+            
+            return _dec(row[0], encoding) if row is not None else None
+    
+    async def lrange(self, key, start, stop, *, encoding=None):
+        key = _enc(key)
+        
+        with self._transaction():
+            if not self._check_type(key, 'list'):
+                return []
+            
+            values = list(v for v, in self._query('SELECT value FROM lists WHERE key = ? ORDER BY pos', key))
+        
+        # Redis list ranges include the stop index.
+        if stop < 0:
+            stop = len(values) + stop
+        
+        return list(_dec(v, encoding) for v in values[start if start >= 0 else max(len(values)+start, 0):stop+1])
+    
+    async def llen(self, key):
+        key = _enc(key)
+        
+        with self._transaction():
+            if not self._check_type(key, 'list'):
+                return 0
+            
+            return self._query('SELECT COUNT(*) FROM lists WHERE key = ?', key).fetchone()[0]
+    
+    async def lrem(self, key, count, value):
+        key = _enc(key)
+        
+        with self._transaction():
+            if not self._check_type(key, 'list'):
+                return 0
+            
+            order = 'DESC' if count < 0 else 'ASC'
+            rows = self._query('SELECT pos FROM lists WHERE key = ? AND value = ? ORDER BY pos '+order, key, _enc(value)).fetchall()
+            if count != 0:
+                rows = rows[:abs(count)]
+            
+            for pos, in rows:
+                self._query('DELETE FROM lists WHERE key = ? AND pos = ?', key, pos)
+            
+            self._delete_if_empty(key, 'lists')
+            return len(rows)
+    
+    async def ltrim(self, key, start, stop):
+        key = _enc(key)
+        
+        with self._transaction():
+            if not self._check_type(key, 'list'):
+                return True
+            
+            positions = list(p for p, in self._query('SELECT pos FROM lists WHERE key = ? ORDER BY pos', key))
+            n = len(positions)
+            
+            start = max(start + n if start < 0 else start, 0)
+            stop = stop + n if stop < 0 else stop
+            kept = set(positions[start:stop+1])
+            
+            for pos in positions:
+                if pos not in kept:
+                    self._query('DELETE FROM lists WHERE key = ? AND pos = ?', key, pos)
+            
+            self._delete_if_empty(key, 'lists')
+            return True
+    
+    # Sorted sets
+    
+    async def zadd(self, key, score, member, *pairs):
+        key = _enc(key)
+        pairs = (score, member) + pairs
+        
+        with self._transaction():
+            self._create(key, 'zset')
+            
+            n = 0
+            for score, member in zip(pairs[::2], pairs[1::2]):
+                member = _enc(member)
+                if self._query('SELECT 1 FROM zsets WHERE key = ? AND member = ?', key, member).fetchone() is None:
+                    n += 1
+                
+                self._query('INSERT OR REPLACE INTO zsets (key, member, score) VALUES (?, ?, ?)', key, member, float(score))
+            
+            return n
+    
+    async def zrem(self, key, member, *members):
+        key = _enc(key)
+        
+        with self._transaction():
+            if not self._check_type(key, 'zset'):
+                return 0
+            
+            n = 0
+            for m in (member,)+members:
+                n += self._query('DELETE FROM zsets WHERE key = ? AND member = ?', key, _enc(m)).rowcount
+            
+            self._delete_if_empty(key, 'zsets')
+            return n
+    
+    async def zscore(self, key, member):
+        key = _enc(key)
+        
+        with self._transaction():
+            if not self._check_type(key, 'zset'):
+                return None
+            
+            row = self._query('SELECT score FROM zsets WHERE key = ? AND member = ?', key, _enc(member)).fetchone()
+        
+        if row is None:
+            return None
+        
+        # Matches aioredis, which converts integral scores to ints.
+        return int(row[0]) if row[0].is_integer() else row[0]
+    
+    async def zcard(self, key):
+        key = _enc(key)
+        
+        with self._transaction():
+            if not self._check_type(key, 'zset'):
+                return 0
+            
+            return self._query('SELECT COUNT(*) FROM zsets WHERE key = ?', key).fetchone()[0]
+    
+    async def zrangebyscore(self, key, min=float('-inf'), max=float('inf'), withscores=False, *, encoding=None):
+        key = _enc(key)
+        
+        with self._transaction():
+            if not self._check_type(key, 'zset'):
+                return []
+            
+            rows = self._query(
+                'SELECT member, score FROM zsets WHERE key = ? AND score >= ? AND score <= ? ORDER BY score, member',
+                key, float(min), float(max)
+            ).fetchall()
+        
+        if withscores:
+            return list((_dec(m, encoding), s) for m, s in rows)
+        return list(_dec(m, encoding) for m, _ in rows)
+    
+    # Streams
+    
+    async def xadd(self, stream, fields, message_id=b'*', max_len=None, exact_len=False):
+        key = _enc(stream)
+        
+        with self._transaction():
+            self._create(key, 'stream')
+            
+            row = self._query('SELECT length, last_ms, last_seq FROM stream_meta WHERE key = ?', key).fetchone()
+            length, last_ms, last_seq = row if row is not None else (0, 0, 0)
+            
+            if _enc(message_id) == b'*':
+                ms = max(int(time.time() * 1000), last_ms)
+                seq = (last_seq + 1) if ms == last_ms else 0
+            else:
+                ms, seq = _parse_stream_id(message_id, 0)
+                if (ms, seq) <= (last_ms, last_seq):
+                    raise aioredis.ReplyError("ERR The ID specified in XADD is equal or smaller than the target stream top item")
+            
+            self._query('INSERT INTO streams (key, ms, seq, fields) VALUES (?, ?, ?, ?)', key, ms, seq, _pack_fields(fields))
+            length += 1
+            
+            if max_len is not None and length > max_len:
+                self._query(
+                    'DELETE FROM streams WHERE key = ? AND (ms, seq) IN (SELECT ms, seq FROM streams WHERE key = ? ORDER BY ms, seq LIMIT ?)',
+                    key, key, length - max_len
+                )
+                length = max_len
+            
+            self._query('INSERT OR REPLACE INTO stream_meta (key, length, last_ms, last_seq) VALUES (?, ?, ?, ?)', key, length, ms, seq)
+            
+            return '{}-{}'.format(ms, seq).encode('utf-8')
+    
+    def _xrange(self, stream, start, stop, count, reverse):
+        key = _enc(stream)
+        
+        start = (0, 0) if _enc(start) == b'-' else _parse_stream_id(start, 0)
+        stop = (_max_int, _max_int) if _enc(stop) == b'+' else _parse_stream_id(stop, _max_int)
+        
+        with self._transaction():
+            if not self._check_type(key, 'stream'):
+                return []
+            
+            sql = 'SELECT ms, seq, fields FROM streams WHERE key = ? AND (ms, seq) >= (?, ?) AND (ms, seq) <= (?, ?) ORDER BY ms {0}, seq {0}'.format('DESC' if reverse else 'ASC')
+            params = [key, start[0], start[1], stop[0], stop[1]]
+            
+            if count is not None:
+                sql += ' LIMIT ?'
+                params.append(count)
+            
+            return list(
+                ('{}-{}'.format(ms, seq).encode('utf-8'), _unpack_fields(fields))
+                for ms, seq, fields in self._query(sql, *params)
+            )
+    
+    async def xrange(self, stream, start='-', stop='+', count=None):
+        return self._xrange(stream, start, stop, count, False)
+    
+    async def xrevrange(self, stream, start='+', stop='-', count=None):
+        return self._xrange(stream, stop, start, count, True)
+    
+    # Scripting
+    
+    async def script_load(self, script):
+        digest = hashlib.sha1(script.encode('utf-8')).hexdigest()
+        if digest not in _script_impls:
+            raise aioredis.ReplyError("ERR the embedded backend cannot run arbitrary Lua scripts")
+        
+        return digest
+    
+    async def evalsha(self, digest, keys=[], args=[]):
+        try:
+            impl = _script_impls[digest]
+        except KeyError:
+            raise aioredis.ReplyError("NOSCRIPT No matching script. Please use EVAL.")
+        
+        with self._transaction():
+            return await impl(self, list(_enc(k) for k in keys), list(_enc(a) for a in args))
+
+# Python equivalents of the Lua scripts used by WaifuStream, keyed by the
+# SHA1 digest of the script source.
+_script_impls = {}
+
+def _implements(script):
+    def decorator(f):
+        _script_impls[hashlib.sha1(script.encode('utf-8')).hexdigest()] = f
+        return f
+    return decorator
+
+@_implements(index._intern_script)
+async def _intern(db, keys, args):
+    str_id = await db.hget(keys[0], args[0])
+    if str_id is not None:
+        return int(str_id)
+    
+    str_id = await db.incr(keys[2])
+    await db.hset(keys[0], args[0], str_id)
+    await db.hset(keys[1], str_id, args[0])
+    return str_id
+
+@_implements(index._add_entry_script)
+async def _add_entry(db, keys, args):
+    if await db.exists(keys[0], keys[1]) > 0:
+        return 0
+    
+    entry_id = await db.incr(keys[3])
+    bucket_size = int(args[2])
+    await db.hset(args[3] + str(entry_id // bucket_size).encode('utf-8'), entry_id % bucket_size, args[0])
+    
+    for key in keys[4:]:
+        await db.sadd(key, entry_id)
+    
+    fields = dict(zip(args[4::2], args[5::2]))
+    fields[b'n'] = entry_id
+    await db.hmset_dict(keys[0], fields)
+    await db.xadd(keys[2], {b'imhash': args[0]}, max_len=int(args[1]))
+    
+    return 1
+
+@_implements(index._assign_entry_id_script)
+async def _assign_entry_id(db, keys, args):
+    if await db.exists(keys[0]) == 0:
+        return 0
+    
+    entry_id = await db.hget(keys[0], b'n')
+    if entry_id is not None:
+        entry_id = int(entry_id)
+    else:
+        entry_id = await db.incr(keys[1])
+        bucket_size = int(args[1])
+        await db.hset(args[2] + str(entry_id // bucket_size).encode('utf-8'), entry_id % bucket_size, args[0])
+        await db.hset(keys[0], b'n', entry_id)
+    
+    for key in keys[2:]:
+        if await db.srem(key, args[0]) > 0:
+            await db.sadd(key, entry_id)
+    
+    return 1
+
+@_implements(index._add_scheme_hash_script)
+async def _add_scheme_hash(db, keys, args):
+    entry_id = await db.hget(keys[0], b'n')
+    if entry_id is None or await db.hget(keys[0], args[2]) is not None:
+        return 0
+    
+    entry_id = int(entry_id)
+    bucket_size = int(args[3])
+    await db.hset(keys[0], args[2], args[1])
+    await db.hset(args[4] + str(entry_id // bucket_size).encode('utf-8'), entry_id % bucket_size, args[1])
+    
+    entries = await db.hget(keys[1], args[1])
+    await db.hset(keys[1], args[1], (entries or b'') + args[0])
+    
+    for key in keys[2:]:
+        await db.sadd(key, entry_id)
+    
+    return 1
+
+@_implements(work_queue._claim_script)
+async def _claim(db, keys, args):
+    for key in keys[4:]:
+        item = await db.rpop(key)
+        if item is not None:
+            await db.lpush(keys[0], key + b'\n' + item)
+            await db.zadd(keys[1], int(args[1]), args[0])
+            return [key, item, int(await db.hget(keys[2], item) or 0)]
+    
+    await db.delete(keys[3])
+    return None
+
+@_implements(work_queue._reap_script)
+async def _reap(db, keys, args):
+    lease = await db.zscore(keys[0], args[0])
+    if lease is not None and lease > int(args[1]):
+        return 0
+    
+    items = await db.lrange(keys[1], 0, -1)
+    for elem in items:
+        key, _, item = elem.partition(b'\n')
+        await db.lpush(key, item)
+        await db.lpush(keys[2], 1)
+    
+    await db.ltrim(keys[2], 0, int(args[2]) - 1)
+    await db.delete(keys[1])
+    await db.zrem(keys[0], args[0])
+    return len(items)
+
+async def _resolve_members(db, members, id_prefix, bucket_size):
+    out = []
+    for m in members:
+        if len(m) >= 16:
+            out.append(m)
+            continue
+        
+        # Reverse map hashes are only ever written by scripts, so they can
+        # be read directly without type checks.
+        entry_id = int(m)
+        row = db._query(
+            'SELECT value FROM hashes WHERE key = ? AND field = ?',
+            id_prefix + str(entry_id // bucket_size).encode('utf-8'),
+            str(entry_id % bucket_size).encode('utf-8')
+        ).fetchone()
+        out.append(row[0] if row is not None else None)
+    return out
+
+@_implements(index._search_script)
+async def _search(db, keys, args):
+    query = args[0]
+    threshold = int(args[1])
+    k = int(args[2])
+    
+    members = await db.sunion(*keys)
+    hashes = set(await _resolve_members(db, members, args[3], int(args[4])))
+    hashes = list(h for h in hashes if h is not None and len(h) == len(query))
+    
+    if len(hashes) == 0:
+        return []
+    
+    results = sorted(index.score_candidates(hashes, np.frombuffer(query, dtype=np.uint8), threshold), key=lambda o: (o[1], o[0]))
+    if k > 0:
+        results = results[:k]
+    
+    out = []
+    for h, dist in results:
+        out.extend((h, dist))
+    return out
@@ -1,5 +1,7 @@
 import asyncio
 from datetime import datetime, timedelta
+import time
+import urllib.parse
 
 version = None
 
@@ -26,3 +28,150 @@ async def sleep_to_minute(freq):
     next_check_time = last_check_time + timedelta(minutes=freq)
     return await asyncio.sleep((next_check_time - datetime.utcnow()).total_seconds())
     
+
+class TokenBucket(object):
+    """Limits the rate of some operation, while allowing short bursts.
+    
+    Each operation takes a token from the bucket, which is refilled at a
+    constant rate up to a maximum of `burst` tokens. After a `backoff`, no
+    tokens are handed out for an exponentially-increasing delay, until an
+    operation succeeds again.
+    
+    Attributes:
+        rate (float): The number of tokens added per second. If None, the
+            rate is unlimited (but backoffs still apply).
+        burst (int): The maximum number of tokens in the bucket.
+    """
+    
+    min_backoff = 1.0
+    max_backoff = 300.0
+    
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        
+        self._tokens = burst
+        self._last = time.monotonic()
+        self._backoff = 0.0
+        self._resume_at = 0.0
+        self._lock = asyncio.Lock()
+    
+    async def acquire(self):
+        """Wait until a token is available, then take it.
+        """
+        
+        # Waiters are served in FIFO order.
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._resume_at:
+                    await asyncio.sleep(self._resume_at - now)
+                    continue
+                
+                if self.rate is None:
+                    return
+                
+                self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+    
+    def backoff(self, retry_after=None):
+        """Pause after a failure (i.e. a rate limit or server error).
+        
+        The pause doubles after each consecutive failure, from `min_backoff`
+        up to `max_backoff` seconds.
+        
+        Args:
+            retry_after (float): If given, pause for at least this many seconds.
+        """
+        
+        self._backoff = min(self.max_backoff, max(self.min_backoff, self._backoff * 2))
+        self._resume_at = max(self._resume_at, time.monotonic() + max(self._backoff, retry_after or 0))
+        self._tokens = 0
+    
+    def success(self):
+        """Reset the backoff delay after a successful operation.
+        """
+        self._backoff = 0.0
+
+class HostRateLimiter(object):
+    """Rate-limits HTTP requests with a separate TokenBucket for each host.
+    
+    Attributes:
+        default_limit (tuple): The (rate, burst) used for hosts not within `limits`.
+        limits (dict): Maps host names to (rate, burst) tuples.
+    """
+    
+    def __init__(self, default_limit=(None, 1), limits=None):
+        self.default_limit = tuple(default_limit)
+        self.limits = dict(limits or {})
+        self._buckets = {}
+    
+    def bucket(self, url):
+        """Get the TokenBucket for the host of a URL.
+        """
+        
+        host = urllib.parse.urlsplit(url).hostname
+        if host not in self._buckets:
+            self._buckets[host] = TokenBucket(*self.limits.get(host, self.default_limit))
+        
+        return self._buckets[host]
+
+def parse_retry_after(value):
+    """Parse the value of a `Retry-After` header, in seconds.
+    
+    Returns:
+        A `float`, or None if the header is missing or is an HTTP date.
+    """
+    
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+async def fetch_url(sess, url, limiter=None, max_tries=5):
+    """Download the contents of a URL.
+    
+    If a limiter is given, each request waits for a token from the bucket
+    for the URL's host. Responses with a 429 or 5xx status make the host's
+    bucket back off (respecting any `Retry-After` header), and are retried
+    up to `max_tries` times in total.
+    
+    Args:
+        sess (aiohttp.ClientSession): The session to make requests with.
+        url (str): The URL to fetch.
+        limiter (HostRateLimiter): If given, used to rate-limit requests.
+        max_tries (int): The maximum number of requests to make.
+    
+    Raises:
+        aiohttp.ClientResponseError: If the final response has an error status.
+    
+    Returns:
+        The response body, as `bytes`.
+    """
+    
+    bucket = limiter.bucket(url) if limiter is not None else None
+    
+    for attempt in range(max_tries):
+        if bucket is not None:
+            await bucket.acquire()
+        
+        async with sess.get(url) as resp:
+            data = await resp.read()
+            
+            retry = (resp.status == 429 or resp.status >= 500)
+            if bucket is None or not retry:
+                if bucket is not None:
+                    bucket.success()
+                
+                resp.raise_for_status()
+                return data
+            
+            bucket.backoff(parse_retry_after(resp.headers.get('Retry-After')))
+            if attempt == max_tries - 1:
+                resp.raise_for_status()
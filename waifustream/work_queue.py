@@ -0,0 +1,271 @@
+import asyncio
+import os
+import socket
+import time
+
+import attr
+
+from . import index
+
+"""Images awaiting indexing are queued within the Redis lists
+`index_queue:<tag>`.
+"""
+queue_key_prefix = 'index_queue:'
+
+"""Items claimed by each fetch worker are moved into the Redis list
+`fetch_processing:<worker id>` until they're completed or released, so that
+they can be recovered if the worker dies.
+"""
+processing_key_prefix = 'fetch_processing:'
+
+"""A sorted set mapping the ID of each fetch worker to the time (in
+milliseconds since the epoch) at which its lease on its claimed items expires.
+"""
+lease_key = 'fetch_leases'
+
+"""A hash mapping queued data to the number of times fetching it has failed
+and been retried (see `WorkQueue.release`).
+"""
+attempts_key = 'fetch_attempts'
+
+"""A list used to wake idle workers when items are queued. Each element is a
+signal that one item may be available.
+"""
+ready_key = 'index_queue_ready'
+
+"""The maximum number of pending wakeup signals.
+"""
+max_ready_signals = 100
+
+# Time values far enough in the future to cover every lease.
+_forever_ms = 1 << 52
+
+
+def queue_key(tag):
+    return queue_key_prefix + tag
+
+def processing_key(worker_id):
+    return processing_key_prefix + worker_id
+
+def default_worker_id():
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+def signal_ready(redis, n):
+    """Wake up to `n` idle workers after queueing items.
+    
+    Args:
+        redis: The Redis pipeline or transaction that queued the items.
+        n (int): The number of items queued.
+    """
+    
+    n = min(n, max_ready_signals)
+    if n > 0:
+        redis.lpush(ready_key, *([1] * n))
+        redis.ltrim(ready_key, 0, max_ready_signals - 1)
+
+# Processing list elements record the key of the queue each item came from,
+# so that it can be returned there. Items and their ready signals are always
+# queued together, so if every queue is empty, any remaining signals are
+# stale (their items were claimed without waiting), and would only wake idle
+# workers for nothing; they're cleared atomically with the failed claim.
+_claim_script = """
+for i = 5, #KEYS do
+    local item = redis.call('RPOP', KEYS[i])
+    if item then
+        redis.call('LPUSH', KEYS[1], KEYS[i] .. '\\n' .. item)
+        redis.call('ZADD', KEYS[2], ARGV[2], ARGV[1])
+        return {KEYS[i], item, tonumber(redis.call('HGET', KEYS[3], item) or 0)}
+    end
+end
+redis.call('DEL', KEYS[4])
+return false
+"""
+
+_reap_script = """
+local lease = redis.call('ZSCORE', KEYS[1], ARGV[1])
+if lease and tonumber(lease) > tonumber(ARGV[2]) then
+    return 0
+end
+
+local items = redis.call('LRANGE', KEYS[2], 0, -1)
+for _, elem in ipairs(items) do
+    local sep = string.find(elem, '\\n', 1, true)
+    redis.call('LPUSH', string.sub(elem, 1, sep - 1), string.sub(elem, sep + 1))
+    redis.call('LPUSH', KEYS[3], 1)
+end
+
+redis.call('LTRIM', KEYS[3], 0, tonumber(ARGV[3]) - 1)
+redis.call('DEL', KEYS[2])
+redis.call('ZREM', KEYS[1], ARGV[1])
+return #items
+"""
+
+
+@attr.s(frozen=True)
+class WorkItem(object):
+    """An item claimed from a tag queue.
+    
+    Attributes:
+        queue_key (bytes): The key of the queue the item was claimed from.
+        data (bytes): The queued data (a serialized IndexEntry).
+        attempts (int): The number of times this item was previously
+            released for retrying.
+    """
+    
+    queue_key: bytes = attr.ib()
+    data: bytes = attr.ib()
+    attempts: int = attr.ib(default=0)
+    
+    @property
+    def tag(self):
+        return self.queue_key.decode('utf-8')[len(queue_key_prefix):]
+    
+    @property
+    def element(self):
+        return self.queue_key + b'\n' + self.data
+
+
+class WorkQueue(object):
+    """A reliable view of the tag queues, for one fetch worker.
+    
+    Claiming an item atomically moves it from its tag queue into the
+    worker's processing list, where it stays until the worker completes or
+    releases it. Each worker holds a lease on its processing list, which it
+    must renew (with `heartbeat`) more often than every `lease_timeout`
+    seconds. When a lease expires (i.e. because its worker crashed or lost
+    its connection), any other worker's `reap` returns the items to their
+    queues. Any number of workers, on any number of hosts, can share the
+    same queues.
+    
+    Items are delivered at least once: an item whose lease expired while it
+    was still being processed may be processed again by another worker.
+    
+    Attributes:
+        redis (aioredis.Redis): A Redis interface.
+        worker_id (str): A unique ID for this worker. Defaults to the host
+            name and process ID; workers given a fixed ID recover their own
+            unfinished items immediately upon restarting (see `recover`).
+        lease_timeout (float): The number of seconds a lease lasts for.
+    """
+    
+    def __init__(self, redis, worker_id=None, lease_timeout=300):
+        self.redis = redis
+        self.worker_id = worker_id or default_worker_id()
+        self.lease_timeout = lease_timeout
+    
+    @property
+    def processing_key(self):
+        return processing_key(self.worker_id)
+    
+    def _lease_deadline(self):
+        return int((time.time() + self.lease_timeout) * 1000)
+    
+    async def claim(self, tags, timeout=0, blocking_redis=None):
+        """Claim the next item from the first non-empty queue out of a list of tags.
+        
+        Args:
+            tags (list of str): The tags whose queues are checked, in order.
+            timeout (float): If all queues are empty, wait up to this many
+                seconds for items to be queued.
+            blocking_redis (aioredis.Redis): The connection used for waiting,
+                which is blocked while doing so. Required if `timeout` is
+                nonzero.
+        
+        Returns:
+            A WorkItem, or None if all queues are empty.
+        """
+        
+        if len(tags) == 0:
+            return None
+        
+        keys = [self.processing_key, lease_key, attempts_key, ready_key] + list(queue_key(tag) for tag in tags)
+        args = [self.worker_id, self._lease_deadline()]
+        
+        res = await index.run_script(self.redis, _claim_script, keys, args)
+        if res is None and timeout > 0:
+            if await blocking_redis.brpop(ready_key, timeout=timeout) is not None:
+                res = await index.run_script(self.redis, _claim_script, keys, args)
+        
+        if res is None:
+            return None
+        return WorkItem(queue_key=res[0], data=res[1], attempts=int(res[2]))
+    
+    async def complete(self, items):
+        """Remove finished items from this worker's processing list.
+        
+        Args:
+            items (list of WorkItem): The finished items.
+        """
+        
+        pipe = self.redis.pipeline()
+        for item in items:
+            pipe.lrem(self.processing_key, 1, item.element)
+            if item.attempts > 0:
+                pipe.hdel(attempts_key, item.data)
+        await pipe.execute()
+    
+    async def release(self, item):
+        """Return an unfinished item to the back of its queue, to be retried later.
+        
+        The item's attempt count is incremented, and is returned with it the
+        next time it's claimed.
+        """
+        
+        tr = self.redis.multi_exec()
+        tr.lpush(item.queue_key, item.data)
+        tr.lrem(self.processing_key, 1, item.element)
+        tr.hincrby(attempts_key, item.data, 1)
+        signal_ready(tr, 1)
+        await tr.execute()
+    
+    async def heartbeat(self):
+        """Renew this worker's lease on its claimed items.
+        """
+        await self.redis.zadd(lease_key, self._lease_deadline(), self.worker_id)
+    
+    async def _reap(self, worker_id, expired_before):
+        keys = [lease_key, processing_key(worker_id), ready_key]
+        args = [worker_id, expired_before, max_ready_signals]
+        return await index.run_script(self.redis, _reap_script, keys, args)
+    
+    async def reap(self):
+        """Return the items claimed by workers with expired leases to their queues.
+        
+        Returns:
+            int: The number of items returned.
+        """
+        
+        now = int(time.time() * 1000)
+        expired = await self.redis.zrangebyscore(lease_key, max=now, encoding='utf-8')
+        
+        n = 0
+        for worker_id in expired:
+            if worker_id != self.worker_id:
+                n += await self._reap(worker_id, now)
+        
+        return n
+    
+    async def recover(self):
+        """Return all items claimed under this worker's ID to their queues.
+        
+        This should be called when a worker starts, before it claims any
+        items, to recover items left behind by a previous run with the same ID.
+        
+        Returns:
+            int: The number of items returned.
+        """
+        
+        return await self._reap(self.worker_id, _forever_ms)
+    
+    async def run_heartbeat(self):
+        """Renew this worker's lease and reap expired leases, forever.
+        """
+        
+        while True:
+            await self.heartbeat()
+            
+            n = await self.reap()
+            if n > 0:
+                print("[fetch] Requeued {} items from expired leases".format(n))
+            
+            await asyncio.sleep(self.lease_timeout / 3)